@@ -0,0 +1,234 @@
+import time
+import fnmatch
+
+from big_brother.details.globals import MainProp, MetaProp, InstanceProp
+from big_brother.details.utils import parse_duration
+
+
+API_VERSION = 1
+# Query parameters
+FIELDS_PARAM = "fields"  # Ex: fields=name,load_avg_1
+SORT_PARAM = "sort"  # Ex: sort=load_avg_1 (ascending), sort=-load_avg_1 (descending)
+LIMIT_PARAM = "limit"  # Ex: limit=5
+FILTER_PARAMS = [InstanceProp.NAME, InstanceProp.TYPE]  # Ex: name=apollo-*,helios  type=Synology NAS
+QUERY_PARAMS = [FIELDS_PARAM, SORT_PARAM, LIMIT_PARAM] + FILTER_PARAMS
+# History query parameters
+HOST_PARAM = "host"  # Ex: host=apollo-*,helios (default: all)
+METRIC_PARAM = "metric"  # Ex: metric=load_avg_1
+FROM_PARAM = "from"  # Ex: from=1671198283 (seconds since epoch), from=-24h (24h ago, default: -1h)
+TO_PARAM = "to"  # Ex: to=-12h (default: now)
+STEP_PARAM = "step"  # Ex: step=15m (rollup tier), step=raw (samples), default: finest one with few points
+AGGREGATE_PARAM = "agg"  # Ex: agg=p95 (default: none, series returned)
+HISTORY_QUERY_PARAMS = [HOST_PARAM, METRIC_PARAM, FROM_PARAM, TO_PARAM, STEP_PARAM, AGGREGATE_PARAM]
+DEFAULT_HISTORY_DURATION = 3600  # 1h
+# Archive query parameters (same as history ones, without step)
+ARCHIVE_QUERY_PARAMS = [HOST_PARAM, METRIC_PARAM, FROM_PARAM, TO_PARAM, AGGREGATE_PARAM]
+DEFAULT_ARCHIVE_DURATION = 86400  # 1 day
+
+
+def query_snapshot(snapshot, kind, query):
+    """Select instances or storages (kind) of a snapshot matching query parameters, sort them and project them on
+    requested fields, using indexes built once per snapshot
+
+    Example:
+    query: {"fields": "name,load_avg_1", "sort": "load_avg_1", "limit": "2"}
+    result: {"version": 1, "snapshot": "3a-17f0...", "timestamp": "2022-12-16 13:44:43",
+             "instances": [{"name": "helios", "load_avg_1": 0.65}, {"name": "apollo-1", "load_avg_1": 142.35}]}
+    """
+    if kind not in [MainProp.INSTANCES, MainProp.STORAGES]:
+        raise RuntimeError(f"Invalid kind: {kind}")
+    unknown_params = sorted(set(query.keys()) - set(QUERY_PARAMS))
+    if unknown_params:
+        raise RuntimeError(f"Invalid parameter(s): {', '.join(unknown_params)}")
+    records = snapshot.data[kind]
+    index = snapshot.get_rendering(f"api-index-{kind}", lambda data: create_index(data[kind]))
+    # Filter
+    indices = None
+    for prop in FILTER_PARAMS:
+        if query.get(prop):
+            matching_indices = get_matching_indices(index[prop], query[prop].split(","))
+            indices = matching_indices if indices is None else indices & matching_indices
+    # Sort (default: input order)
+    sort_field = query.get(SORT_PARAM)
+    if sort_field:
+        descending = sort_field.startswith("-")
+        sort_field = sort_field.removeprefix("-")
+        check_fields([sort_field], index)
+        order = snapshot.get_rendering(f"api-order-{kind}-{sort_field}",
+                                       lambda data: get_sort_order(data[kind], sort_field))
+        ordered_indices = order["descending"] if descending else order["ascending"]
+    else:
+        ordered_indices = range(len(records))
+    if indices is not None:
+        ordered_indices = [i for i in ordered_indices if i in indices]
+    # Limit
+    limit = query.get(LIMIT_PARAM)
+    if limit:
+        if not limit.isdigit():
+            raise RuntimeError(f"Invalid {LIMIT_PARAM}: {limit}")
+        ordered_indices = ordered_indices[:int(limit)]
+    # Project
+    fields = query.get(FIELDS_PARAM)
+    if fields:
+        fields = fields.split(",")
+        check_fields(fields, index)
+        selected_records = [{field: records[i].get(field) for field in fields} for i in ordered_indices]
+    else:
+        selected_records = [records[i] for i in ordered_indices]
+    return {
+        "version": API_VERSION,
+        "snapshot": snapshot.get_tag(),
+        "timestamp": snapshot.data[MainProp.METADATA][MetaProp.PROCESS_TIMESTAMP],
+        kind: selected_records,
+    }
+
+
+def create_index(records):
+    """Index records by filtered property values (ex: {"name": {"helios": {1}}, ...}), and list their fields"""
+    index = {prop: {} for prop in FILTER_PARAMS}
+    index[FIELDS_PARAM] = {value for key, value in vars(InstanceProp).items() if not key.startswith("_")}
+    for i, record in enumerate(records):
+        for prop in FILTER_PARAMS:
+            index[prop].setdefault(str(record.get(prop)), set()).add(i)
+        index[FIELDS_PARAM].update(record.keys())
+    return index
+
+
+def get_matching_indices(prop_index, patterns):
+    """Get indices of records matching any of given values, which may contain wildcards (ex: apollo-*)"""
+    indices = set()
+    for pattern in patterns:
+        if any(char in pattern for char in "*?["):
+            for value, value_indices in prop_index.items():
+                if fnmatch.fnmatchcase(value, pattern):
+                    indices |= value_indices
+        else:
+            indices |= prop_index.get(pattern, set())
+    return indices
+
+
+def get_sort_order(records, field):
+    """Get indices of records sorted by given field, ascending and descending, missing values being last"""
+    known_indices = [i for i, record in enumerate(records) if record.get(field) is not None]
+    missing_indices = [i for i, record in enumerate(records) if record.get(field) is None]
+    # Sorts being stable, equal values are kept in input order
+    try:
+        ascending = sorted(known_indices, key=lambda i: records[i][field])
+        descending = sorted(known_indices, key=lambda i: records[i][field], reverse=True)
+    except TypeError:
+        # Mixed types
+        ascending = sorted(known_indices, key=lambda i: str(records[i][field]))
+        descending = sorted(known_indices, key=lambda i: str(records[i][field]), reverse=True)
+    return {
+        "ascending": ascending + missing_indices,
+        "descending": descending + missing_indices,
+    }
+
+
+def check_fields(fields, index):
+    unknown_fields = [field for field in fields if field not in index[FIELDS_PARAM]]
+    if unknown_fields:
+        raise RuntimeError(f"Invalid field(s): {', '.join(unknown_fields)}")
+
+
+def query_history(history, query):
+    """Get series of a metric over a time range for hosts matching query parameters, or their aggregate (each one's
+    and all together), from the finest rollup tier covering the time range with few points (MetricsHistory)
+
+    Example:
+    query: {"host": "apollo-*", "metric": "mem_used", "from": "-24h", "agg": "p95"}
+    result: {"version": 1, "metric": "mem_used", "from": 1671112923.0, "to": 1671199323.0, "step": 900,
+             "stat": "mean", "agg": "p95", "hosts": {"apollo-1": 10211651.2, "apollo-2": 5702442.0},
+             "all": 10147312.4}
+    """
+    # NumPy only needed with history
+    from big_brother.details.history import get_aggregate_stat, aggregate_series, get_json_values
+
+    metric, from_time, to_time = parse_range_query(query, HISTORY_QUERY_PARAMS, DEFAULT_HISTORY_DURATION)
+    # Series
+    step = query.get(STEP_PARAM)
+    if not step:
+        step = history.select_step(from_time, to_time)
+    elif step == "raw":
+        step = None
+    else:
+        step = parse_duration(step)
+    aggregate = query.get(AGGREGATE_PARAM)
+    stat = None if step is None else get_aggregate_stat(aggregate) if aggregate else "mean"
+    hosts = history.get_hosts()
+    if query.get(HOST_PARAM):
+        host_index = {host: {i} for i, host in enumerate(hosts)}
+        hosts = [hosts[i] for i in sorted(get_matching_indices(host_index, query[HOST_PARAM].split(",")))]
+    series = [history.get_series(host, metric, from_time, to_time, step, stat) for host in hosts]
+    result = {
+        "version": API_VERSION,
+        METRIC_PARAM: metric,
+        FROM_PARAM: from_time,
+        TO_PARAM: to_time,
+        STEP_PARAM: step,
+        "stat": stat,
+        AGGREGATE_PARAM: aggregate,
+    }
+    if aggregate:
+        host_values, all_value = aggregate_series(series, aggregate)
+        result["hosts"] = dict(zip(hosts, get_json_values(host_values)))
+        result["all"] = get_json_values([all_value])[0]
+    else:
+        result["hosts"] = {host: {"times": times.tolist(), "values": get_json_values(values)}
+                           for host, (times, values) in zip(hosts, series)}
+    return result
+
+
+def query_archive(archive, query):
+    """Get series of a metric over a time range for hosts matching query parameters, or their aggregate (each one's
+    and all together), computed by the archive database (MetricsArchive)
+
+    Example:
+    query: {"host": "apollo-*", "metric": "load_avg_1", "from": "-30d", "agg": "max"}
+    result: {"version": 1, "metric": "load_avg_1", "from": 1668607323.0, "to": 1671199323.0, "agg": "max",
+             "hosts": {"apollo-1": 254.12, "apollo-2": 31.5}, "all": 254.12}
+    """
+    metric, from_time, to_time = parse_range_query(query, ARCHIVE_QUERY_PARAMS, DEFAULT_ARCHIVE_DURATION)
+    host_patterns = query[HOST_PARAM].split(",") if query.get(HOST_PARAM) else []
+    aggregate = query.get(AGGREGATE_PARAM)
+    result = {
+        "version": API_VERSION,
+        METRIC_PARAM: metric,
+        FROM_PARAM: from_time,
+        TO_PARAM: to_time,
+        AGGREGATE_PARAM: aggregate,
+    }
+    if aggregate:
+        result["hosts"], result["all"] = archive.get_aggregates(host_patterns, metric, from_time, to_time, aggregate)
+    else:
+        result["hosts"] = {host: {"times": times, "values": values} for host, (times, values) in
+                           archive.get_series(host_patterns, metric, from_time, to_time).items()}
+    return result
+
+
+def parse_range_query(query, query_params, default_duration):
+    """Check parameters of a time range query, and get its (metric, from time, to time)"""
+    unknown_params = sorted(set(query.keys()) - set(query_params))
+    if unknown_params:
+        raise RuntimeError(f"Invalid parameter(s): {', '.join(unknown_params)}")
+    metric = query.get(METRIC_PARAM)
+    if not metric:
+        raise RuntimeError(f"Missing parameter: {METRIC_PARAM}")
+    now = time.time()
+    to_time = parse_time(query.get(TO_PARAM), now)
+    to_time = now if to_time is None else to_time
+    from_time = parse_time(query.get(FROM_PARAM), now)
+    from_time = to_time - default_duration if from_time is None else from_time
+    return metric, from_time, to_time
+
+
+def parse_time(text, now):
+    """Parse a time given in seconds since epoch, or relative to now (ex: -24h), None if not given"""
+    if not text:
+        return None
+    if text.startswith("-"):
+        return now - parse_duration(text[1:])
+    try:
+        return float(text)
+    except ValueError:
+        raise RuntimeError(f"Invalid time: {text} (ex: 1671198283, -24h)")
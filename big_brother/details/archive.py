@@ -0,0 +1,309 @@
+import os
+import math
+import time
+import queue
+import sqlite3
+import threading
+import contextlib
+
+from big_brother.details.globals import InstanceProp
+from big_brother.details.segments import SegmentStore, DEFAULT_CODEC, SEGMENT_DURATION, SEGMENT_FILE_EXTENSION, \
+    write_segment, read_segment_rows, get_segment_name
+
+
+# Properties of instances and storages kept in archive (one column each)
+ARCHIVE_METRICS = [
+    InstanceProp.CPU_COUNT,
+    InstanceProp.LOAD_AVERAGE_1,
+    InstanceProp.LOAD_AVERAGE_5,
+    InstanceProp.LOAD_AVERAGE_15,
+    InstanceProp.MEMORY_TOTAL,
+    InstanceProp.MEMORY_USED,
+    InstanceProp.DISK_SPACE_TOTAL,
+    InstanceProp.DISK_SPACE_USED,
+    InstanceProp.DISK_SPACE_AVAILABLE,
+    InstanceProp.NET_SEND_RATE,
+    InstanceProp.NET_RECEIVE_RATE,
+    InstanceProp.UPTIME,
+]
+ARCHIVE_TABLE = "samples"
+DEFAULT_ARCHIVE_RETENTION = 365 * 86400  # 1 year
+# Delay between two prunings of samples older than retention (seconds)
+ARCHIVE_PRUNE_PERIOD = 3600  # 1h
+# Cycles waiting to be written, before new ones are dropped (writer not keeping up, ex: disk full)
+MAX_PENDING_CYCLES = 64
+# Aggregates, computed from partial ones (min, max, sum, count) of database and segments
+ARCHIVE_AGGREGATES = ["min", "max", "mean", "count"]
+
+
+class MetricsArchive:
+    """Long-term archive of instances and storages metrics, in a SQLite database (one row per host and sample time)
+
+    Monitoring cycles are handed over to a dedicated writer thread through a bounded queue, so that archiving never
+    blocks the monitor: each cycle is inserted in a single transaction, the database being in WAL mode so that readers
+    (ex: server, opening the archive with readonly=True) never block the writer nor get blocked by it.
+    Older days may be moved to compressed segments (see compact_archive), queried along with the database if
+    segments_dir is given: segments up to the last compacted day, then the database (samples of compacted days
+    archived late being only queried once compacted as well).
+    """
+
+    def __init__(self, db_path, retention=DEFAULT_ARCHIVE_RETENTION, readonly=False, logger=None,
+                 max_pending=MAX_PENDING_CYCLES, segments_dir=None):
+        self.db_path = db_path
+        self.segments = None if segments_dir is None else SegmentStore(segments_dir)
+        self.retention = retention
+        self.readonly = readonly
+        self.logger = logger
+        self.dropped_count = 0
+        if readonly:
+            if not os.path.isfile(db_path):
+                raise RuntimeError(f"File not found: {db_path}")
+            with contextlib.closing(self._connect()) as connection:
+                self.metrics = get_table_columns(connection)[2:]
+            return
+        self.metrics = list(ARCHIVE_METRICS)
+        init_archive_db(db_path, self.metrics)
+        self._queue = queue.Queue(max_pending)
+        self._writer = threading.Thread(target=self._write_cycles, name="BBArchiveWriter", daemon=True)
+        self._writer.start()
+
+    def append_results(self, timestamp, results):
+        """Queue instance and storage results of a cycle (given time in seconds since epoch) to be written, return
+        False if dropped (writer not keeping up)
+        """
+        rows = [(result[InstanceProp.NAME], timestamp, *[result.get(metric) for metric in self.metrics])
+                for result in results]
+        try:
+            self._queue.put_nowait(rows)
+            return True
+        except queue.Full:
+            self.dropped_count += 1
+            return False
+
+    def close(self):
+        """Write queued cycles, and stop writer"""
+        if not self.readonly and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+    def _write_cycles(self):
+        connection = self._connect()
+        columns = ["host", "ts"] + self.metrics
+        insert_query = f"INSERT OR IGNORE INTO {ARCHIVE_TABLE} ({', '.join(columns)}) " \
+                       f"VALUES ({', '.join(['?'] * len(columns))})"
+        prune_time = 0
+        try:
+            while True:
+                rows = self._queue.get()
+                if rows is None:
+                    break
+                try:
+                    # One transaction per cycle
+                    with connection:
+                        connection.executemany(insert_query, rows)
+                    if self.retention and time.monotonic() >= prune_time:
+                        prune_time = time.monotonic() + ARCHIVE_PRUNE_PERIOD
+                        with connection:
+                            connection.execute(f"DELETE FROM {ARCHIVE_TABLE} WHERE ts < ?",
+                                               (time.time() - self.retention,))
+                except sqlite3.Error as e:
+                    # Cycle lost, following ones still written
+                    if self.logger is not None:
+                        self.logger.error(f"Archive {self.db_path}: {e}")
+        finally:
+            connection.close()
+
+    def get_hosts(self):
+        with contextlib.closing(self._connect()) as connection:
+            return [row[0] for row in connection.execute(f"SELECT DISTINCT host FROM {ARCHIVE_TABLE} ORDER BY host")]
+
+    def get_series(self, host_patterns, metric, from_time, to_time):
+        """Get {host: (times, values)} of a metric for hosts matching any of given patterns (wildcards allowed, ex:
+        apollo-*) between given times, in time order
+        """
+        self._check_metric(metric)
+        host_clause, host_params = get_host_clause(host_patterns)
+
+        def read_database(database_from_time):
+            with contextlib.closing(self._connect()) as connection:
+                return connection.execute(
+                    f"SELECT host, ts, {metric} FROM {ARCHIVE_TABLE} WHERE {host_clause} AND ts BETWEEN ? AND ? "
+                    f"ORDER BY host, ts", (*host_params, database_from_time, to_time)).fetchall()
+
+        # Older samples first (segments)
+        series, rows = self._read_segments_and_database(host_patterns, metric, from_time, to_time, read_database)
+        for host, timestamp, value in rows:
+            times, values = series.setdefault(host, ([], []))
+            times.append(timestamp)
+            values.append(value)
+        return dict(sorted(series.items()))
+
+    def get_aggregates(self, host_patterns, metric, from_time, to_time, aggregate):
+        """Get ({host: aggregate}, aggregate of all hosts) of a metric (ARCHIVE_AGGREGATES) between given times"""
+        self._check_metric(metric)
+        if aggregate not in ARCHIVE_AGGREGATES:
+            raise RuntimeError(f"Invalid aggregate: {aggregate} ({', '.join(ARCHIVE_AGGREGATES)})")
+        host_clause, host_params = get_host_clause(host_patterns)
+
+        def read_database(database_from_time):
+            with contextlib.closing(self._connect()) as connection:
+                return connection.execute(
+                    f"SELECT host, MIN({metric}), MAX({metric}), SUM({metric}), COUNT({metric}) FROM {ARCHIVE_TABLE} "
+                    f"WHERE {host_clause} AND ts BETWEEN ? AND ? AND {metric} IS NOT NULL GROUP BY host",
+                    (*host_params, database_from_time, to_time)).fetchall()
+
+        # Partial aggregates [min, max, sum, count] of each host, from segments then computed by SQLite
+        series, rows = self._read_segments_and_database(host_patterns, metric, from_time, to_time, read_database)
+        host_partials = {}
+        for host, (_, values) in series.items():
+            values = [value for value in values if value is not None]
+            if values:
+                host_partials[host] = [min(values), max(values), math.fsum(values), len(values)]
+        for host, *partial in rows:
+            host_partials[host] = merge_partial_aggregates(host_partials.get(host), partial)
+        all_partial = None
+        for partial in host_partials.values():
+            all_partial = merge_partial_aggregates(all_partial, partial)
+        return {host: get_aggregate(host_partials[host], aggregate) for host in sorted(host_partials)}, \
+            get_aggregate(all_partial, aggregate)
+
+    def _read_segments_and_database(self, host_patterns, metric, from_time, to_time, read_database):
+        """Get (segments series, database rows) between given times, each sample being read from either one only:
+        database read after the last segment, both read again if a day was compacted meanwhile
+        """
+        while True:
+            end_time = None if self.segments is None else self.segments.get_end_time()
+            series = {} if end_time is None else self.segments.get_series(host_patterns, metric, from_time, to_time)
+            rows = read_database(from_time if end_time is None else max(from_time, end_time))
+            if self.segments is None or self.segments.get_end_time() == end_time:
+                return series, rows
+
+    def _check_metric(self, metric):
+        # Also protecting queries built with it
+        if metric not in self.metrics:
+            raise RuntimeError(f"Invalid metric: {metric}")
+
+    def _connect(self):
+        if self.readonly:
+            return sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        return connect_archive_db(self.db_path)
+
+
+def init_archive_db(db_path, metrics=None):
+    """Create archive database (or add its new metric columns), ex: to be opened read-only before the first write"""
+    with contextlib.closing(connect_archive_db(db_path)) as connection, connection:
+        create_table(connection, metrics or ARCHIVE_METRICS)
+
+
+def connect_archive_db(db_path):
+    connection = sqlite3.connect(db_path)
+    # Readers not blocking the writer, and fewer disk syncs (last transactions may be lost on power loss, without
+    # corruption)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+def create_table(connection, metrics):
+    """Create samples table (host, ts, metrics...), indexed by (host, ts) and by ts (pruning), or add its new
+    metric columns
+    """
+    columns = ", ".join(f"{metric} REAL" for metric in metrics)
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {ARCHIVE_TABLE} (host TEXT NOT NULL, ts REAL NOT NULL, {columns}, "
+                       f"PRIMARY KEY (host, ts)) WITHOUT ROWID")
+    connection.execute(f"CREATE INDEX IF NOT EXISTS {ARCHIVE_TABLE}_ts ON {ARCHIVE_TABLE} (ts)")
+    existing_columns = get_table_columns(connection)
+    for metric in metrics:
+        if metric not in existing_columns:
+            connection.execute(f"ALTER TABLE {ARCHIVE_TABLE} ADD COLUMN {metric} REAL")
+
+
+def get_table_columns(connection):
+    return [row[1] for row in connection.execute(f"PRAGMA table_info({ARCHIVE_TABLE})")]
+
+
+def merge_partial_aggregates(partial, other_partial):
+    if partial is None:
+        return list(other_partial)
+    return [min(partial[0], other_partial[0]), max(partial[1], other_partial[1]), partial[2] + other_partial[2],
+            partial[3] + other_partial[3]]
+
+
+def get_aggregate(partial, aggregate):
+    """Get aggregate from partial ones [min, max, sum, count], None if no value"""
+    if partial is None:
+        return 0 if aggregate == "count" else None
+    minimum, maximum, total, count = partial
+    return {"min": minimum, "max": maximum, "mean": total / count, "count": count}[aggregate]
+
+
+def compact_archive(db_path, segments_dir, older_than, codec=DEFAULT_CODEC, retention=DEFAULT_ARCHIVE_RETENTION,
+                    logger=None):
+    """Move days of archive database older than given duration (seconds) to compressed segment files, one per day,
+    and remove segments older than retention (if any). Return paths of written segments.
+
+    A day is written in its segment (merged with the existing one, if any: samples written late) before its samples
+    are removed from the database, in a single transaction. Readers only query the database after the last segment
+    (see MetricsArchive): they get each sample from either one. Only the samples written in the segment are removed,
+    the ones archived meanwhile being compacted next time.
+    Note: the samples of a day (all hosts) are held in memory while its segment is written.
+    """
+    os.makedirs(segments_dir, exist_ok=True)
+    init_archive_db(db_path)
+    written_paths = []
+    cutoff_time = (time.time() - older_than) // SEGMENT_DURATION * SEGMENT_DURATION
+    with contextlib.closing(connect_archive_db(db_path)) as connection:
+        metrics = get_table_columns(connection)[2:]
+        while True:
+            first_time = connection.execute(f"SELECT MIN(ts) FROM {ARCHIVE_TABLE}").fetchone()[0]
+            if first_time is None or first_time >= cutoff_time:
+                break
+            day_time = first_time // SEGMENT_DURATION * SEGMENT_DURATION
+            day_params = (day_time, day_time + SEGMENT_DURATION)
+            segment_path = os.path.join(segments_dir, get_segment_name(day_time))
+            host_rows = read_archived_rows(segment_path, metrics) if os.path.isfile(segment_path) else {}
+            hosts = [row[0] for row in connection.execute(
+                f"SELECT DISTINCT host FROM {ARCHIVE_TABLE} WHERE ts >= ? AND ts < ?", day_params)]
+            compacted_keys = []
+            for host in hosts:
+                # One query per host, through (host, ts) primary key
+                rows = connection.execute(
+                    f"SELECT ts, {', '.join(metrics)} FROM {ARCHIVE_TABLE} WHERE host = ? AND ts >= ? AND ts < ? "
+                    f"ORDER BY ts", (host, *day_params)).fetchall()
+                compacted_keys.extend((host, row[0]) for row in rows)
+                host_rows[host] = sorted({row[0]: row for row in host_rows.get(host, []) + rows}.values())
+            blocks_count = write_segment(segment_path, metrics, sorted(host_rows.items()), codec)
+            with connection:
+                connection.executemany(f"DELETE FROM {ARCHIVE_TABLE} WHERE host = ? AND ts = ?", compacted_keys)
+            written_paths.append(segment_path)
+            if logger is not None:
+                logger.info(f"{segment_path}: {len(host_rows)} hosts, {blocks_count} blocks "
+                            f"({os.path.getsize(segment_path) / 1024:.0f}K)")
+    # Retention
+    if retention:
+        oldest_name = get_segment_name(time.time() - retention)
+        for file_name in sorted(os.listdir(segments_dir)):
+            if file_name.endswith(SEGMENT_FILE_EXTENSION) and file_name < oldest_name:
+                os.remove(os.path.join(segments_dir, file_name))
+                if logger is not None:
+                    logger.info(f"{file_name} removed (older than retention)")
+    return written_paths
+
+
+def read_archived_rows(segment_path, metrics):
+    """Read rows of each host of a segment, with given metrics (None if not in segment)"""
+    segment_metrics, host_rows = read_segment_rows(segment_path)
+    if segment_metrics == metrics:
+        return host_rows
+    indices = [segment_metrics.index(metric) + 1 if metric in segment_metrics else None for metric in metrics]
+    return {host: [(row[0], *[None if i is None else row[i] for i in indices]) for row in rows]
+            for host, rows in host_rows.items()}
+
+
+def get_host_clause(host_patterns):
+    """Get SQL condition (and its parameters) on host matching any of given patterns (GLOB: same wildcards as
+    fnmatch, case-sensitive), all hosts if none
+    """
+    if not host_patterns:
+        return "1", ()
+    return f"({' OR '.join(['host GLOB ?'] * len(host_patterns))})", tuple(host_patterns)
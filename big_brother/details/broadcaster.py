@@ -0,0 +1,61 @@
+import queue
+import threading
+
+
+# Messages waiting to be sent to a client, before it is considered too slow and disconnected
+MAX_PENDING_MESSAGES = 8
+
+
+class Broadcaster:
+    """Fan-out of messages to subscribers (ex: Server-Sent Events connections), each one with its own bounded queue
+
+    A message is published once, and shared as is by all the subscribers. A subscriber not keeping up with published
+    messages is closed (None message) rather than slowing the others down.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING_MESSAGES):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self):
+        """Get a new subscriber queue, receiving all messages published from now on"""
+        subscriber = queue.Queue(self.max_pending)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def get_subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                # Too slow: drop its pending messages, and close it
+                self.unsubscribe(subscriber)
+                close_subscriber(subscriber)
+
+    def close(self):
+        """Close all subscribers"""
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, set()
+        for subscriber in subscribers:
+            close_subscriber(subscriber)
+
+
+def close_subscriber(subscriber):
+    while True:
+        try:
+            subscriber.get_nowait()
+        except queue.Empty:
+            break
+    subscriber.put_nowait(None)
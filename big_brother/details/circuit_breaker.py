@@ -0,0 +1,97 @@
+import time
+import socket
+import datetime
+import threading
+
+from big_brother.details.globals import DATETIME_FORMAT
+
+
+# Consecutive failures before skipping a host
+BREAKER_THRESHOLD = 2
+# Backoff of skipped hosts: 30s, 60s, 120s... up to 30min
+BREAKER_MIN_DELAY = 30
+BREAKER_MAX_DELAY = 1800
+# Cheap reachability check: TCP connection to the ssh port
+REACHABILITY_PORT = 22
+REACHABILITY_TIMEOUT = 2
+
+
+class HostCircuitBreaker:
+    """Per-host tracking of connection failures, so that unreachable hosts do not waste probe timeouts
+
+    A host failing BREAKER_THRESHOLD times in a row is skipped with an exponential backoff. Once the backoff is over,
+    it is probed again only if a cheap reachability check (TCP connection to its ssh port) succeeds.
+    Once monitor cycles are started, a host counts at most one failure per cycle (ex: host of an instance and of
+    storages).
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._cycle = None
+
+    def start_cycle(self):
+        with self._lock:
+            self._cycle = 0 if self._cycle is None else self._cycle + 1
+
+    def allow(self, ip, logger):
+        """Check whether a host should be probed"""
+        with self._lock:
+            host = self._get_host(ip)
+            if host["failures"] < self.threshold:
+                return True
+            if time.monotonic() < host["retry_time"]:
+                return False
+        # Backoff over, cheap check before running probes
+        if is_reachable(ip):
+            logger.info(f"{ip} reachable again")
+            return True
+        self.record_failure(ip, logger)
+        return False
+
+    def record_success(self, ip):
+        with self._lock:
+            host = self._get_host(ip)
+            host["failures"] = 0
+            host["failure_cycle"] = None
+            host["last_seen"] = datetime.datetime.now().strftime(DATETIME_FORMAT)
+
+    def record_failure(self, ip, logger):
+        with self._lock:
+            host = self._get_host(ip)
+            if self._cycle is not None and host["failure_cycle"] == self._cycle:
+                # Already failed on this cycle
+                return
+            host["failure_cycle"] = self._cycle
+            host["failures"] += 1
+            if host["failures"] >= self.threshold:
+                delay = min(BREAKER_MIN_DELAY * 2 ** (host["failures"] - self.threshold), BREAKER_MAX_DELAY)
+                host["retry_time"] = time.monotonic() + delay
+                logger.warning(f"{ip} unreachable ({host['failures']} failures), skipped for {delay}s")
+
+    def is_unreachable(self, ip):
+        """Check whether the last connection to a host failed"""
+        with self._lock:
+            return self._get_host(ip)["failures"] > 0
+
+    def get_last_seen(self, ip):
+        """Get date of the last successful connection to a host, or None"""
+        with self._lock:
+            return self._get_host(ip)["last_seen"]
+
+    def _get_host(self, ip):
+        return self._hosts.setdefault(ip, {
+            "failures": 0,
+            "retry_time": 0.,
+            "failure_cycle": None,
+            "last_seen": None,
+        })
+
+
+def is_reachable(ip, port=REACHABILITY_PORT, timeout=REACHABILITY_TIMEOUT):
+    try:
+        with socket.create_connection((ip, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
@@ -0,0 +1,59 @@
+import time
+import threading
+
+from big_brother.details.globals import InstanceProp
+
+
+# Time to live of slow-changing host facts (seconds)
+DEFAULT_FACT_TTLS = {
+    InstanceProp.CPU_COUNT: 3600,  # 1h
+    InstanceProp.USAGE_MEMO: 24 * 3600,  # 1 day, but refreshed as soon as the memo file is modified
+}
+
+
+class HostFactsCache:
+    """Cache of slow-changing host facts (CPU count, usage memo...), each one refreshed after its own time to live
+
+    All facts of a host are invalidated when it reboots (uptime going backwards) or when probing it is interrupted
+    (connection failure, timeout).
+    """
+
+    def __init__(self, ttls=None):
+        self.ttls = DEFAULT_FACT_TTLS if ttls is None else ttls
+        self._lock = threading.Lock()
+        self._facts = {}
+        self._uptimes = {}
+
+    def get(self, ip, key):
+        """Get cached fact of a host, or None if unknown or expired"""
+        with self._lock:
+            timestamp, value = self._facts.get(ip, {}).get(key, (None, None))
+        if timestamp is None or time.monotonic() - timestamp > self.ttls[key]:
+            return None
+        return value
+
+    def set(self, ip, key, value):
+        with self._lock:
+            self._facts.setdefault(ip, {})[key] = (time.monotonic(), value)
+
+    def set_missing(self, ip, values):
+        """Cache given facts of a host, unless already cached (so that their time to live is not extended)"""
+        for key, value in values.items():
+            if value is not None and self.get(ip, key) is None:
+                self.set(ip, key, value)
+
+    def invalidate(self, ip):
+        with self._lock:
+            self._facts.pop(ip, None)
+
+    def check_uptime(self, ip, uptime):
+        """Invalidate cached facts of a host whose uptime (seconds) went backwards (reboot), return True if so"""
+        if uptime is None:
+            return False
+        with self._lock:
+            previous_uptime = self._uptimes.get(ip)
+            self._uptimes[ip] = uptime
+        if previous_uptime is not None and uptime < previous_uptime:
+            self.invalidate(ip)
+            return True
+        return False
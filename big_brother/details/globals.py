@@ -6,11 +6,26 @@ DEFAULT_INSTANCES_JSON_PATH = os.path.join(PROJECT_DIR, "instances.json")
 DEFAULT_MONITORING_JSON_PATH = os.path.join(PROJECT_DIR, "live_data", "monitoring_results.json")
 DEFAULT_MONITOR_LOG_PATH = os.path.join(PROJECT_DIR, "live_data", "monitor.log")
 DEFAULT_MONITOR_PERIOD = 10  # 10s
+DEFAULT_MONITOR_WORKERS = 8
 
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 USAGE_MEMO_PATH = "/opt/bigbrother.memo"
 
+# Usage thresholds, shared by the server (colors) and the monitor (priority sampling)
+# -- Load average thresholds
+LOW_LOAD_PERCENT = 5
+MEDIUM_LOAD_PERCENT = 75
+HIGH_LOAD_PERCENT = 200
+# -- Memory usage thresholds
+LOW_MEM_PERCENT = 5
+MEDIUM_MEM_PERCENT = 75
+HIGH_MEM_PERCENT = 90
+# -- Disk space usage thresholds
+LOW_SPACE_PERCENT = 5
+MEDIUM_SPACE_PERCENT = 75
+HIGH_SPACE_PRECENT = 90
+
 
 class MainProp:
     """Enumeration-like definition of main properties in monitoring results"""
@@ -19,10 +34,25 @@ class MainProp:
     STORAGES = "storages"
 
 
+class SettingsProp:
+    """Enumeration-like definition of monitor settings in input JSON file"""
+    SETTINGS = "settings"
+    WORKERS = "workers"
+    BATCH_PROBE = "batch_probe"
+    ENGINE = "engine"
+    GROUP_INTERVALS = "group_intervals"
+    PRIORITY_INTERVAL = "priority_interval"
+    JITTER = "jitter"
+    DEADLINE = "deadline"
+    COMPACT_JSON = "compact_json"
+
+
 class MetaProp:
     """Enumeration-like definition of JSON metadata properties in monitoring results"""
     PROCESS_TIMESTAMP = "timestamp"
     PROCESS_TIMEDELTA = "timedelta"
+    PROBES = "probes"
+    VERSION = "version"
 
 
 class InstanceProp:
@@ -47,3 +77,16 @@ class InstanceProp:
     NET_RECEIVE_RATE = "net_receive_rate"
     UPTIME = "uptime"
     USAGE_MEMO = "usage_memo"
+    STATE = "state"
+    LAST_SEEN = "last_seen"
+    # Optional scheduling details of input JSON file
+    INTERVAL = "interval"
+    GROUP = "group"
+
+
+class InstanceState:
+    """Enumeration-like definition of instance/storage states in monitoring results"""
+    OK = "ok"  # Metrics retrieved on this cycle
+    ERROR = "error"  # Metrics retrieval failed
+    STALE = "stale"  # Hung or late, last known metrics
+    UNREACHABLE = "unreachable"  # Connection failed, or skipped after repeated connection failures
@@ -0,0 +1,391 @@
+import os
+import re
+import json
+import time
+import threading
+import warnings
+import urllib.parse
+
+import numpy as np
+
+from big_brother.details.globals import InstanceProp, DEFAULT_MONITOR_PERIOD
+from big_brother.details.utils import parse_duration
+
+
+# Numeric metrics kept in history (a missing value being NaN)
+HISTORY_METRICS = [
+    InstanceProp.LOAD_AVERAGE_1,
+    InstanceProp.LOAD_AVERAGE_5,
+    InstanceProp.LOAD_AVERAGE_15,
+    InstanceProp.MEMORY_USED,
+    InstanceProp.DISK_SPACE_USED,
+    InstanceProp.DISK_SPACE_AVAILABLE,
+    InstanceProp.NET_SEND_RATE,
+    InstanceProp.NET_RECEIVE_RATE,
+]
+# Samples kept per host: 1 day at the default 10s period
+DEFAULT_HISTORY_CAPACITY = 8640
+# Rollup tiers: (window duration, windows kept) in seconds, ex: 15 min windows over 30 days
+DEFAULT_ROLLUP_TIERS = [(60, 2880), (900, 2880), (3600, 2160)]  # 1m:2d,15m:30d,1h:90d
+# Statistics kept per rollup window and metric (mean being sum / count of known values), and the ones queried
+ROLLUP_FIELDS = ["min", "max", "sum", "count", "last"]
+ROLLUP_STATS = ["min", "max", "mean", "last"]
+# Aggregates of series (besides percentiles, ex: p95), and the rollup statistic they are computed from (percentiles
+# being computed from window means)
+AGGREGATE_STATS = {"min": "min", "max": "max", "mean": "mean", "last": "last"}
+# Points returned by a query, above which a coarser rollup tier is used
+DEFAULT_MAX_POINTS = 1000
+# Description of a history directory (metrics and capacity of its ring files)
+HISTORY_META_FILE = "history.json"
+# Type of values in ring files (float64: exact for integer metrics such as memory and disk space in KiB), and the
+# one of history directories created before it was given in their description
+VALUES_TYPE = "float64"
+LEGACY_VALUES_TYPE = "float32"
+RING_FILE_EXTENSION = ".ring"
+
+
+class HistoryRing:
+    """Fixed-size ring buffer of timed samples, each sample being a row of float values (ex: one per metric)
+
+    Backed by typed arrays, in memory or memory-mapped on a file (shared with readers of other processes).
+    Appending a sample is O(1): a row write, no allocation. Sample times being increasing, the last sample is the one
+    with the latest time (unwritten rows having a time of 0). Not thread-safe by itself: see lock.
+    """
+
+    def __init__(self, capacity, row_shape, path=None, readonly=False):
+        self.capacity = capacity
+        self.row_shape = tuple(row_shape)
+        self.path = path
+        dtype = np.dtype([("time", np.float64), ("values", VALUES_TYPE, self.row_shape)])
+        if path is None:
+            self._records = np.zeros(capacity, dtype=dtype)
+        elif os.path.isfile(path):
+            self._records = np.memmap(path, dtype=dtype, mode="r" if readonly else "r+", shape=(capacity,))
+        else:
+            if readonly:
+                raise RuntimeError(f"File not found: {path}")
+            self._records = np.memmap(path, dtype=dtype, mode="w+", shape=(capacity,))
+        self.times = self._records["time"]
+        self.values = self._records["values"]
+        self.head = 0  # Index of next row
+        self.count = 0
+        # Held by users of the ring across appends and reads (ex: MetricsHistory, for a host and its rollups)
+        self.lock = threading.Lock()
+        self.locate()
+
+    def locate(self):
+        """Locate last sample, scanning all the rows"""
+        self.count = int(np.count_nonzero(self.times > 0))
+        self.head = (int(np.argmax(self.times)) + 1) % self.capacity if self.count else 0
+
+    def refresh(self):
+        """Catch up with samples appended since (ex: ring file written by another process), checking new rows only"""
+        last_time = self.get_last_time() or 0.
+        for _ in range(self.capacity):
+            next_time = float(self.times[self.head])
+            if next_time <= last_time:
+                return
+            last_time = next_time
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+        # Whole ring rewritten since
+        self.locate()
+
+    def append(self, timestamp, row):
+        # Values first, so that concurrent readers never get a sample time without its values
+        self.values[self.head] = row
+        self.times[self.head] = timestamp
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def get_last_time(self):
+        return float(self.times[self.head - 1]) if self.count else None
+
+    def get_last_row(self):
+        """Get last sample values, as a view to update them in place"""
+        return self.values[self.head - 1]
+
+    def get_range(self, from_time=None, to_time=None):
+        """Get (times, values) of samples between given times (included), in time order"""
+        # Rows in time order: oldest ones from head once full, each part being searched separately (no reordering)
+        parts = [slice(0, self.count)] if self.count < self.capacity else \
+            [slice(self.head, self.capacity), slice(0, self.head)]
+        times, values = [], []
+        for part in parts:
+            part_times = self.times[part]
+            start = 0 if from_time is None else int(np.searchsorted(part_times, from_time, side="left"))
+            end = len(part_times) if to_time is None else int(np.searchsorted(part_times, to_time, side="right"))
+            times.append(part_times[start:end])
+            values.append(self.values[part][start:end])
+        return np.concatenate(times), np.concatenate(values)
+
+    def flush(self):
+        if isinstance(self._records, np.memmap):
+            self._records.flush()
+
+
+class RollupRing(HistoryRing):
+    """Ring buffer of statistics (ROLLUP_FIELDS) of samples over fixed time windows, updated as samples arrive
+
+    Each row holds the statistics of a window (its time being the window start) and the ongoing window is updated in
+    place, so that reading a time range never requires aggregating raw samples again. Statistics are float64 like
+    samples: sums of large values over long windows (ex: memory in KiB over 1 hour) stay exact.
+    """
+
+    def __init__(self, step, capacity, metrics_count, path=None, readonly=False):
+        super().__init__(capacity, [len(ROLLUP_FIELDS), metrics_count], path, readonly)
+        self.step = step
+
+    def add(self, timestamp, values):
+        """Account for a sample (times being increasing), given an array of values (NaN if unknown)"""
+        window_time = timestamp // self.step * self.step
+        known = ~np.isnan(values)
+        known_values = np.where(known, values, 0)
+        if self.get_last_time() == window_time:
+            stats = self.get_last_row()
+            np.fmin(stats[0], values, out=stats[0])
+            np.fmax(stats[1], values, out=stats[1])
+            stats[2] += known_values
+            stats[3] += known
+            stats[4] = np.where(known, values, stats[4])
+        else:
+            self.append(window_time, [values, values, known_values, known, values])
+
+    def get_stat_range(self, stat, metric_index, from_time=None, to_time=None):
+        """Get (window times, statistic values) of a metric for windows overlapping given times, in time order"""
+        if from_time is not None:
+            from_time = from_time // self.step * self.step
+        times, stats = self.get_range(from_time, to_time)
+        stats = stats[:, :, metric_index]
+        if stat == "mean":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return times, stats[:, 2] / stats[:, 3]
+        return times, stats[:, ROLLUP_FIELDS.index(stat)]
+
+
+class MetricsHistory:
+    """History of numeric metrics of monitored instances and storages: a ring buffer of samples per host (name),
+    with one value per metric, and rollup rings per tier (window duration) maintained incrementally from the samples
+
+    Kept in memory, or in memory-mapped ring files of a directory (one per host) surviving restarts and readable by
+    other processes (ex: server reading the history written by the monitor, with readonly=True).
+    """
+
+    def __init__(self, history_dir=None, capacity=None, metrics=None, rollups=None, readonly=False, period=None):
+        self.history_dir = history_dir
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        self._rings = {}
+        # Ring files layout (capacity, metrics, rollup tiers and type of values) fixed at history directory creation,
+        # unlike the sampling period of the monitor (seconds between two samples of a host)
+        meta = self._load_meta()
+        self.capacity = capacity or meta.get("capacity") or DEFAULT_HISTORY_CAPACITY
+        self.metrics = list(metrics or meta.get("metrics") or HISTORY_METRICS)
+        self.rollups = sorted([list(tier) for tier in rollups or meta.get("rollups") or DEFAULT_ROLLUP_TIERS])
+        self.period = period or meta.get("period") or DEFAULT_MONITOR_PERIOD
+        if any(meta[key] != value for key, value in self._get_meta().items() if key in meta and key != "period"):
+            raise RuntimeError(f"History directory {history_dir} created with other settings: {meta}")
+        if history_dir is not None and meta != self._get_meta() and not readonly:
+            os.makedirs(history_dir, exist_ok=True)
+            with open(os.path.join(history_dir, HISTORY_META_FILE), "w") as f_out:
+                json.dump(self._get_meta(), f_out)
+
+    def _load_meta(self):
+        if self.history_dir is None:
+            return {}
+        meta_path = os.path.join(self.history_dir, HISTORY_META_FILE)
+        if not os.path.isfile(meta_path):
+            if self.readonly:
+                raise RuntimeError(f"File not found: {meta_path}")
+            return {}
+        with open(meta_path) as f_in:
+            meta = json.load(f_in)
+        meta.setdefault("values_type", LEGACY_VALUES_TYPE)
+        return meta
+
+    def _get_meta(self):
+        return {"capacity": self.capacity, "metrics": self.metrics, "rollups": self.rollups, "values_type": VALUES_TYPE,
+                "period": self.period}
+
+    def get_steps(self):
+        """Get window durations of rollup tiers, finest first"""
+        return [step for step, _ in self.rollups]
+
+    def append(self, host, timestamp, values):
+        """Append a sample of a host: given time (seconds since epoch), and a value per metric (None if unknown)"""
+        ring, rollup_rings = self._get_rings(host, create=True)
+        values = np.array([np.nan if value is None else value for value in values], dtype=VALUES_TYPE)
+        # Sample ring lock guarding the rollup rings of the host as well
+        with ring.lock:
+            last_time = ring.get_last_time()
+            if last_time is not None and timestamp <= last_time:
+                # Same sample again (ex: carried over result)
+                return
+            for rollup_ring in rollup_rings.values():
+                rollup_ring.add(timestamp, values)
+            ring.append(timestamp, values)
+
+    def append_result(self, timestamp, result):
+        """Append metrics of an instance or storage result"""
+        self.append(result[InstanceProp.NAME], timestamp, [result.get(metric) for metric in self.metrics])
+
+    def get_hosts(self):
+        if self.history_dir is not None:
+            # Including hosts added by another process
+            for file_name in os.listdir(self.history_dir):
+                if file_name.endswith(RING_FILE_EXTENSION):
+                    self._get_rings(urllib.parse.unquote(file_name[:-len(RING_FILE_EXTENSION)]))
+        with self._lock:
+            return sorted(self._rings.keys())
+
+    def get_series(self, host, metric, from_time=None, to_time=None, step=None, stat=None):
+        """Get (times, values) of a metric of a host between given times, in time order (empty if unknown host)
+
+        Raw samples by default, else statistic (ROLLUP_STATS, default: mean) of the windows of given rollup step
+        overlapping given times, window times being their start.
+        """
+        if metric not in self.metrics:
+            raise RuntimeError(f"Invalid metric: {metric}")
+        if step is not None and step not in self.get_steps():
+            raise RuntimeError(f"Invalid step: {step} (rollup steps: {self.get_steps()})")
+        if stat is not None and (step is None or stat not in ROLLUP_STATS):
+            raise RuntimeError(f"Invalid statistic: {stat}")
+        rings = self._get_rings(host)
+        ring = None if rings is None else rings[0] if step is None else rings[1].get(step)
+        if ring is None:
+            return np.empty(0), np.empty(0, dtype=VALUES_TYPE)
+        # Copies of the rows, read while no sample is being appended (see append)
+        with rings[0].lock:
+            if self.readonly:
+                ring.refresh()
+            if step is not None:
+                return ring.get_stat_range(stat or "mean", self.metrics.index(metric), from_time, to_time)
+            times, values = ring.get_range(from_time, to_time)
+        return times, values[:, self.metrics.index(metric)]
+
+    def select_step(self, from_time=None, to_time=None, max_points=DEFAULT_MAX_POINTS):
+        """Select the finest series (raw samples: None, else rollup step) covering given times with at most max_points
+        points, else the coarsest one (raw samples being nominally taken every monitor period)
+        """
+        now = time.time()
+        to_time = now if to_time is None else to_time
+        sources = [(None, self.period, self.capacity)] + [(step, step, size) for step, size in self.rollups]
+        if from_time is not None:
+            for step, period, size in sources:
+                if from_time >= now - period * size and (to_time - from_time) / period <= max_points:
+                    return step
+        return sources[-1][0]
+
+    def flush(self):
+        with self._lock:
+            rings = [ring for ring, rollup_rings in self._rings.values()
+                     for ring in [ring] + list(rollup_rings.values())]
+        for ring in rings:
+            ring.flush()
+
+    def _get_rings(self, host, create=False):
+        """Get (sample ring, {step: rollup ring}) of a host, None if unknown"""
+        with self._lock:
+            rings = self._rings.get(host)
+            if rings is None:
+                file_name = urllib.parse.quote(host, safe="") + RING_FILE_EXTENSION
+                path = None
+                if self.history_dir is not None:
+                    path = os.path.join(self.history_dir, file_name)
+                    if not os.path.isfile(path) and not create:
+                        return None
+                elif not create:
+                    return None
+                # Rollup rings first, so that readers finding the sample ring find them as well
+                rollup_rings = {}
+                for step, size in self.rollups:
+                    rollup_path = None
+                    if self.history_dir is not None:
+                        rollup_path = os.path.join(self.history_dir, f"{step}s", file_name)
+                        if self.readonly and not os.path.isfile(rollup_path):
+                            continue
+                        os.makedirs(os.path.dirname(rollup_path), exist_ok=True)
+                    rollup_rings[step] = RollupRing(step, size, len(self.metrics), rollup_path, self.readonly)
+                rings = HistoryRing(self.capacity, [len(self.metrics)], path, self.readonly), rollup_rings
+                self._rings[host] = rings
+            return rings
+
+
+def parse_rollup_tiers(text):
+    """Parse rollup tiers given as comma-separated window:retention durations (ex: "1m:2d,1h:90d") into
+    [(window duration, windows kept), ...] in seconds
+    """
+    tiers = []
+    for tier in text.split(","):
+        step, _, retention = tier.partition(":")
+        step, retention = parse_duration(step), parse_duration(retention)
+        if retention < step:
+            raise RuntimeError(f"Invalid rollup tier: {tier} (retention shorter than window)")
+        tiers.append((step, retention // step))
+    return tiers
+
+
+def get_aggregate_stat(aggregate):
+    """Get rollup statistic an aggregate (ex: max, p95) is computed from"""
+    if aggregate in AGGREGATE_STATS:
+        return AGGREGATE_STATS[aggregate]
+    match = re.fullmatch(r"p(\d+(\.\d+)?)", aggregate)
+    if match is None or float(match.group(1)) > 100:
+        raise RuntimeError(f"Invalid aggregate: {aggregate} ({', '.join(AGGREGATE_STATS)}, or percentile ex: p95)")
+    return "mean"
+
+
+def aggregate_series(series, aggregate):
+    """Aggregate values of each (times, values) series, NaN being ignored, and values of all the series together
+
+    Series are gathered in a single NaN-padded matrix, so that each aggregate is computed once for all of them.
+    Return (array of aggregates per series, aggregate of all the series), NaN if no value.
+    """
+    get_aggregate_stat(aggregate)
+    length = max([len(times) for times, _ in series], default=0)
+    times = np.full((len(series), length), -np.inf)
+    values = np.full((len(series), length), np.nan)
+    for i, (series_times, series_values) in enumerate(series):
+        times[i, :len(series_times)] = series_times
+        values[i, :len(series_values)] = series_values
+    if not np.any(~np.isnan(values)):
+        return np.full(len(series), np.nan), np.nan
+    with warnings.catch_warnings():
+        # All-NaN series
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if aggregate == "min":
+            return np.nanmin(values, axis=1), np.nanmin(values)
+        if aggregate == "max":
+            return np.nanmax(values, axis=1), np.nanmax(values)
+        if aggregate == "mean":
+            return np.nanmean(values, axis=1), np.nanmean(values)
+        if aggregate == "last":
+            # Last known value of each series, and the latest one of all
+            times[np.isnan(values)] = -np.inf
+            last_indices = np.argmax(times, axis=1)
+            last_values = values[np.arange(len(series)), last_indices]
+            return last_values, values.flat[np.argmax(times)]
+        percentile = float(aggregate[1:])
+        return get_percentiles(values, percentile), np.nanpercentile(values, percentile)
+
+
+def get_percentiles(values, percentile):
+    """Get percentile of each row of a matrix, NaN being ignored (same as np.nanpercentile(values, percentile, axis=1),
+    with a single sort of the matrix rather than a computation per row)
+    """
+    # NaN sorted last
+    sorted_values = np.sort(values, axis=1)
+    counts = np.count_nonzero(~np.isnan(values), axis=1)
+    # Linear interpolation between closest ranks
+    positions = np.maximum(counts - 1, 0) * percentile / 100
+    lower_indices = np.floor(positions).astype(int)
+    upper_indices = np.ceil(positions).astype(int)
+    rows = np.arange(len(values))
+    lower_values = sorted_values[rows, lower_indices]
+    upper_values = sorted_values[rows, upper_indices]
+    return lower_values + (upper_values - lower_values) * (positions - lower_indices)
+
+
+def get_json_values(values):
+    """Get values as a list of JSON numbers, NaN being null (rounded, ex: mean 0.3 rather than 0.30000000000000004)"""
+    return [None if value != value else value for value in np.round(np.asarray(values, dtype=np.float64), 6).tolist()]
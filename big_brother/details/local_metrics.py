@@ -0,0 +1,182 @@
+import os
+import re
+
+from big_brother.details.globals import InstanceProp, USAGE_MEMO_PATH
+from big_brother.details.net_counters import get_net_rates
+
+
+def get_local_instance_metrics(home_disk_path, net_interface, logger):
+    """Get metrics of the instance running the monitor, directly from /proc and statvfs (no subprocess)
+
+    Same metrics as the remote probes (nproc, top, free, df, network counters, uptime and usage memo commands)
+    """
+    result = {}
+    result.update(get_local_cpu_metrics(logger))
+    result.update(get_local_load_metrics(logger))
+    result.update(get_local_memory_metrics(logger))
+    result.update(get_local_disk_metrics(home_disk_path, logger))
+    result.update(get_local_net_metrics(net_interface, logger))
+    result.update(get_local_uptime_metrics(logger))
+    result.update(get_local_usage_memo(logger))
+    return result
+
+
+def get_local_cpu_metrics(logger):
+    # Same as nproc: CPUs available to the current process
+    result = {InstanceProp.CPU_COUNT: None}
+    try:
+        result.update({InstanceProp.CPU_COUNT: len(os.sched_getaffinity(0))})
+    except OSError as e:
+        logger.error(f"Error getting local CPU count: {e}")
+    return result
+
+
+def get_local_load_metrics(logger):
+    """Get load averages from /proc/loadavg
+
+    Raw file content example:
+    12.09 12.26 15.26 11/809 1192691
+    """
+    result = {
+        InstanceProp.LOAD_AVERAGE_1: None,
+        InstanceProp.LOAD_AVERAGE_5: None,
+        InstanceProp.LOAD_AVERAGE_15: None,
+    }
+    try:
+        with open("/proc/loadavg") as f_in:
+            values = [float(value) for value in f_in.read().split()[:3]]
+        result.update({
+            InstanceProp.LOAD_AVERAGE_1: values[0],
+            InstanceProp.LOAD_AVERAGE_5: values[1],
+            InstanceProp.LOAD_AVERAGE_15: values[2],
+        })
+    except (OSError, ValueError, IndexError) as e:
+        logger.error(f"Error reading /proc/loadavg: {e}")
+    return result
+
+
+def get_local_memory_metrics(logger):
+    """Get memory usage (RAM) metrics from /proc/meminfo, in KiB
+
+    Raw file content example:
+    MemTotal:       528221324 kB
+    MemFree:        308751440 kB
+    MemAvailable:   521607216 kB
+    ...
+    """
+    result = {
+        InstanceProp.MEMORY_TOTAL: None,
+        InstanceProp.MEMORY_USED: None,
+    }
+    try:
+        meminfo = {}
+        with open("/proc/meminfo") as f_in:
+            for line in f_in:
+                key, value = line.split(":", 1)
+                meminfo[key] = int(value.split()[0])
+        # Used memory: total - available (memory not reclaimable without swapping). Note: the "used" column of free
+        # may differ (total - free - buffers - cache with procps < 4), hence a tolerance when comparing them
+        result.update({
+            InstanceProp.MEMORY_TOTAL: meminfo["MemTotal"],
+            InstanceProp.MEMORY_USED: meminfo["MemTotal"] - meminfo["MemAvailable"],
+        })
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Error reading /proc/meminfo: {e}")
+    return result
+
+
+def get_local_disk_metrics(disk_path, logger):
+    # Same as df command, in KiB
+    result = {
+        InstanceProp.DISK_FILE_SYSTEM: None,
+        InstanceProp.DISK_SPACE_TOTAL: None,
+        InstanceProp.DISK_SPACE_USED: None,
+        InstanceProp.DISK_SPACE_AVAILABLE: None,
+    }
+    try:
+        stats = os.statvfs(disk_path)
+        result.update({
+            InstanceProp.DISK_FILE_SYSTEM: get_local_file_system(disk_path),
+            InstanceProp.DISK_SPACE_TOTAL: stats.f_blocks * stats.f_frsize // 1024,
+            InstanceProp.DISK_SPACE_USED: (stats.f_blocks - stats.f_bfree) * stats.f_frsize // 1024,
+            InstanceProp.DISK_SPACE_AVAILABLE: stats.f_bavail * stats.f_frsize // 1024,
+        })
+    except OSError as e:
+        logger.error(f"Error getting disk space of '{disk_path}': {e}")
+    return result
+
+
+def get_local_file_system(disk_path):
+    """Get file system mounted on given path (ex: /dev/sdc2), from /proc/self/mounts
+
+    Raw file content example:
+    /dev/sdc2 / ext4 rw,relatime,errors=remount-ro 0 0
+    //192.168.10.206/datacenter /mnt/datacenter cifs rw,relatime,vers=3.0 0 0
+    """
+    real_path = os.path.realpath(disk_path)
+    file_system, mount_point = None, ""
+    with open("/proc/self/mounts") as f_in:
+        for line in f_in:
+            items = line.split()
+            # Octal escapes in mount points (ex: "\040" for spaces)
+            items_mount_point = re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), items[1])
+            if is_sub_path(real_path, items_mount_point) and len(items_mount_point) >= len(mount_point):
+                # Deepest mount point containing the path (last one if stacked)
+                file_system, mount_point = items[0], items_mount_point
+    return file_system
+
+
+def is_sub_path(path, parent_path):
+    return path == parent_path or path.startswith(parent_path.rstrip("/") + "/")
+
+
+def get_local_net_metrics(net_interface, logger):
+    """Get network rates in bits/s, from /proc/net/dev byte counters variation since previous call
+
+    Raw file content example:
+    Inter-|   Receive                                                |  Transmit
+     face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier ...
+        lo: 8908367    1145    0    0    0     0          0         0  8908367    1145    0    0    0     0       0 ...
+      ens4: 91827364  12345    0    0    0     0          0         0  1234567    2345    0    0    0     0       0 ...
+    """
+    result = {
+        InstanceProp.NET_SEND_RATE: None,
+        InstanceProp.NET_RECEIVE_RATE: None,
+    }
+    try:
+        with open("/proc/net/dev") as f_in:
+            for line in f_in.readlines()[2:]:
+                name, values = line.split(":", 1)
+                if name.strip() == net_interface:
+                    values = values.split()
+                    return get_net_rates("localhost", net_interface, int(values[8]), int(values[0]))
+        logger.error(f"Network interface '{net_interface}' not found in /proc/net/dev")
+    except (OSError, ValueError, IndexError) as e:
+        logger.error(f"Error reading /proc/net/dev: {e}")
+    return result
+
+
+def get_local_uptime_metrics(logger):
+    """Get uptime in days from /proc/uptime
+
+    Raw file content example:
+    1598632.42 12345678.90
+    """
+    result = {InstanceProp.UPTIME: None}
+    try:
+        with open("/proc/uptime") as f_in:
+            uptime_seconds = float(f_in.read().split()[0])
+        result.update({InstanceProp.UPTIME: int(uptime_seconds // (24 * 3600))})
+    except (OSError, ValueError, IndexError) as e:
+        logger.error(f"Error reading /proc/uptime: {e}")
+    return result
+
+
+def get_local_usage_memo(logger):
+    result = {InstanceProp.USAGE_MEMO: None}
+    try:
+        with open(USAGE_MEMO_PATH, errors="replace") as f_in:
+            result.update({InstanceProp.USAGE_MEMO: f_in.read().strip()})
+    except OSError as e:
+        logger.error(f"Error reading {USAGE_MEMO_PATH}: {e}")
+    return result
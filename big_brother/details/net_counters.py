@@ -0,0 +1,37 @@
+import time
+import threading
+
+from big_brother.details.globals import InstanceProp
+
+
+# Previous byte counters of each (ip, net_interface), to compute rates from one cycle to the other
+_NET_COUNTERS_LOCK = threading.Lock()
+_PREVIOUS_NET_COUNTERS = {}
+
+
+def get_net_rates(ip, net_interface, sent_bytes, received_bytes, timestamp=None):
+    """Get network rates in bits/s, from byte counters variation since previous call for the same interface
+
+    Rates are None on first call, or when counters were reset (ex: reboot)
+    """
+    if timestamp is None:
+        timestamp = time.monotonic()
+    counters = (timestamp, sent_bytes, received_bytes)
+    with _NET_COUNTERS_LOCK:
+        previous_counters = _PREVIOUS_NET_COUNTERS.get((ip, net_interface))
+        _PREVIOUS_NET_COUNTERS[(ip, net_interface)] = counters
+    result = {
+        InstanceProp.NET_SEND_RATE: None,
+        InstanceProp.NET_RECEIVE_RATE: None,
+    }
+    if previous_counters is not None:
+        elapsed_time = counters[0] - previous_counters[0]
+        sent_bytes_delta = counters[1] - previous_counters[1]
+        received_bytes_delta = counters[2] - previous_counters[2]
+        if elapsed_time > 0 and sent_bytes_delta >= 0 and received_bytes_delta >= 0:
+            result.update({
+                InstanceProp.NET_SEND_RATE: round(8 * sent_bytes_delta / elapsed_time),
+                InstanceProp.NET_RECEIVE_RATE: round(8 * received_bytes_delta / elapsed_time),
+            })
+    return result
+
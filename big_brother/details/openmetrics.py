@@ -0,0 +1,152 @@
+import datetime
+
+from big_brother.details.globals import MainProp, MetaProp, InstanceProp, InstanceState, DATETIME_FORMAT
+from big_brother.details.probe_stats import PROBE_STATUSES
+
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+METRIC_PREFIX = "bigbrother"
+
+# Exposed metrics of instances and storages: (metric name, type, unit, help, property, factor)
+# -- Sizes are given in KiB in monitoring results, exposed in bytes
+INSTANCE_METRICS = [
+    ("instance_cpus", "gauge", "", "Number of CPU(s)", InstanceProp.CPU_COUNT, 1),
+    ("instance_load_average_1m", "gauge", "", "Load average over 1min", InstanceProp.LOAD_AVERAGE_1, 1),
+    ("instance_load_average_5m", "gauge", "", "Load average over 5min", InstanceProp.LOAD_AVERAGE_5, 1),
+    ("instance_load_average_15m", "gauge", "", "Load average over 15min", InstanceProp.LOAD_AVERAGE_15, 1),
+    ("instance_memory_total_bytes", "gauge", "bytes", "Total memory", InstanceProp.MEMORY_TOTAL, 1024),
+    ("instance_memory_used_bytes", "gauge", "bytes", "Used memory", InstanceProp.MEMORY_USED, 1024),
+    ("instance_disk_space_total_bytes", "gauge", "bytes", "Total home disk space",
+     InstanceProp.DISK_SPACE_TOTAL, 1024),
+    ("instance_disk_space_used_bytes", "gauge", "bytes", "Used home disk space", InstanceProp.DISK_SPACE_USED, 1024),
+    ("instance_disk_space_available_bytes", "gauge", "bytes", "Available home disk space",
+     InstanceProp.DISK_SPACE_AVAILABLE, 1024),
+    ("instance_network_send_rate_bits", "gauge", "bits", "Network send rate (bits/s)", InstanceProp.NET_SEND_RATE, 1),
+    ("instance_network_receive_rate_bits", "gauge", "bits", "Network receive rate (bits/s)",
+     InstanceProp.NET_RECEIVE_RATE, 1),
+    ("instance_uptime_days", "gauge", "days", "Uptime", InstanceProp.UPTIME, 1),
+]
+STORAGE_METRICS = [
+    ("storage_space_total_bytes", "gauge", "bytes", "Total storage space", InstanceProp.DISK_SPACE_TOTAL, 1024),
+    ("storage_space_used_bytes", "gauge", "bytes", "Used storage space", InstanceProp.DISK_SPACE_USED, 1024),
+    ("storage_space_available_bytes", "gauge", "bytes", "Available storage space",
+     InstanceProp.DISK_SPACE_AVAILABLE, 1024),
+]
+STATES = [InstanceState.OK, InstanceState.ERROR, InstanceState.STALE, InstanceState.UNREACHABLE]
+# Labels of instances and storages: (label name, property)
+# -- Storages also labelled by path, several storages of a host (ex: mounts) sharing name, ip and type otherwise
+INSTANCE_LABELS = [("name", InstanceProp.NAME), ("ip", InstanceProp.IP), ("type", InstanceProp.TYPE)]
+STORAGE_LABELS = INSTANCE_LABELS + [("path", InstanceProp.DISK_PATH)]
+
+
+def create_openmetrics_text(data):
+    """Create OpenMetrics text exposition of monitoring results: instance and storage metrics labelled by name, ip and
+    type (and path for storages), and monitor cycle timings
+
+    Example:
+    # TYPE bigbrother_instance_cpus gauge
+    # HELP bigbrother_instance_cpus Number of CPU(s)
+    bigbrother_instance_cpus{name="apollo-1",ip="192.168.10.101",type=""} 80
+    ...
+    # EOF
+    """
+    lines = []
+    for kind, metrics, label_props in [(MainProp.INSTANCES, INSTANCE_METRICS, INSTANCE_LABELS),
+                                       (MainProp.STORAGES, STORAGE_METRICS, STORAGE_LABELS)]:
+        targets = data.get(kind) or []
+        labels = [get_target_labels(target, label_props) for target in targets]
+        for name, metric_type, unit, help_text, prop, factor in metrics:
+            add_metric_family(lines, name, metric_type, unit, help_text)
+            for target, target_labels in zip(targets, labels):
+                value = target.get(prop)
+                if value is not None:
+                    lines.append(f"{METRIC_PREFIX}_{name}{{{target_labels}}} {format_value(value * factor)}")
+        # -- Monitoring state, as a set of 0/1 values (no state in results of older monitors)
+        name = f"{kind[:-1]}_state"
+        add_metric_family(lines, name, "stateset", "", "Monitoring state")
+        for target, target_labels in zip(targets, labels):
+            target_state = target.get(InstanceProp.STATE)
+            if target_state is None:
+                continue
+            for state in STATES:
+                lines.append(f'{METRIC_PREFIX}_{name}{{{target_labels},{METRIC_PREFIX}_{name}="{state}"}} '
+                             f'{int(state == target_state)}')
+    add_monitor_metrics(lines, data.get(MainProp.METADATA) or {})
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def add_monitor_metrics(lines, metadata):
+    # Cycle end time and duration
+    timestamp = metadata.get(MetaProp.PROCESS_TIMESTAMP)
+    if timestamp is not None:
+        add_metric_family(lines, "monitor_cycle_timestamp_seconds", "gauge", "seconds",
+                          "End time of last monitor cycle")
+        epoch = datetime.datetime.strptime(timestamp, DATETIME_FORMAT).timestamp()
+        lines.append(f"{METRIC_PREFIX}_monitor_cycle_timestamp_seconds {format_value(epoch)}")
+    timedelta = metadata.get(MetaProp.PROCESS_TIMEDELTA)
+    if timedelta is not None:
+        add_metric_family(lines, "monitor_cycle_duration_seconds", "gauge", "seconds",
+                          "Duration of last monitor cycle")
+        lines.append(f"{METRIC_PREFIX}_monitor_cycle_duration_seconds {format_value(parse_timedelta(timedelta))}")
+    # Probe durations of last cycle, per probe name, as gauges: summarizing a single cycle, they are no counters
+    probes = metadata.get(MetaProp.PROBES)
+    if not probes:
+        return
+    name = "monitor_probe_duration_seconds"
+    add_metric_family(lines, name, "gauge", "seconds", "Total duration of probes (spawn, run and parse) of last cycle")
+    for probe, stats in probes["by_probe"].items():
+        total_time = stats["spawn_time"] + stats["run_time"] + stats["parse_time"]
+        lines.append(f'{METRIC_PREFIX}_{name}{{probe="{escape_label_value(probe)}"}} '
+                     f'{format_value(round(total_time, 4))}')
+    name = "monitor_probe_max_duration_seconds"
+    add_metric_family(lines, name, "gauge", "seconds", "Longest duration of probes of last cycle")
+    for probe, stats in probes["by_probe"].items():
+        lines.append(f'{METRIC_PREFIX}_{name}{{probe="{escape_label_value(probe)}"}} {format_value(stats["max_time"])}')
+    name = "monitor_probes_by_duration"
+    add_metric_family(lines, name, "gauge", "", "Number of probes of last cycle lasting at most max_seconds")
+    upper_bounds = [format_value(float(upper_bound)) for upper_bound in probes["buckets"]] + ["+Inf"]
+    for probe, stats in probes["by_probe"].items():
+        cumulated_count = 0
+        for upper_bound, count in zip(upper_bounds, stats["histogram"]):
+            cumulated_count += count
+            lines.append(f'{METRIC_PREFIX}_{name}{{probe="{escape_label_value(probe)}",max_seconds="{upper_bound}"}} '
+                         f'{cumulated_count}')
+    name = "monitor_probes"
+    add_metric_family(lines, name, "gauge", "", "Number of probes of last cycle, per outcome")
+    for probe, stats in probes["by_probe"].items():
+        for status in PROBE_STATUSES:
+            lines.append(f'{METRIC_PREFIX}_{name}{{probe="{escape_label_value(probe)}",status="{status}"}} '
+                         f'{stats.get(status, 0)}')
+
+
+def add_metric_family(lines, name, metric_type, unit, help_text):
+    lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+    if unit:
+        lines.append(f"# UNIT {METRIC_PREFIX}_{name} {unit}")
+    lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+
+
+def get_target_labels(target, label_props):
+    return ",".join(f'{label}="{escape_label_value(target.get(prop))}"' for label, prop in label_props)
+
+
+def escape_label_value(value):
+    if value is None:
+        return ""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    # Integers as is, floats with their shortest exact representation (ex: 0.1, 1.0)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def parse_timedelta(value):
+    """Convert a timedelta string (ex: '0:02:15', '1 day, 0:02:15') into seconds"""
+    days = 0
+    if "day" in value:
+        days_str, value = value.split(",")
+        days = int(days_str.split()[0])
+    hours, minutes, seconds = value.strip().split(":")
+    return days * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
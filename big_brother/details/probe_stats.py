@@ -0,0 +1,92 @@
+import threading
+
+
+# Upper bounds of probe duration histogram buckets (seconds), plus a last unbounded bucket
+PROBE_DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# Number of slowest probes reported
+SLOWEST_PROBES_COUNT = 10
+# Probe outcomes
+PROBE_STATUSES = ["ok", "error", "timeout", "unreachable"]
+
+
+class ProbeStats:
+    """Timings (spawn, run, parse) and outcome of each probe of a monitoring cycle, tagged by host and probe name
+
+    Probes of the cycle ending after it (late ones, background re-probes) are not recorded: they are left out of the
+    summary of their cycle, and of the summary of any other one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = []
+        self._closed = False
+
+    def record(self, host, probe, status, spawn_time=0., run_time=0., parse_time=0.):
+        with self._lock:
+            if self._closed:
+                return
+            self._records.append((host, probe, status, spawn_time, run_time, parse_time))
+
+    def close(self):
+        """End the cycle: get summary of its probes (see get_probes_summary), later ones being dropped"""
+        with self._lock:
+            self._closed = True
+            records = self._records
+        return get_probes_summary(records)
+
+
+def get_probes_summary(records):
+    """Aggregate probe records per probe name and per host: counts per outcome, time sums, duration histogram
+
+    Example:
+    {
+       "buckets": [0.01, 0.05, ...],
+       "by_probe": {"load": {"count": 30, "ok": 29, "error": 0, "timeout": 1, "unreachable": 0, "spawn_time": 0.09,
+                             "run_time": 12.3, "parse_time": 0.001, "max_time": 10.01, "histogram": [0, 2, ...]}, ...},
+       "by_host": {"192.168.10.101": {...}, ...},
+       "slowest": [{"host": "192.168.10.101", "probe": "load", "time": 10.01}, ...],
+    }
+    """
+    by_probe = {}
+    by_host = {}
+    for host, probe, status, spawn_time, run_time, parse_time in records:
+        for stats in [by_probe.setdefault(probe, create_stats()), by_host.setdefault(host, create_stats())]:
+            total_time = spawn_time + run_time + parse_time
+            stats["count"] += 1
+            stats[status] += 1
+            stats["spawn_time"] += spawn_time
+            stats["run_time"] += run_time
+            stats["parse_time"] += parse_time
+            stats["max_time"] = max(stats["max_time"], total_time)
+            stats["histogram"][get_bucket_index(total_time)] += 1
+    slowest = sorted(records, key=lambda record: sum(record[3:]), reverse=True)[:SLOWEST_PROBES_COUNT]
+    return {
+        "buckets": PROBE_DURATION_BUCKETS,
+        "by_probe": {probe: round_stats(stats) for probe, stats in sorted(by_probe.items())},
+        "by_host": {host: round_stats(stats) for host, stats in sorted(by_host.items())},
+        "slowest": [{"host": record[0], "probe": record[1], "time": round(sum(record[3:]), 4)} for record in slowest],
+    }
+
+
+def create_stats():
+    return {
+        "count": 0,
+        **{status: 0 for status in PROBE_STATUSES},
+        "spawn_time": 0.,
+        "run_time": 0.,
+        "parse_time": 0.,
+        "max_time": 0.,
+        "histogram": [0] * (len(PROBE_DURATION_BUCKETS) + 1),
+    }
+
+
+def round_stats(stats):
+    # Times rounded to 0.1ms
+    return {key: round(value, 4) if isinstance(value, float) else value for key, value in stats.items()}
+
+
+def get_bucket_index(duration):
+    for i, upper_bound in enumerate(PROBE_DURATION_BUCKETS):
+        if duration <= upper_bound:
+            return i
+    return len(PROBE_DURATION_BUCKETS)
@@ -0,0 +1,82 @@
+import time
+
+from big_brother.details.globals import InstanceProp, MEDIUM_LOAD_PERCENT, MEDIUM_MEM_PERCENT, MEDIUM_SPACE_PERCENT
+
+
+# Shortest tick (seconds), whatever the target intervals
+MIN_TICK = 1
+# A target is due a bit before its exact time, so that tick rounding does not delay it by a whole tick
+DUE_TOLERANCE = 0.05  # Fraction of tick
+
+
+class MonitorScheduler:
+    """Fixed-rate scheduler of monitored targets (instances and storages), each one with its own interval
+
+    Times are measured against a monotonic clock: a target due every N seconds is sampled every N seconds, whatever
+    the cycle durations (no drift). Missed ticks or samples are skipped rather than caught up.
+    The scheduler also keeps the last result of each target, carried over in snapshots while it is not due or late.
+    """
+
+    def __init__(self, default_interval):
+        if default_interval <= 0:
+            raise RuntimeError(f"Invalid interval: {default_interval}")
+        self.default_interval = default_interval
+        self.tick = default_interval
+        self._next_times = {}
+        self._results = {}
+        self._pending = {}
+
+    def set_tick(self, tick):
+        self.tick = max(tick, MIN_TICK)
+
+    def get_next_tick_time(self, tick_time, now=None):
+        """Get time of the tick following given one (fixed rate), skipping missed ticks"""
+        now = time.monotonic() if now is None else now
+        next_tick_time = tick_time + self.tick
+        if next_tick_time < now:
+            # Late (cycle longer than tick)
+            next_tick_time += self.tick * ((now - next_tick_time) // self.tick + 1)
+        return next_tick_time
+
+    def is_due(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        if key in self._pending:
+            # Still running from a previous cycle
+            return False
+        next_time = self._next_times.get(key)
+        return next_time is None or now >= next_time - DUE_TOLERANCE * self.tick
+
+    def set_result(self, key, result, interval, sample_time):
+        """Keep result of a target sampled at given time, to be sampled again after interval"""
+        self._results[key] = result
+        next_time = self._next_times.get(key)
+        if next_time is None or sample_time - next_time > interval:
+            # First sample, or samples missed: restart schedule from this sample
+            next_time = sample_time
+        self._next_times[key] = next_time + interval
+
+    def get_result(self, key):
+        return self._results.get(key)
+
+    def set_pending(self, key, pending):
+        """Keep a late sampling (ex: Future) of a target, so that it is not sampled again until it is over"""
+        self._pending[key] = pending
+
+    def pop_pending(self, key):
+        return self._pending.pop(key, None)
+
+
+def is_alerting(result):
+    """Check whether an instance or storage result is in a warning or critical state (load, memory, disk space)"""
+    for used, total, threshold_percent in [
+        (result.get(InstanceProp.LOAD_AVERAGE_1), result.get(InstanceProp.CPU_COUNT), MEDIUM_LOAD_PERCENT),
+        (result.get(InstanceProp.MEMORY_USED), result.get(InstanceProp.MEMORY_TOTAL), MEDIUM_MEM_PERCENT),
+    ]:
+        if used is not None and total and 100 * used / total >= threshold_percent:
+            return True
+    # Same disk space usage as the dashboard: total - available
+    total = result.get(InstanceProp.DISK_SPACE_TOTAL)
+    available = result.get(InstanceProp.DISK_SPACE_AVAILABLE)
+    if total and available is not None and 100 * (total - available) / total >= MEDIUM_SPACE_PERCENT:
+        return True
+    return False
@@ -0,0 +1,193 @@
+import os
+import io
+import json
+import lzma
+import math
+import zlib
+import array
+import struct
+import fnmatch
+import datetime
+import threading
+
+
+# Segment file: [magic][compressed blocks...][compressed JSON index][footer: index offset and size, magic]
+SEGMENT_MAGIC = b"BBSEG001"
+SEGMENT_FOOTER = struct.Struct("<QQ8s")
+SEGMENT_FILE_EXTENSION = ".seg"
+SEGMENT_DURATION = 86400  # 1 day (UTC)
+# Samples of a host over this duration are compressed together, and decompressed together when read
+BLOCK_DURATION = 3600  # 1h
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+DEFAULT_CODEC = "zlib"
+
+
+class SegmentStore:
+    """Read-only access to a directory of compressed archive segments, one file per day (ex: 2022-12-16.seg)
+
+    A segment holds blocks of samples, each one being a host over an hour compressed on its own, and an index of the
+    blocks (host, time range, location in file) read first: queries only decompress the blocks they touch.
+    """
+
+    def __init__(self, segments_dir):
+        self.segments_dir = segments_dir
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def get_series(self, host_patterns, metric, from_time, to_time):
+        """Get {host: (times, values)} of a metric for hosts matching any of given patterns (all if none) between
+        given times, in time order, values being None if unknown
+        """
+        series = {}
+        for segment_path in self.get_segment_paths(from_time, to_time):
+            with open(segment_path, "rb") as f_in:
+                index = self._get_index(segment_path, f_in)
+                if metric not in index["metrics"]:
+                    continue
+                for block in get_matching_blocks(index, host_patterns, from_time, to_time):
+                    times, values = read_block(f_in, index, block, metric)
+                    host_times, host_values = series.setdefault(block[0], ([], []))
+                    for timestamp, value in zip(times, values):
+                        if from_time <= timestamp <= to_time:
+                            host_times.append(timestamp)
+                            host_values.append(None if math.isnan(value) else value)
+        return series
+
+    def get_segment_paths(self, from_time, to_time):
+        """Get paths of segments overlapping given times, in time order"""
+        if not os.path.isdir(self.segments_dir):
+            return []
+        first_name = get_segment_name(max(from_time, 0))
+        last_name = get_segment_name(max(to_time, 0))
+        return [os.path.join(self.segments_dir, file_name) for file_name in sorted(os.listdir(self.segments_dir))
+                if file_name.endswith(SEGMENT_FILE_EXTENSION) and first_name <= file_name <= last_name]
+
+    def get_end_time(self):
+        """Get end time of the last segment (compaction going from oldest days on), None if no segment"""
+        file_names = [] if not os.path.isdir(self.segments_dir) else \
+            [file_name for file_name in os.listdir(self.segments_dir) if file_name.endswith(SEGMENT_FILE_EXTENSION)]
+        if not file_names:
+            return None
+        day = datetime.datetime.strptime(max(file_names)[:-len(SEGMENT_FILE_EXTENSION)], "%Y-%m-%d")
+        return day.replace(tzinfo=datetime.timezone.utc).timestamp() + SEGMENT_DURATION
+
+    def _get_index(self, segment_path, f_in):
+        # Segments being replaced as a whole (ex: merged), an index is valid as long as its file
+        stat = os.fstat(f_in.fileno())
+        version = stat.st_ino, stat.st_mtime_ns, stat.st_size
+        with self._lock:
+            cached = self._indexes.get(segment_path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        index = read_index(f_in)
+        with self._lock:
+            self._indexes[segment_path] = version, index
+        return index
+
+
+def write_segment(segment_path, metrics, host_rows, codec=DEFAULT_CODEC):
+    """Write a segment file from rows (ts, metric values...) of each host (host, rows), in time order, replacing it
+    atomically
+    """
+    compress = CODECS[codec][0]
+    blocks = []
+    tmp_path = f"{segment_path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f_out:
+            f_out.write(SEGMENT_MAGIC)
+            for host, rows in host_rows:
+                for block_rows in split_block_rows(rows):
+                    data = compress(encode_rows(block_rows, len(metrics)))
+                    blocks.append([host, block_rows[0][0], block_rows[-1][0], f_out.tell(), len(data),
+                                   len(block_rows)])
+                    f_out.write(data)
+            index = {"codec": codec, "metrics": list(metrics), "blocks": blocks}
+            index_data = zlib.compress(json.dumps(index, separators=(',', ':')).encode())
+            index_offset = f_out.tell()
+            f_out.write(index_data)
+            f_out.write(SEGMENT_FOOTER.pack(index_offset, len(index_data), SEGMENT_MAGIC))
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        os.replace(tmp_path, segment_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(blocks)
+
+
+def read_segment_rows(segment_path):
+    """Read all rows (ts, metric values...) of each host of a segment: (metrics, {host: rows})"""
+    host_rows = {}
+    with open(segment_path, "rb") as f_in:
+        index = read_index(f_in)
+        for block in index["blocks"]:
+            f_in.seek(block[3])
+            rows = decode_rows(CODECS[index["codec"]][1](f_in.read(block[4])), block[5], len(index["metrics"]))
+            host_rows.setdefault(block[0], []).extend(rows)
+    return index["metrics"], host_rows
+
+
+def read_index(f_in):
+    f_in.seek(-SEGMENT_FOOTER.size, io.SEEK_END)
+    index_offset, index_size, magic = SEGMENT_FOOTER.unpack(f_in.read(SEGMENT_FOOTER.size))
+    if magic != SEGMENT_MAGIC:
+        raise RuntimeError(f"Invalid segment file: {f_in.name}")
+    f_in.seek(index_offset)
+    return json.loads(zlib.decompress(f_in.read(index_size)))
+
+
+def read_block(f_in, index, block, metric):
+    """Decompress a block, and get (times, values) of given metric"""
+    f_in.seek(block[3])
+    data = CODECS[index["codec"]][1](f_in.read(block[4]))
+    count = block[5]
+    metric_index = index["metrics"].index(metric)
+    columns = array.array("d")
+    columns.frombytes(data)
+    return columns[:count], columns[(metric_index + 1) * count:(metric_index + 2) * count]
+
+
+def get_matching_blocks(index, host_patterns, from_time, to_time):
+    """Get blocks of hosts matching any of given patterns (all if none), overlapping given times"""
+    return [block for block in index["blocks"]
+            if block[1] <= to_time and block[2] >= from_time and
+            (not host_patterns or any(fnmatch.fnmatchcase(block[0], pattern) for pattern in host_patterns))]
+
+
+def split_block_rows(rows):
+    """Split rows in time order into rows of each block duration"""
+    block_rows = []
+    for row in rows:
+        if block_rows and row[0] // BLOCK_DURATION != block_rows[0][0] // BLOCK_DURATION:
+            yield block_rows
+            block_rows = []
+        block_rows.append(row)
+    if block_rows:
+        yield block_rows
+
+
+def encode_rows(rows, metrics_count):
+    """Encode rows column by column (times, then values of each metric, NaN if unknown) as float64: similar values
+    being next to each other, they compress better
+    """
+    columns = array.array("d", (row[0] for row in rows))
+    for i in range(1, metrics_count + 1):
+        columns.extend(math.nan if row[i] is None else row[i] for row in rows)
+    return columns.tobytes()
+
+
+def decode_rows(data, count, metrics_count):
+    columns = array.array("d")
+    columns.frombytes(data)
+    return [tuple(None if math.isnan(value) else value for value in columns[i::count][:metrics_count + 1])
+            for i in range(count)]
+
+
+def get_segment_name(timestamp):
+    """Get file name of the segment holding given time (ex: 2022-12-16.seg)"""
+    day = datetime.datetime.fromtimestamp(timestamp // SEGMENT_DURATION * SEGMENT_DURATION, datetime.timezone.utc)
+    return day.strftime("%Y-%m-%d") + SEGMENT_FILE_EXTENSION
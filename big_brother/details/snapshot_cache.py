@@ -0,0 +1,116 @@
+import os
+import time
+import threading
+
+from big_brother.details.globals import MainProp, MetaProp
+from big_brother.details.utils import load_json
+
+
+# Longest wait for the first monitoring results of an in-memory store (seconds)
+FIRST_SNAPSHOT_TIMEOUT = 60
+
+
+class Snapshot:
+    """Parsed monitoring results of a given version, along with their renderings (HTML page, OpenMetrics text...)
+
+    Each rendering is built once, on first request, then shared by all the following requests. A rendering may be
+    derived from another one (ex: compressed page).
+    """
+
+    def __init__(self, version, data, modified_time):
+        self.version = version
+        self.data = data
+        self.modified_time = modified_time
+        self._lock = threading.RLock()
+        self._renderings = {}
+
+    def get_rendering(self, name, render_func):
+        """Get rendering of snapshot data with given name, built by render_func(data) if not done yet"""
+        rendering = self._renderings.get(name)
+        if rendering is None:
+            with self._lock:
+                # Single-flight: concurrent requests wait for the first one to render
+                rendering = self._renderings.get(name)
+                if rendering is None:
+                    rendering = render_func(self.data)
+                    self._renderings[name] = rendering
+        return rendering
+
+    def get_tag(self):
+        """Get an opaque string identifying snapshot version (ex: to build HTTP entity tags)"""
+        return "-".join(f"{value:x}" for value in self.version)
+
+
+class SnapshotCache:
+    """In-memory snapshot of the monitoring results JSON file, reloaded only when the file changes
+
+    The file version is given by its (inode, modification time, size): the monitor replacing or rewriting the file
+    changes at least one of them. Concurrent requests hitting a new version trigger a single reload.
+    """
+
+    def __init__(self, json_path):
+        self.json_path = json_path
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def get(self):
+        """Get snapshot of current file version"""
+        version = get_file_version(self.json_path)
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        with self._lock:
+            # Single-flight: concurrent requests wait for the first one to reload
+            version = get_file_version(self.json_path)
+            if self._snapshot is None or self._snapshot.version != version:
+                self._snapshot = Snapshot(version, load_json(self.json_path), version[1] / 1e9)
+            return self._snapshot
+
+    def get_next(self, snapshot, timeout):
+        """Get snapshot following given one, or given one if unchanged after timeout (the file being polled)"""
+        time.sleep(timeout)
+        return self.get()
+
+
+class MemorySnapshotStore:
+    """In-memory snapshots of monitoring results, published by a monitor running in the same process (no file)
+
+    Same interface as SnapshotCache, the snapshot version being the store creation time (distinct versions across
+    process restarts, ex: for HTTP entity tags) and the results version in metadata.
+    """
+
+    def __init__(self, first_snapshot_timeout=FIRST_SNAPSHOT_TIMEOUT):
+        self.first_snapshot_timeout = first_snapshot_timeout
+        self._creation_time = time.time_ns()
+        self._condition = threading.Condition()
+        self._snapshot = None
+        self._count = 0
+
+    def publish(self, data):
+        """Publish new monitoring results (not to be modified afterwards: shared by all requests)"""
+        with self._condition:
+            # Results version, or publication count without it
+            self._count += 1
+            version = (self._creation_time, data[MainProp.METADATA].get(MetaProp.VERSION) or self._count)
+            self._snapshot = Snapshot(version, data, time.time())
+            self._condition.notify_all()
+
+    def get(self):
+        """Get snapshot of last published results, waiting for the first ones"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._snapshot is not None, self.first_snapshot_timeout):
+                raise RuntimeError("No monitoring results published yet")
+            return self._snapshot
+
+    def get_next(self, snapshot, timeout):
+        """Get snapshot following given one, or given one if none published before timeout"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._snapshot is not snapshot, timeout)
+            return self._snapshot or snapshot
+
+
+def get_file_version(file_path):
+    if not os.path.isfile(file_path):
+        raise RuntimeError(f"File not found: {file_path}")
+    stat = os.stat(file_path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
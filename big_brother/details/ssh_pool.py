@@ -0,0 +1,130 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+
+# Timeout to establish an ssh connection, master or not (seconds): connection failures end (with return code 255)
+# before command deadlines
+SSH_CONNECT_TIMEOUT = 5
+# Master connections left idle (ex: monitor killed) close themselves after this delay (seconds)
+SSH_CONTROL_PERSIST = 600
+# Delay between two health checks of a master connection (seconds)
+SSH_HEALTH_CHECK_PERIOD = 30
+# Reconnection backoff after failures: 10s, 20s, 40s... up to 10min
+SSH_RECONNECT_MIN_DELAY = 10
+SSH_RECONNECT_MAX_DELAY = 600
+
+
+class SSHConnectionPool:
+    """Pool of long-lived multiplexed ssh connections (OpenSSH ControlMaster), one master per (user, ip)
+
+    Probes reuse the master connection of their target through its control socket, so that connection setup
+    (TCP handshake, key exchange, authentication) is a one-time cost per host instead of a per-probe cost.
+    When no master is available (connection failure, reconnection backoff), probes fall back to plain ssh.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        # Short directory path, since unix socket paths are limited to ~100 characters
+        self.control_dir = tempfile.mkdtemp(prefix="bb_ssh_")
+        self._lock = threading.Lock()
+        self._masters = {}
+
+    def get_ssh_options(self, ip, ssh_user):
+        """Get ssh options to reuse the master connection of (ssh_user, ip), if available"""
+        master = self._get_master(ip, ssh_user)
+        with master["lock"]:
+            now = time.monotonic()
+            if master["alive"] and now - master["last_check"] > SSH_HEALTH_CHECK_PERIOD:
+                # Periodic health check
+                master["alive"] = self._check_master(ip, ssh_user)
+                master["last_check"] = now
+                if not master["alive"]:
+                    self.logger.warning(f"SSH master connection to {get_ssh_destination(ip, ssh_user)} lost")
+            if not master["alive"] and now >= master["retry_time"]:
+                # (Re)connect, with exponential backoff on failures
+                master["alive"] = self._start_master(ip, ssh_user)
+                master["last_check"] = now
+                if master["alive"]:
+                    master["failures"] = 0
+                else:
+                    master["failures"] += 1
+                    delay = min(SSH_RECONNECT_MIN_DELAY * 2 ** (master["failures"] - 1), SSH_RECONNECT_MAX_DELAY)
+                    master["retry_time"] = now + delay
+                    self.logger.warning(f"SSH master connection to {get_ssh_destination(ip, ssh_user)} failed, "
+                                        f"retry in {delay}s")
+            if not master["alive"]:
+                # Fallback to plain ssh
+                return []
+        return ["-o", f"ControlPath={self._get_control_path()}"]
+
+    def invalidate(self, ip, ssh_user):
+        """Force a health check of the master connection of (ssh_user, ip) on next use (ex: after a ssh failure)"""
+        master = self._get_master(ip, ssh_user)
+        with master["lock"]:
+            master["last_check"] = float("-inf")
+
+    def close(self):
+        """Close all master connections"""
+        with self._lock:
+            keys = list(self._masters.keys())
+            self._masters.clear()
+        for ssh_user, ip in keys:
+            self._run_control_command("exit", ip, ssh_user)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+    def _get_master(self, ip, ssh_user):
+        with self._lock:
+            return self._masters.setdefault((ssh_user, ip), {
+                "lock": threading.Lock(),
+                "alive": False,
+                "last_check": 0.,
+                "failures": 0,
+                "retry_time": 0.,
+            })
+
+    def _get_control_path(self):
+        # %C: hash of local host, remote host, port and user
+        return os.path.join(self.control_dir, "%C")
+
+    def _start_master(self, ip, ssh_user):
+        cmd_args = [
+            "ssh", "-M", "-N", "-f",
+            "-o", f"ControlPath={self._get_control_path()}",
+            "-o", f"ControlPersist={SSH_CONTROL_PERSIST}",
+            "-o", "BatchMode=yes",
+            "-o", f"ConnectTimeout={SSH_CONNECT_TIMEOUT}",
+            "-o", "ServerAliveInterval=30",
+            get_ssh_destination(ip, ssh_user),
+        ]
+        # Note: the backgrounded master inherits standard streams, so they must not be captured
+        try:
+            cmd_output = subprocess.run(cmd_args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL, timeout=2 * SSH_CONNECT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            return False
+        return cmd_output.returncode == 0
+
+    def _check_master(self, ip, ssh_user):
+        return self._run_control_command("check", ip, ssh_user)
+
+    def _run_control_command(self, control_cmd, ip, ssh_user):
+        cmd_args = [
+            "ssh", "-O", control_cmd,
+            "-o", f"ControlPath={self._get_control_path()}",
+            get_ssh_destination(ip, ssh_user),
+        ]
+        try:
+            cmd_output = subprocess.run(cmd_args, capture_output=True, timeout=SSH_CONNECT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            return False
+        return cmd_output.returncode == 0
+
+
+def get_ssh_destination(ip, ssh_user=None):
+    if ssh_user is None:
+        return f"{ip}"
+    return f"{ssh_user}@{ip}"
@@ -1,5 +1,13 @@
 import os
+import re
 import json
+import tempfile
+
+
+# File mode creation mask assumed if the one of the process cannot be read
+DEFAULT_UMASK = 0o022
+# Duration units (seconds)
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
 
 
 def load_json(json_path):
@@ -11,14 +19,60 @@ def load_json(json_path):
         return json.load(json_file)
 
 
-def write_json(out_json_path, data):
+def write_json(out_json_path, data, compact=False):
+    """Write data in a JSON file, atomically: readers get either the previous or the new file content, never a
+    partially written one (temporary file in the same directory, flushed to disk, then renamed)
+    """
     # Ensure parent directory existence
     out_dir = os.path.dirname(os.path.abspath(out_json_path))
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
     # Write file content
-    with open(out_json_path, "w") as f_out:
-        json.dump(data, f_out, indent=3)
+    tmp_file = tempfile.NamedTemporaryFile("w", dir=out_dir, prefix=f".{os.path.basename(out_json_path)}.",
+                                           suffix=".tmp", delete=False)
+    try:
+        with tmp_file as f_out:
+            if compact:
+                json.dump(data, f_out, separators=(",", ":"))
+            else:
+                json.dump(data, f_out, indent=3)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        # Same permissions as a file created by open() (temporary files being private)
+        os.chmod(tmp_file.name, 0o666 & ~get_umask())
+        os.replace(tmp_file.name, out_json_path)
+    except BaseException:
+        os.remove(tmp_file.name)
+        raise
+    # Persist the rename itself
+    dir_fd = os.open(out_dir, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def get_umask():
+    """Get the process file mode creation mask, from /proc (Linux), DEFAULT_UMASK if unavailable
+
+    Note: os.umask() only reads it by setting it, which is not thread-safe
+    """
+    try:
+        with open("/proc/self/status") as f_in:
+            for line in f_in:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    return DEFAULT_UMASK
+
+
+def parse_duration(text):
+    """Parse a duration in seconds, minutes, hours, days or weeks (ex: 15m) into seconds"""
+    match = re.fullmatch(r"(\d+)([smhdw])", text.strip())
+    if match is None or not int(match.group(1)):
+        raise RuntimeError(f"Invalid duration: {text} (ex: 30s, 15m, 1h, 2d, 1w)")
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
 
 
 def get_kib_size_as_human_readable_str(value_kib):
@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+
+TOP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+[sys.path.append(dir_path) for dir_path in [TOP_DIR] if dir_path not in sys.path]
+
+from big_brother.details.logger import create_rotating_logger
+from big_brother.details.utils import parse_duration
+from big_brother.details.archive import compact_archive, DEFAULT_ARCHIVE_RETENTION
+from big_brother.details.segments import CODECS, DEFAULT_CODEC
+
+
+# Lowest scheduling priority: compaction (compression) never competing with the monitor for CPU
+COMPACTION_NICENESS = 19
+
+
+def compact_archive_periodically(archive_db_path, segments_dir, older_than, codec=DEFAULT_CODEC,
+                                 retention=DEFAULT_ARCHIVE_RETENTION, period=None, log_path=None):
+    """Compact days of the archive database older than given duration into compressed segments, at low priority,
+    once or on repeat (every period seconds)
+    """
+    logger = create_rotating_logger(log_path=log_path, log_name="BBCompaction")
+    os.nice(COMPACTION_NICENESS)
+    while True:
+        logger.info(f"Compact {archive_db_path} into {segments_dir} (days older than {older_than}s, {codec})")
+        segment_paths = compact_archive(archive_db_path, segments_dir, older_than, codec, retention, logger)
+        logger.info(f">> {len(segment_paths)} segment(s) written")
+        if not period:
+            break
+        logger.info(f"Sleep {period}s...")
+        time.sleep(period)
+
+
+if __name__ == "__main__":
+    # Handy command line interface (-h for help)
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Compact older days of the monitor's archive database into compressed segment files (one per "
+                    "day), read by the server along with the database")
+    parser.add_argument('--archive_db', metavar="PATH", required=True,
+                        help='Path to archive database of the monitor')
+    parser.add_argument('--segments_dir', metavar="PATH", required=True,
+                        help='Directory of compressed segments')
+    parser.add_argument('--older_than', metavar="DURATION", default="7d",
+                        help='Compact days older than that (default: %(default)s)')
+    parser.add_argument('--codec', choices=sorted(CODECS), default=DEFAULT_CODEC,
+                        help='Compression codec: zlib (faster) or lzma (smaller) (default: %(default)s)')
+    parser.add_argument('--retention', metavar="DURATION", default="365d",
+                        help='Remove segments older than that (default: %(default)s)')
+    parser.add_argument('--period', metavar="N", type=int, default=None,
+                        help='Repeat compaction every N seconds (default: once)')
+    parser.add_argument('--log', metavar="PATH", default=None,
+                        help='Path to log file (default: console only)')
+    args = parser.parse_args()
+
+    # Go
+    compact_archive_periodically(
+        archive_db_path=args.archive_db,
+        segments_dir=args.segments_dir,
+        older_than=parse_duration(args.older_than),
+        codec=args.codec,
+        retention=parse_duration(args.retention),
+        period=args.period,
+        log_path=args.log,
+    )
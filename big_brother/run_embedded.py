@@ -0,0 +1,132 @@
+import os
+import sys
+import _thread
+import threading
+
+TOP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+[sys.path.append(dir_path) for dir_path in [TOP_DIR] if dir_path not in sys.path]
+
+from big_brother.details.globals import DEFAULT_INSTANCES_JSON_PATH, DEFAULT_MONITOR_LOG_PATH, \
+    DEFAULT_MONITOR_PERIOD, DEFAULT_MONITOR_WORKERS
+from big_brother.details.utils import parse_duration
+from big_brother.details.snapshot_cache import MemorySnapshotStore
+from big_brother.details.archive import DEFAULT_ARCHIVE_RETENTION, init_archive_db
+from big_brother.run_monitor import monitor_instances_periodically, ENGINE_THREADS, ENGINE_ASYNCIO
+from big_brother.run_server import run_server, DEFAULT_HOST, DEFAULT_PORT
+
+
+def run_embedded(host, port, instances_json_path, out_json_path, log_path, period, workers=None, batch_probe=None,
+                 engine=None, ssh_pool=True, compact_json=None, history=None, archive_db_path=None,
+                 archive_retention=DEFAULT_ARCHIVE_RETENTION, archive_segments_dir=None):
+    """Run monitor and server in a single process: the monitor runs in a background thread, handing each new
+    monitoring results directly to the server (in memory), and writing them in JSON only if out_json_path is given
+
+    The history of metrics (MetricsHistory) if given is kept by the monitor, and queried by the server as it is.
+    The archive database if given is written by the monitor, and read by the server (along with its compacted segments
+    if given).
+    """
+    snapshot_store = MemorySnapshotStore()
+    if archive_db_path is not None:
+        # Readable by the server before the first monitoring cycle
+        init_archive_db(archive_db_path)
+    threading.Thread(
+        target=run_monitor_thread,
+        name="BBMonitor",
+        daemon=True,
+        kwargs=dict(
+            instances_json_path=instances_json_path,
+            out_json_path=out_json_path,
+            log_path=log_path,
+            period=period,
+            workers=workers,
+            batch_probe=batch_probe,
+            engine=engine,
+            ssh_pool=ssh_pool,
+            compact_json=compact_json,
+            publish_func=snapshot_store.publish,
+            history=history,
+            archive_db_path=archive_db_path,
+            archive_retention=archive_retention,
+        ),
+    ).start()
+    run_server(host=host, port=port, data_json_path=None, debug=False, snapshot_store=snapshot_store,
+               history=history, archive_db_path=archive_db_path, archive_segments_dir=archive_segments_dir)
+
+
+def run_monitor_thread(**kwargs):
+    try:
+        monitor_instances_periodically(**kwargs)
+    finally:
+        # Monitor stopped (error already logged): stop the server as well, rather than serving outdated results
+        _thread.interrupt_main()
+
+
+if __name__ == "__main__":
+    # Handy command line interface (-h for help)
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Run BigBrother monitor and server in a single process, monitoring results being handed over "
+                    "in memory")
+    parser.add_argument('--host', default=DEFAULT_HOST,
+                        help='Server host name (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Server port number (default: %(default)s)')
+    parser.add_argument('--instances_json', metavar="PATH", default=DEFAULT_INSTANCES_JSON_PATH,
+                        help='Path to JSON file listing target instances and storages (default: %(default)s)')
+    parser.add_argument('--out_json', metavar="PATH", default=None,
+                        help='Path to output JSON file where to also store monitoring results (default: none)')
+    parser.add_argument('--log', metavar="PATH", default=DEFAULT_MONITOR_LOG_PATH,
+                        help='Path to monitor log file (default: %(default)s)')
+    parser.add_argument('--period', metavar="N", type=int, default=DEFAULT_MONITOR_PERIOD,
+                        help='Repeat monitoring every N seconds (default: %(default)s)')
+    parser.add_argument('--workers', metavar="N", type=int, default=None,
+                        help='Monitor up to N instances and storages in parallel '
+                             f'(default: "workers" of input JSON "settings", else {DEFAULT_MONITOR_WORKERS})')
+    parser.add_argument('--batch_probe', action="store_true", default=None,
+                        help='Retrieve all metrics of an instance with a single combined command (single ssh connection)')
+    parser.add_argument('--engine', choices=[ENGINE_THREADS, ENGINE_ASYNCIO], default=None,
+                        help='Collection engine: parallel threads running shell commands, or a single asyncio '
+                             f'event loop running commands without shell (default: "engine" of input JSON '
+                             f'"settings", else {ENGINE_THREADS})')
+    parser.add_argument('--no_ssh_pool', action="store_true", default=False,
+                        help='Open a new ssh connection for each command, instead of reusing long-lived connections')
+    parser.add_argument('--compact_json', action="store_true", default=None,
+                        help='Write monitoring results without indentation (smaller file, faster to write)')
+    parser.add_argument('--history', action="store_true", default=False,
+                        help='Keep and serve history of metrics, in memory unless --history_dir is given (requires '
+                             'NumPy)')
+    parser.add_argument('--history_dir', metavar="PATH", default=None,
+                        help='Keep history of metrics in ring files of this directory (default: none)')
+    parser.add_argument('--archive_db', metavar="PATH", default=None,
+                        help='Archive metrics in this SQLite database, and serve them (default: none)')
+    parser.add_argument('--archive_retention', metavar="DURATION", default="365d",
+                        help='Remove archived metrics older than that (default: %(default)s)')
+    parser.add_argument('--archive_segments_dir', metavar="PATH", default=None,
+                        help='Compressed segments of the archive database (see run_compaction.py, default: none)')
+    args = parser.parse_args()
+
+    # History (optional, NumPy only needed then)
+    metrics_history = None
+    if args.history or args.history_dir:
+        from big_brother.details.history import MetricsHistory
+        metrics_history = MetricsHistory(args.history_dir, period=args.period)
+
+    # Go
+    run_embedded(
+        host=args.host,
+        port=args.port,
+        instances_json_path=args.instances_json,
+        out_json_path=args.out_json,
+        log_path=args.log,
+        period=args.period,
+        workers=args.workers,
+        batch_probe=args.batch_probe,
+        engine=args.engine,
+        ssh_pool=not args.no_ssh_pool,
+        compact_json=args.compact_json,
+        history=metrics_history,
+        archive_db_path=args.archive_db,
+        archive_retention=parse_duration(args.archive_retention),
+        archive_segments_dir=args.archive_segments_dir,
+    )
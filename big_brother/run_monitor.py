@@ -2,44 +2,164 @@ import os
 import sys
 import subprocess
 import re
+import shlex
+import signal
 import time
+import random
 import datetime
+import asyncio
+import functools
+import concurrent.futures
 
 TOP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 [sys.path.append(dir_path) for dir_path in [TOP_DIR] if dir_path not in sys.path]
 
-from big_brother.details.globals import MainProp, MetaProp, InstanceProp, DEFAULT_INSTANCES_JSON_PATH, \
-    DEFAULT_MONITORING_JSON_PATH, DEFAULT_MONITOR_PERIOD, DEFAULT_MONITOR_LOG_PATH, DATETIME_FORMAT, USAGE_MEMO_PATH
+from big_brother.details.globals import MainProp, MetaProp, InstanceProp, InstanceState, SettingsProp, DEFAULT_INSTANCES_JSON_PATH, \
+    DEFAULT_MONITORING_JSON_PATH, DEFAULT_MONITOR_PERIOD, DEFAULT_MONITOR_WORKERS, DEFAULT_MONITOR_LOG_PATH, \
+    DATETIME_FORMAT, USAGE_MEMO_PATH
 from big_brother.details.logger import create_rotating_logger
-from big_brother.details.utils import load_json, write_json
+from big_brother.details.utils import load_json, write_json, parse_duration
+from big_brother.details.ssh_pool import SSHConnectionPool, get_ssh_destination, SSH_CONNECT_TIMEOUT
+from big_brother.details.local_metrics import get_local_instance_metrics
+from big_brother.details.net_counters import get_net_rates
+from big_brother.details.facts_cache import HostFactsCache
+from big_brother.details.scheduler import MonitorScheduler, is_alerting
+from big_brother.details.circuit_breaker import HostCircuitBreaker
+from big_brother.details.probe_stats import ProbeStats
+from big_brother.details.archive import MetricsArchive, DEFAULT_ARCHIVE_RETENTION
 
 
 SSH_TIMEOUT = 10
+# Stricter deadline of storage probes (seconds), a hung mount must not stall the cycle
+STORAGE_TIMEOUT = 5
+# Return codes of timed out commands (timeout command, then killed with SIGKILL)
+TIMEOUT_RETURNCODES = [124, 137]
 LOCALHOST_IPS = ["localhost", "127.0.0.1"]
+# Probe commands
+NPROC_CMD = "nproc"
+TOP_CMD = "top -b -n1 -i"
+LOAD_CMD = f"cat /proc/loadavg 2>/dev/null || {TOP_CMD} | head -n 1"
+FREE_CMD = "free"
+DF_CMD = "df {disk_path}"
+# -- Storage probe, killed on remote side as well (only touches the target mounts)
+# -- Note: in the foreground, so that killing the process group of the probe kills df as well
+STORAGE_DF_CMD = "timeout --foreground -s KILL {timeout} df -P {disk_paths}"
+NET_COUNTERS_CMD = "cat /sys/class/net/{interface}/statistics/tx_bytes /sys/class/net/{interface}/statistics/rx_bytes"
+UPTIME_CMD = "uptime --pretty"
+# -- Units of its output (seconds)
+UPTIME_UNITS = {"week": 604800, "weeks": 604800, "day": 86400, "days": 86400, "hour": 3600, "hours": 3600,
+                "minute": 60, "minutes": 60}
+# -- Memo modification time ("none" without memo file), then memo content unless modification time is the cached one
+NO_USAGE_MEMO_MTIME = "none"
+USAGE_MEMO_CMD = f'memo_mtime=$(stat -c %Y {USAGE_MEMO_PATH} 2>/dev/null || echo {NO_USAGE_MEMO_MTIME}) ' \
+                 f'&& echo "$memo_mtime" && ([ "$memo_mtime" = "{{mtime}}" ] || [ "$memo_mtime" = ' \
+                 f'"{NO_USAGE_MEMO_MTIME}" ] || cat {USAGE_MEMO_PATH})'
+# Section delimiter in batched probe output
+BATCH_MARKER = "@@BB@@"
+# Characters requiring a shell to run a command
+SHELL_SPECIAL_CHARS = "|&;<>()$`*?'\"\\"
+# A storage sharing its volume with another one is still queried on its own after this delay (seconds),
+# to notice remounts
+STORAGE_VOLUME_TTL = 3600
+# Collection engines
+ENGINE_THREADS = "threads"
+ENGINE_ASYNCIO = "asyncio"
+# Default settings, overridden by input JSON "settings" section, then by command line
+DEFAULT_MONITOR_SETTINGS = {
+    SettingsProp.WORKERS: DEFAULT_MONITOR_WORKERS,
+    SettingsProp.BATCH_PROBE: False,
+    SettingsProp.ENGINE: ENGINE_THREADS,
+    SettingsProp.GROUP_INTERVALS: {},
+    SettingsProp.PRIORITY_INTERVAL: None,
+    SettingsProp.JITTER: 0.1,
+    SettingsProp.DEADLINE: None,
+    SettingsProp.COMPACT_JSON: False,
+}
 
+# Globals
+# -- Monitor state kept across cycles (necessary evil)
+SSH_POOL = None
+FACTS_CACHE = HostFactsCache()
+CIRCUIT_BREAKER = HostCircuitBreaker()
+# -- Volume of each storage (ip, disk_path) seen on previous cycles: (volume, time of its last own query)
+STORAGE_VOLUMES = {}
+# -- Storages (ip, user, disk_path) hung on a previous cycle, with their background re-probe (Future)
+STORAGE_QUARANTINE = {}
+STORAGE_REPROBE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="BBReprobe")
+# -- Last known metrics of each storage (ip, disk_path), reported while it is hung
+LAST_STORAGE_METRICS = {}
+# -- Version of the last written monitoring results (increasing, including across monitor restarts)
+SNAPSHOT_VERSION = None
 
-def monitor_instances_periodically(instances_json_path, out_json_path, log_path, period):
+
+def monitor_instances_periodically(instances_json_path, out_json_path, log_path, period, workers=None,
+                                   batch_probe=None, engine=None, ssh_pool=True, compact_json=None, publish_func=None,
+                                   history=None, archive_db_path=None, archive_retention=DEFAULT_ARCHIVE_RETENTION):
+    """Monitor instances and storages on repeat, writing results in JSON (if out_json_path) and/or handing them to
+    publish_func(results) (ex: in-memory server snapshots), keeping their metrics in history (MetricsHistory), and
+    archiving them in a SQLite database (if archive_db_path)
+    """
+    global SSH_POOL
     # Logger
     logger = create_rotating_logger(log_path=log_path, log_name="BBMonitor")
     # Period checkpoint
     if period <= 0:
         raise RuntimeError(f"Invalid period: {period}")
-    # On repeat...
-    while True:
-        # Monitor
-        monitor_instances(
-            instances_json_path=instances_json_path,
-            out_json_path=out_json_path,
-            logger=logger,
-        )
-        # Wait
-        logger.info("-" * 80)
-        logger.info(f"Sleep {period}s...")
-        time.sleep(period)
-        logger.info("-" * 80)
-
-
-def monitor_instances(instances_json_path, out_json_path, logger=None):
+    # Long-lived ssh connections, shared by all cycles
+    if ssh_pool:
+        SSH_POOL = SSHConnectionPool(logger)
+    # Fixed-rate scheduling, the period being the default interval of each instance and storage
+    scheduler = MonitorScheduler(default_interval=period)
+    tick_time = time.monotonic()
+    # Long-term archive, written by its own thread
+    archive = None
+    if archive_db_path is not None:
+        archive = MetricsArchive(archive_db_path, retention=archive_retention, logger=logger)
+    try:
+        # On repeat...
+        while True:
+            # Monitor
+            results = monitor_instances(
+                instances_json_path=instances_json_path,
+                out_json_path=out_json_path,
+                logger=logger,
+                workers=workers,
+                batch_probe=batch_probe,
+                engine=engine,
+                scheduler=scheduler,
+                compact_json=compact_json,
+                history=history,
+                archive=archive,
+            )
+            if publish_func is not None:
+                publish_func(results)
+            # Wait next tick, measured from previous one (whatever the cycle duration)
+            tick_time = scheduler.get_next_tick_time(tick_time)
+            sleep_time = max(tick_time - time.monotonic(), 0)
+            logger.info("-" * 80)
+            logger.info(f"Sleep {sleep_time:.1f}s...")
+            time.sleep(sleep_time)
+            logger.info("-" * 80)
+    finally:
+        # Teardown
+        if history is not None:
+            history.flush()
+        if archive is not None:
+            logger.info("Write archive")
+            archive.close()
+        if SSH_POOL is not None:
+            logger.info("Close ssh connections")
+            SSH_POOL.close()
+            SSH_POOL = None
+
+
+def monitor_instances(instances_json_path, out_json_path, logger=None, workers=None, batch_probe=None, engine=None,
+                      scheduler=None, compact_json=None, history=None, archive=None):
+    """Monitor instances and storages once, write results in JSON (unless out_json_path is None), and return them
+
+    With a scheduler, only due instances and storages are monitored, until the cycle deadline: the other ones are
+    carried over from previous cycles (late ones being adopted once done).
+    """
     # Logger
     if logger is None:
         # -- Dummy logger
@@ -47,105 +167,587 @@ def monitor_instances(instances_json_path, out_json_path, logger=None):
     try:
         # Init timing
         start_time = time.time()
+        cycle_time = time.monotonic()
+        CIRCUIT_BREAKER.start_cycle()
+        # Probe timings and outcomes of this cycle
+        probe_stats = ProbeStats()
         # Load instance and storage details
         json_data = load_json(instances_json_path)
-        # Monitor each instance
         instances = json_data.get("instances")
-        instance_results = []
-        logger.info(f"Monitor {len(instances)} instances")
-        for i, instance in enumerate(instances, start=1):
-            name = instance[InstanceProp.NAME]
-            ip = instance[InstanceProp.IP]
-            ssh_user = instance[InstanceProp.USER]
-            home_disk_path = "/"
-            net_interface = instance[InstanceProp.NET_INTERFACE]
-            logger.info(f"[{i}/{len(instances)}] {name} ({ip})")
-            result = instance.copy()
-            result.update(get_nproc_metrics(ip, ssh_user, logger))
-            result.update(get_top_metrics(ip, ssh_user, logger))
-            result.update(get_free_metrics(ip, ssh_user, logger))
-            result.update(get_df_metrics(ip, home_disk_path, ssh_user, logger))
-            result.update(get_iftop_metrics(ip, net_interface, ssh_user, logger))
-            result.update(get_uptime_metrics(ip, ssh_user, logger))
-            result.update(get_usage_memo(ip, ssh_user, logger))
-            logger.info(f">> {result}")
-            instance_results.append(result)
-        # Monitor each storage
         storages = json_data.get("storages")
-        storage_results = []
-        logger.info(f"Monitor {len(storages)} storages")
-        for i, storage in enumerate(storages, start=1):
-            name = storage[InstanceProp.NAME]
-            ip = storage[InstanceProp.IP]
-            ssh_user = storage[InstanceProp.USER]
-            disk_path = storage[InstanceProp.DISK_PATH]
-            logger.info(f"[{i}/{len(storages)}] {name} ({ip} - {disk_path})")
-            result = storage.copy()
-            result.update(get_df_metrics(ip, disk_path, ssh_user, logger))
-            logger.info(f">> {result}")
-            storage_results.append(result)
+        # Settings
+        settings = get_monitor_settings(json_data, {
+            SettingsProp.WORKERS: workers,
+            SettingsProp.BATCH_PROBE: batch_probe,
+            SettingsProp.ENGINE: engine,
+            SettingsProp.COMPACT_JSON: compact_json,
+        })
+        workers = settings[SettingsProp.WORKERS]
+        # Due instances and storages (all of them without scheduler)
+        instance_keys = [get_target_key(MainProp.INSTANCES, instance) for instance in instances]
+        storage_keys = [get_target_key(MainProp.STORAGES, storage) for storage in storages]
+        deadline = None
+        jitter = 0.
+        adopted_instances, adopted_storages = {}, {}
+        if scheduler is not None:
+            adopted_instances = adopt_late_results(scheduler, instances, instance_keys, settings, logger)
+            adopted_storages = adopt_late_results(scheduler, storages, storage_keys, settings, logger)
+            scheduler.set_tick(min([get_target_interval(target, settings, scheduler) for target in instances + storages]
+                                   + [settings[SettingsProp.PRIORITY_INTERVAL] or scheduler.default_interval]))
+            deadline = cycle_time + (settings[SettingsProp.DEADLINE] or scheduler.tick)
+            jitter = settings[SettingsProp.JITTER] * scheduler.tick
+        due_instances = {i: instance for i, (instance, key) in enumerate(zip(instances, instance_keys))
+                         if scheduler is None or scheduler.is_due(key, cycle_time)}
+        due_storages = {i: storage for i, (storage, key) in enumerate(zip(storages, storage_keys))
+                        if scheduler is None or scheduler.is_due(key, cycle_time)}
+        # Storage queries: a single df per host, and a single query per volume
+        storage_groups, storage_sources = get_storage_queries(list(due_storages.values()), logger, probe_stats)
+        storage_sources = dict(zip(due_storages.keys(), storage_sources))
+        logger.info(f"Monitor {len(due_instances)}/{len(instances)} instances and {len(due_storages)}/{len(storages)} "
+                    f"storages ({sum(len(disk_paths) for disk_paths in storage_groups.values())} volumes on "
+                    f"{len(storage_groups)} hosts) with {workers} workers ({settings[SettingsProp.ENGINE]} engine)")
+        if settings[SettingsProp.ENGINE] == ENGINE_ASYNCIO:
+            # Monitor each instance and storage host within a single event loop (late ones are cancelled)
+            instance_results, group_results, late_instance_futures, late_group_futures = asyncio.run(
+                monitor_all_async(due_instances, len(instances), storage_groups, settings, logger, deadline, jitter,
+                                  probe_stats))
+        else:
+            # Monitor each instance and storage host in parallel threads (late ones keep running)
+            instance_results, group_results, late_instance_futures, late_group_futures = monitor_all_threads(
+                due_instances, len(instances), storage_groups, settings, logger, deadline, jitter, probe_stats)
+        # Storages of completed (or quarantined) storage hosts
+        done_storages = {i: storage for i, storage in due_storages.items()
+                         if storage_sources[i][:2] not in late_group_futures}
+        done_storage_results = collect_storage_results(
+            list(done_storages.values()), [storage_sources[i] for i in done_storages], group_results, logger)
+        done_storage_results = dict(zip(done_storages.keys(), done_storage_results))
+        # Late results of previous cycles, processed as fresh ones (each storage from its own storage host results)
+        for i, (storage_source, storage_group_results) in adopted_storages.items():
+            if i not in done_storage_results:
+                done_storages[i] = storages[i]
+                done_storage_results[i] = collect_storage_results(
+                    [storages[i]], [storage_source], {storage_source[:2]: storage_group_results}, logger)[0]
+        instance_results = {**{i: result for i, (_, result) in adopted_instances.items()}, **instance_results}
+        update_storage_quarantine(list(done_storages.values()), list(done_storage_results.values()), logger,
+                                  probe_stats)
+        # Gather results in input order, carrying over the ones of instances and storages not due or late
+        # -- Late ones still running (threads engine) are adopted once done
+        for i, future in late_instance_futures.items():
+            logger.warning(f"{instances[i][InstanceProp.NAME]} ({instances[i][InstanceProp.IP]}) late, carried over")
+            if future is not None:
+                scheduler.set_pending(instance_keys[i], (future, None))
+        for i, storage in due_storages.items():
+            group_key = storage_sources[i][:2]
+            if group_key in late_group_futures:
+                logger.warning(f"{storage[InstanceProp.NAME]} ({storage[InstanceProp.IP]} - "
+                               f"{storage[InstanceProp.DISK_PATH]}) late, carried over")
+                if late_group_futures[group_key] is not None:
+                    scheduler.set_pending(storage_keys[i], (late_group_futures[group_key], storage_sources[i]))
+        # Keep metrics sampled on this cycle in history
+        if history is not None:
+            for result in list(instance_results.values()) + list(done_storage_results.values()):
+                history.append_result(start_time, result)
+        if archive is not None:
+            if not archive.append_results(start_time, list(instance_results.values()) +
+                                          list(done_storage_results.values())):
+                logger.warning("Archive writer late, results of this cycle not archived")
+        stale_status = {InstanceProp.STATE: InstanceState.STALE, InstanceProp.LAST_SEEN: None}
+        instance_results = gather_target_results(instances, instance_keys, instance_results, scheduler, settings,
+                                                 cycle_time, {**get_empty_instance_metrics(logger), **stale_status})
+        storage_results = gather_target_results(storages, storage_keys, done_storage_results, scheduler, settings,
+                                                cycle_time, {**parse_df_line(None, logger), **stale_status})
         # Add metadata
         logger.info(f"Generate metadata")
-        metadata = generate_metadata(start_time)
-        logger.info(f">> {metadata}")
+        metadata = generate_metadata(start_time, probe_stats.close(), get_next_snapshot_version(out_json_path))
+        logger.info(f">> {metadata[MetaProp.PROCESS_TIMESTAMP]} ({metadata[MetaProp.PROCESS_TIMEDELTA]}), "
+                    f"slowest probes: {metadata[MetaProp.PROBES]['slowest'][:3]}")
         final_results = {
             MainProp.METADATA: metadata,
             MainProp.INSTANCES: instance_results,
             MainProp.STORAGES: storage_results,
         }
         # Write results
-        logger.info(f"Write in JSON")
-        write_json(out_json_path, final_results)
+        if out_json_path is not None:
+            logger.info(f"Write in JSON (version {metadata[MetaProp.VERSION]})")
+            write_json(out_json_path, final_results, compact=settings[SettingsProp.COMPACT_JSON])
+        return final_results
     except Exception as e:
         logger.exception(e)
         raise
 
 
-def wrap_command_for_remote_ip(cmd, ip, ssh_user=None):
+def monitor_all_threads(instances, instances_count, storage_groups, settings, logger, deadline=None, jitter=0.,
+                        probe_stats=None):
+    """Monitor instances ({index: instance}) and storage hosts in parallel threads, until deadline (monotonic time)
+
+    Starts are spread over jitter seconds. Return results of instances and storage hosts done before the deadline,
+    then futures of late ones.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings[SettingsProp.WORKERS])
+    # Note: storages have their own lane, so that hung mounts do not hold instance workers
+    storage_executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings[SettingsProp.WORKERS])
+    try:
+        # Submit each task at its own random start time
+        tasks = [(random.uniform(0, jitter), MainProp.INSTANCES, i) for i in instances] \
+            + [(random.uniform(0, jitter), MainProp.STORAGES, key) for key in storage_groups]
+        start_time = time.monotonic()
+        instance_futures = {}
+        group_futures = {}
+        for delay, kind, key in sorted(tasks):
+            time.sleep(max(start_time + delay - time.monotonic(), 0))
+            if kind == MainProp.INSTANCES:
+                instance_futures[key] = executor.submit(
+                    monitor_instance, instances[key], f"[{key + 1}/{instances_count}]", settings, logger, probe_stats)
+            else:
+                group_futures[key] = storage_executor.submit(
+                    monitor_storage_group, *key, storage_groups[key], logger, probe_stats)
+        # Wait until deadline
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        concurrent.futures.wait([*instance_futures.values(), *group_futures.values()], timeout=timeout)
+    finally:
+        # Late tasks keep running in background
+        executor.shutdown(wait=False)
+        storage_executor.shutdown(wait=False)
+    return {i: future.result() for i, future in instance_futures.items() if future.done()}, \
+        {key: future.result() for key, future in group_futures.items() if future.done()}, \
+        {i: future for i, future in instance_futures.items() if not future.done()}, \
+        {key: future for key, future in group_futures.items() if not future.done()}
+
+
+def get_target_key(kind, target):
+    # Identify an instance or storage from one cycle to the other
+    return kind, target[InstanceProp.NAME], target[InstanceProp.IP], target.get(InstanceProp.DISK_PATH)
+
+
+def get_target_interval(target, settings, scheduler, result=None):
+    """Get sampling interval of an instance or storage: its own one, else its group one, else the default one
+
+    Instances and storages in a warning or critical state (given their result) get the priority interval, if any.
+    """
+    interval = target.get(InstanceProp.INTERVAL) \
+        or settings[SettingsProp.GROUP_INTERVALS].get(target.get(InstanceProp.GROUP)) \
+        or scheduler.default_interval
+    if result is not None and settings[SettingsProp.PRIORITY_INTERVAL] and is_alerting(result):
+        interval = min(interval, settings[SettingsProp.PRIORITY_INTERVAL])
+    return interval
+
+
+def adopt_late_results(scheduler, targets, keys, settings, logger):
+    """Get results of instances or storages late on previous cycles, once done, as {index: (storage source, result)}:
+    instance result (no storage source), or results of the storage host (to be processed as fresh ones)
+
+    Adopted instances and storages are not due again until their next interval.
+    """
+    now = time.monotonic()
+    adopted_results = {}
+    for i, (target, key) in enumerate(zip(targets, keys)):
+        pending = scheduler.pop_pending(key)
+        if pending is None:
+            continue
+        future, storage_source = pending
+        if not future.done():
+            scheduler.set_pending(key, pending)
+            continue
+        adopted_results[i] = storage_source, future.result()
+        result = target.copy()
+        if storage_source is None:
+            # Instance
+            result = future.result()
+        else:
+            # Storage, from its storage host results
+            result.update(future.result()[storage_source[2]])
+        logger.info(f"{target[InstanceProp.NAME]} ({target[InstanceProp.IP]}) late result adopted")
+        scheduler.set_result(key, result, get_target_interval(target, settings, scheduler, result), now)
+    return adopted_results
+
+
+def gather_target_results(targets, keys, results, scheduler, settings, cycle_time, empty_metrics):
+    """Get results of instances or storages in input order: fresh result ({index: result}), else carried over one
+
+    Without any result yet, metrics are unknown (empty_metrics).
+    """
+    gathered_results = []
+    for i, (target, key) in enumerate(zip(targets, keys)):
+        if i in results:
+            result = results[i]
+            if scheduler is not None:
+                scheduler.set_result(key, result, get_target_interval(target, settings, scheduler, result),
+                                     cycle_time)
+        else:
+            result = scheduler.get_result(key) or {**target, **empty_metrics}
+        gathered_results.append(result)
+    return gathered_results
+
+
+def get_empty_instance_metrics(logger):
+    # Same metrics as the probes, all unknown
+    result = {}
+    for parser in [parse_nproc_output, parse_load_output, parse_free_output, parse_df_output,
+                   functools.partial(parse_net_counters_output, ip=None, interface=None), parse_uptime_output,
+                   parse_usage_memo_output]:
+        result.update(parser(None, logger))
+    return result
+
+
+def get_monitor_settings(json_data, overrides):
+    # Priority: explicit values (command line), then input JSON settings, then defaults
+    settings = DEFAULT_MONITOR_SETTINGS.copy()
+    settings.update(json_data.get(SettingsProp.SETTINGS) or {})
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    # Checkpoint
+    if settings[SettingsProp.WORKERS] <= 0:
+        raise RuntimeError(f"Invalid workers count: {settings[SettingsProp.WORKERS]}")
+    if settings[SettingsProp.ENGINE] not in [ENGINE_THREADS, ENGINE_ASYNCIO]:
+        raise RuntimeError(f"Invalid engine: {settings[SettingsProp.ENGINE]}")
+    if not 0 <= settings[SettingsProp.JITTER] < 1:
+        raise RuntimeError(f"Invalid jitter (fraction of tick): {settings[SettingsProp.JITTER]}")
+    for key in [SettingsProp.PRIORITY_INTERVAL, SettingsProp.DEADLINE]:
+        if settings[key] is not None and settings[key] <= 0:
+            raise RuntimeError(f"Invalid {key}: {settings[key]}")
+    return settings
+
+
+def monitor_instance(instance, label, settings, logger, probe_stats=None):
+    name = instance[InstanceProp.NAME]
+    ip = instance[InstanceProp.IP]
+    ssh_user = instance[InstanceProp.USER]
+    home_disk_path = "/"
+    net_interface = instance[InstanceProp.NET_INTERFACE]
+    logger.info(f"{label} {name} ({ip})")
+    result = instance.copy()
+    if ip in LOCALHOST_IPS:
+        # Instance running the monitor, no need for any command
+        result.update(get_timed_local_instance_metrics(ip, home_disk_path, net_interface, logger, probe_stats))
+        result.update(update_host_status(ip, [], logger))
+    elif not CIRCUIT_BREAKER.allow(ip, logger):
+        # Unreachable, skipped until its backoff is over
+        result.update(get_empty_instance_metrics(logger))
+        result.update(get_unreachable_status(ip))
+    else:
+        probes = get_instance_probes(ip, home_disk_path, net_interface)
+        if settings[SettingsProp.BATCH_PROBE]:
+            # All probes at once
+            cmd_output = run_command(create_batched_script(probes), ip, ssh_user)
+            cmd_outputs = split_batched_command_output(cmd_output, probes, ip, ssh_user, probe_stats)
+        else:
+            # One probe after the other (except cached ones)
+            cmd_outputs = run_probes(probes, ip, ssh_user)
+        result.update(process_probe_outputs(ip, probes, cmd_outputs, logger, probe_stats))
+        result.update(update_host_status(ip, cmd_outputs, logger))
+    logger.info(f">> {result}")
+    return result
+
+
+def get_timed_local_instance_metrics(ip, home_disk_path, net_interface, logger, probe_stats=None):
+    start_time = time.perf_counter()
+    result = get_local_instance_metrics(home_disk_path, net_interface, logger)
+    if probe_stats is not None:
+        probe_stats.record(ip, "local", "ok", run_time=time.perf_counter() - start_time)
+    return result
+
+
+def run_probes(probes, ip, ssh_user):
+    """Run probes one after the other (None output for cached ones), skipping the remaining ones (None output as well)
+    after a connection failure"""
+    cmd_outputs = []
+    for _, cmd, _ in probes:
+        if cmd is None or any(is_connection_failure(cmd_output) for cmd_output in cmd_outputs):
+            cmd_outputs.append(None)
+        else:
+            cmd_outputs.append(run_command(cmd, ip, ssh_user))
+    return cmd_outputs
+
+
+def is_connection_failure(cmd_output):
+    # ssh error
+    return cmd_output is not None and cmd_output.returncode == 255
+
+
+def is_interrupted(cmd_output):
+    # ssh error or timeout
+    return is_connection_failure(cmd_output) or (cmd_output is not None and
+                                                 cmd_output.returncode in TIMEOUT_RETURNCODES)
+
+
+def update_host_status(ip, cmd_outputs, logger):
+    """Track connection failures of a host from its command outputs (None for cached or skipped commands), and get
+    its state"""
+    if any(is_connection_failure(cmd_output) for cmd_output in cmd_outputs):
+        CIRCUIT_BREAKER.record_failure(ip, logger)
+        return get_unreachable_status(ip)
+    CIRCUIT_BREAKER.record_success(ip)
+    if any(cmd_output is not None and cmd_output.returncode != 0 for cmd_output in cmd_outputs):
+        state = InstanceState.ERROR
+    else:
+        state = InstanceState.OK
+    return {
+        InstanceProp.STATE: state,
+        InstanceProp.LAST_SEEN: CIRCUIT_BREAKER.get_last_seen(ip),
+    }
+
+
+def get_unreachable_status(ip):
+    return {
+        InstanceProp.STATE: InstanceState.UNREACHABLE,
+        InstanceProp.LAST_SEEN: CIRCUIT_BREAKER.get_last_seen(ip),
+    }
+
+
+def get_storage_queries(storages, logger, probe_stats=None):
+    """Plan storage queries, so that each host gets a single df command and each volume a single query per cycle
+
+    Storages found on previous cycles to share their volume (same network export, or same device on a host) with
+    another storage reuse its metrics, except once per STORAGE_VOLUME_TTL to notice remounts.
+    Quarantined storages (hung mounts) are not queried.
+    Return disk paths to query per (ip, user), and the (ip, user, disk_path) query giving metrics of each storage.
+    """
+    storage_groups = {}
+    storage_sources = []
+    volume_sources = {}
+    now = time.monotonic()
+    for storage in storages:
+        ip = storage[InstanceProp.IP]
+        ssh_user = storage[InstanceProp.USER]
+        disk_path = storage[InstanceProp.DISK_PATH]
+        source = (ip, ssh_user, disk_path)
+        volume, query_time = STORAGE_VOLUMES.get((ip, disk_path), (None, None))
+        if volume is not None:
+            if volume in volume_sources and now - query_time < STORAGE_VOLUME_TTL:
+                # Same volume as a storage already queried
+                source = volume_sources[volume]
+            else:
+                volume_sources.setdefault(volume, source)
+        storage_sources.append(source)
+        if is_storage_quarantined(source, logger, probe_stats):
+            continue
+        disk_paths = storage_groups.setdefault(source[:2], [])
+        if source[2] not in disk_paths:
+            disk_paths.append(source[2])
+    return storage_groups, storage_sources
+
+
+def get_storage_volume(ip, file_system):
+    """Get volume identifier of a file system: network export (ex: 192.168.10.225:/projets), or device of a host
+
+    None when storages on this file system cannot be told to share the same volume (ex: tmpfs)
+    """
+    if file_system is None:
+        return None
+    if file_system.startswith("//") or ":" in file_system:
+        # Network export, whatever the host mounting it
+        return file_system.rstrip("/")
+    if file_system.startswith("/dev/"):
+        # Device, on this host only
+        return f"{ip}:{file_system}"
+    return None
+
+
+def monitor_storage_group(ip, ssh_user, disk_paths, logger, probe_stats=None):
+    """Get disk space usage metrics of several paths of a host, as {disk_path: metrics}
+
+    Note: local storages are queried with df as well, since a hung mount would block the monitor process itself.
+    """
+    logger.info(f"Storages of {ip}: {', '.join(disk_paths)}")
+    if ip not in LOCALHOST_IPS and not CIRCUIT_BREAKER.allow(ip, logger):
+        # Unreachable, skipped until its backoff is over
+        return {disk_path: {**parse_df_line(None, logger), InstanceProp.STATE: InstanceState.UNREACHABLE}
+                for disk_path in disk_paths}
+    cmd_output = run_storage_df(ip, ssh_user, disk_paths, probe_stats)
+    results = process_storage_df_output(cmd_output, disk_paths, logger)
+    if results is None:
+        # At least one path failed or hung, query each path on its own so that it only voids its own metrics
+        # Note: all at once, so that several hung mounts cost a single timeout (as with asyncio engine)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(disk_paths)) as path_executor:
+            cmd_outputs = list(path_executor.map(
+                lambda disk_path: run_storage_df(ip, ssh_user, [disk_path], probe_stats), disk_paths))
+        results = {}
+        for disk_path, path_cmd_output in zip(disk_paths, cmd_outputs):
+            results.update(process_storage_df_output(path_cmd_output, [disk_path], logger))
+    update_host_status(ip, [cmd_output], logger)
+    return results
+
+
+def run_storage_df(ip, ssh_user, disk_paths, probe_stats=None):
+    cmd = STORAGE_DF_CMD.format(timeout=STORAGE_TIMEOUT, disk_paths=shlex.join(disk_paths))
+    # Short margin for ssh connection on top of remote deadline
+    cmd_output = run_command(cmd, ip, ssh_user, timeout=STORAGE_TIMEOUT + 2)
+    record_probe(probe_stats, ip, "storage_df", cmd_output)
+    return cmd_output
+
+
+def collect_storage_results(storages, storage_sources, group_results, logger):
+    """Get storage results in input order, from metrics of their source query, and remember volumes of storages
+
+    Quarantined storages (without source query result) get their last known metrics, with a stale state.
+    """
+    storage_results = []
+    now = time.monotonic()
+    for i, (storage, source) in enumerate(zip(storages, storage_sources), start=1):
+        ip = storage[InstanceProp.IP]
+        ssh_user = storage[InstanceProp.USER]
+        disk_path = storage[InstanceProp.DISK_PATH]
+        result = storage.copy()
+        if source[:2] in group_results and source[2] in group_results[source[:2]]:
+            result.update(group_results[source[:2]][source[2]])
+        else:
+            result.update(parse_df_line(None, logger))
+            result.update({InstanceProp.STATE: InstanceState.STALE})
+        if result[InstanceProp.STATE] == InstanceState.STALE:
+            # Hung mount
+            result.update(LAST_STORAGE_METRICS.get((ip, disk_path), {}))
+            logger.info(f"[{i}/{len(storages)}] {storage[InstanceProp.NAME]} ({ip} - {disk_path}), stale")
+        elif source == (ip, ssh_user, disk_path):
+            logger.info(f"[{i}/{len(storages)}] {storage[InstanceProp.NAME]} ({ip} - {disk_path})")
+            volume = get_storage_volume(ip, result[InstanceProp.DISK_FILE_SYSTEM])
+            STORAGE_VOLUMES[(ip, disk_path)] = (volume, now)
+        else:
+            logger.info(f"[{i}/{len(storages)}] {storage[InstanceProp.NAME]} ({ip} - {disk_path}), "
+                        f"same volume as {source[0]} - {source[2]}")
+        if result[InstanceProp.STATE] == InstanceState.OK:
+            LAST_STORAGE_METRICS[(ip, disk_path)] = {key: result[key] for key in parse_df_line(None, logger).keys()}
+        result.update({InstanceProp.LAST_SEEN: CIRCUIT_BREAKER.get_last_seen(ip)})
+        logger.info(f">> {result}")
+        storage_results.append(result)
+    return storage_results
+
+
+def is_storage_quarantined(source, logger, probe_stats=None):
+    """Check whether a storage (ip, user, disk_path) is still quarantined, releasing it once its re-probe succeeded"""
+    future = STORAGE_QUARANTINE.get(source)
+    if future is None:
+        return False
+    if future.done():
+        if future.exception() is None and future.result()[InstanceProp.STATE] != InstanceState.STALE:
+            logger.info(f"Storage {source[0]} - {source[2]} responds again, released from quarantine")
+            del STORAGE_QUARANTINE[source]
+            return False
+        # Still hung, re-probe again
+        STORAGE_QUARANTINE[source] = submit_storage_reprobe(source, logger, probe_stats)
+    return True
+
+
+def update_storage_quarantine(storages, storage_results, logger, probe_stats=None):
+    # Quarantine storages hung on this cycle, re-probing them in background instead of blocking next cycles
+    for storage, result in zip(storages, storage_results):
+        source = (storage[InstanceProp.IP], storage[InstanceProp.USER], storage[InstanceProp.DISK_PATH])
+        if result[InstanceProp.STATE] == InstanceState.STALE and source not in STORAGE_QUARANTINE:
+            logger.warning(f"Storage {source[0]} - {source[2]} hung, quarantined")
+            STORAGE_QUARANTINE[source] = submit_storage_reprobe(source, logger, probe_stats)
+
+
+def submit_storage_reprobe(source, logger, probe_stats=None):
+    # Note: timed within the cycle submitting it, if done before its end
+    ip, ssh_user, disk_path = source
+    return STORAGE_REPROBE_EXECUTOR.submit(lambda: process_storage_df_output(
+        run_storage_df(ip, ssh_user, [disk_path], probe_stats), [disk_path], logger)[disk_path])
+
+
+def wrap_command_for_remote_ip(cmd, ip, ssh_user=None, timeout=SSH_TIMEOUT):
     if ip in LOCALHOST_IPS:
         # Localhost, no need to use ssh
         return cmd
     else:
-        # Remote instance, Send command though ssh
-        if ssh_user is None:
-            ssh_dst = f"{ip}"
-        else:
-            ssh_dst = f"{ssh_user}@{ip}"
-        return f"timeout {SSH_TIMEOUT} ssh {ssh_dst} {cmd}"
+        # Remote instance, Send command though ssh (killed if it ignores the termination signal)
+        return f"timeout -k 2 {timeout} {shlex.join(get_ssh_args(ip, ssh_user))} {shlex.quote(cmd)}"
+
+
+def get_ssh_args(ip, ssh_user=None):
+    # Reuse pooled master connection, if any
+    ssh_options = [] if SSH_POOL is None else SSH_POOL.get_ssh_options(ip, ssh_user)
+    return ["ssh", "-o", f"ConnectTimeout={SSH_CONNECT_TIMEOUT}", *ssh_options, get_ssh_destination(ip, ssh_user)]
+
+
+def run_command(cmd, ip, ssh_user, timeout=SSH_TIMEOUT):
+    """Launch command, typically through ssh
+
+    The command output gets its spawn time (process creation) and run time (from spawn to exit) as attributes.
+    """
+    cmd_line = wrap_command_for_remote_ip(cmd, ip, ssh_user, timeout)
+    start_time = time.perf_counter()
+    with subprocess.Popen(cmd_line, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+        spawn_time = time.perf_counter()
+        stdout, stderr = process.communicate()
+    cmd_output = subprocess.CompletedProcess(args=cmd_line, returncode=process.returncode, stdout=stdout, stderr=stderr)
+    cmd_output.spawn_time = spawn_time - start_time
+    cmd_output.run_time = time.perf_counter() - spawn_time
+    if cmd_output.returncode == 255 and SSH_POOL is not None and ip not in LOCALHOST_IPS:
+        # ssh error, check pooled master connection before next use
+        SSH_POOL.invalidate(ip, ssh_user)
+    return cmd_output
+
+
+def get_command_status(cmd_output):
+    # Probe outcome, see probe_stats.PROBE_STATUSES
+    if cmd_output.returncode == 0:
+        return "ok"
+    elif cmd_output.returncode in TIMEOUT_RETURNCODES:
+        return "timeout"
+    elif is_connection_failure(cmd_output):
+        return "unreachable"
+    return "error"
+
+
+def record_probe(probe_stats, ip, name, cmd_output, parse_time=0.):
+    # Command timings, if any (see run_command), in probe timings of the cycle (if any)
+    if probe_stats is None:
+        return
+    probe_stats.record(ip, name, get_command_status(cmd_output), spawn_time=getattr(cmd_output, "spawn_time", 0.),
+                       run_time=getattr(cmd_output, "run_time", 0.), parse_time=parse_time)
+
+
+def get_command_stdout(cmd_output, logger):
+    """Get command standard output as text, or None if the command failed (error is logged)"""
+    if cmd_output.returncode == 0:
+        # Success
+        return cmd_output.stdout.decode()
+    elif cmd_output.returncode in TIMEOUT_RETURNCODES:
+        # Timeout
+        logger.error(f"Timeout running command '{cmd_output.args}'")
+    else:
+        # Fail
+        logger.error(f"Error running command '{cmd_output.args}' :\n{cmd_output.stderr.decode().strip()}")
+    return None
 
 
-def get_nproc_metrics(ip, ssh_user, logger):
-    """Get cpu count with nproc command
+def parse_nproc_output(cmd_stdout, logger):
+    """Get cpu count from nproc command output
 
     Raw command output example:
     80
     """
-    # Launch command, typically through ssh
-    cmd = "nproc"
-    cmd_line = wrap_command_for_remote_ip(cmd, ip, ssh_user)
-    cmd_output = subprocess.run(cmd_line, shell=True, capture_output=True)
-    # Process command output
     result = {InstanceProp.CPU_COUNT: None}
-    if cmd_output.returncode == 0:
-        # Success
-        raw_lines = cmd_output.stdout.decode().strip().split("\n")
+    if cmd_stdout is not None:
+        raw_lines = cmd_stdout.strip().split("\n")
         # -- Extract metric from first and only line
         regex_result = re.match(r'(\d+)', raw_lines[0])
         if regex_result:
             result.update({InstanceProp.CPU_COUNT: int(regex_result.group(1))})
         else:
             logger.error(f"Regex search failed on '{raw_lines[0]}'")
-    elif cmd_output.returncode == 124:
-        # Timeout
-        logger.error(f"Timeout running command '{cmd_line}'")
-    else:
-        # Fail
-        logger.error(f"Error running command '{cmd_line}' :\n{cmd_output.stderr.decode().strip()}")
     return result
 
 
-def get_top_metrics(ip, ssh_user, logger):
-    """Get load_average metrics with top command
+def parse_load_output(cmd_stdout, logger):
+    """Get load_average metrics from /proc/loadavg, or from top command output if not available
+
+    Raw command output example:
+    12.09 12.26 15.26 11/809 1192691
+    """
+    if cmd_stdout is not None:
+        # -- Extract metrics from 1st line, /proc/loadavg format
+        regex_result = re.match(r'([\d.]+) ([\d.]+) ([\d.]+) \d+/\d+', cmd_stdout.strip())
+        if regex_result:
+            return {
+                InstanceProp.LOAD_AVERAGE_1: float(regex_result.group(1)),
+                InstanceProp.LOAD_AVERAGE_5: float(regex_result.group(2)),
+                InstanceProp.LOAD_AVERAGE_15: float(regex_result.group(3)),
+            }
+    # Fallback on top output format
+    return parse_top_output(cmd_stdout, logger)
+
+
+def parse_top_output(cmd_stdout, logger):
+    """Get load_average metrics from top command output
 
     Raw command output example:
     top - 09:20:25 up 3 days,  1:58,  0 users,  load average: 12,09, 12,26, 15,26
@@ -160,19 +762,13 @@ def get_top_metrics(ip, ssh_user, logger):
     1192626 rdteam    20   0  436392 140812  57528 R 100,0   0,0   0:25.27 otbAppl+
     1192691 rdteam    20   0  435700 136532  57556 R 100,0   0,0   0:21.75 otbAppl+
     """
-    # Launch command, typically through ssh
-    cmd = "top -b -n1 -i"
-    cmd_line = wrap_command_for_remote_ip(cmd, ip, ssh_user)
-    cmd_output = subprocess.run(cmd_line, shell=True, capture_output=True)
-    # Process command output
     result = {
         InstanceProp.LOAD_AVERAGE_1: None,
         InstanceProp.LOAD_AVERAGE_5: None,
         InstanceProp.LOAD_AVERAGE_15: None,
     }
-    if cmd_output.returncode == 0:
-        # Success
-        raw_lines = cmd_output.stdout.decode().strip().split("\n")
+    if cmd_stdout is not None:
+        raw_lines = cmd_stdout.strip().split("\n")
         # -- Extract metrics from 1st line
         regex_result = re.search(r'load average: (.+), (.+), (.+)', raw_lines[0])
         if regex_result:
@@ -186,35 +782,23 @@ def get_top_metrics(ip, ssh_user, logger):
             })
         else:
             logger.error(f"Regex search failed on '{raw_lines[0]}'")
-    elif cmd_output.returncode == 124:
-        # Timeout
-        logger.error(f"Timeout running command '{cmd_line}'")
-    else:
-        # Fail
-        logger.error(f"Error running command '{cmd_line}' :\n{cmd_output.stderr.decode().strip()}")
     return result
 
 
-def get_free_metrics(ip, ssh_user, logger):
-    """Get memory usage (RAM) metrics with free command
+def parse_free_output(cmd_stdout, logger):
+    """Get memory usage (RAM) metrics from free command output
 
     Raw command output example:
     total        used        free      shared  buff/cache   available
     Mem:       528221324     2856272   308751440        5476   216613612   521607216
     Swap:        8388604      130048     8258556
     """
-    # Launch command, typically through ssh
-    cmd = "free"
-    cmd_line = wrap_command_for_remote_ip(cmd, ip, ssh_user)
-    cmd_output = subprocess.run(cmd_line, shell=True, capture_output=True)
-    # Process command output
     result = {
         InstanceProp.MEMORY_TOTAL: None,
         InstanceProp.MEMORY_USED: None,
     }
-    if cmd_output.returncode == 0:
-        # Success
-        raw_lines = cmd_output.stdout.decode().strip().split("\n")
+    if cmd_stdout is not None:
+        raw_lines = cmd_stdout.strip().split("\n")
         # -- Extract metrics from 2nd line
         regex_result = re.match(r'Mem:\s+(\d+)\s+(\d+)', raw_lines[1])
         if regex_result:
@@ -224,38 +808,32 @@ def get_free_metrics(ip, ssh_user, logger):
             })
         else:
             logger.error(f"Regex search failed on '{raw_lines[1]}'")
-    elif cmd_output.returncode == 124:
-        # Timeout
-        logger.error(f"Timeout running command '{cmd_line}'")
-    else:
-        # Fail
-        logger.error(f"Error running command '{cmd_line}' :\n{cmd_output.stderr.decode().strip()}")
     return result
 
 
-def get_df_metrics(ip, disk_path, ssh_user, logger):
-    """Get disk space usage metrics with df command
+def parse_df_output(cmd_stdout, logger):
+    """Get disk space usage metrics from df command output
 
     Raw command output example:
     Filesystem                        1K-blocks     Used Available Use% Mounted on
     /dev/mapper/ubuntu--vg-ubuntu--lv 957150424 24655784 883800368   3% /
     """
-    # Launch command, typically through ssh
-    cmd = f"df {disk_path}"
-    cmd_line = wrap_command_for_remote_ip(cmd, ip, ssh_user)
-    cmd_output = subprocess.run(cmd_line, shell=True, capture_output=True)
-    # Process command output
+    if cmd_stdout is None:
+        return parse_df_line(None, logger)
+    raw_lines = cmd_stdout.strip().split("\n")
+    # -- Extract metrics from 2nd line
+    return parse_df_line(raw_lines[1], logger)
+
+
+def parse_df_line(line, logger):
     result = {
         InstanceProp.DISK_FILE_SYSTEM: None,
         InstanceProp.DISK_SPACE_TOTAL: None,
         InstanceProp.DISK_SPACE_USED: None,
         InstanceProp.DISK_SPACE_AVAILABLE: None,
     }
-    if cmd_output.returncode == 0:
-        # Success
-        raw_lines = cmd_output.stdout.decode().strip().split("\n")
-        # -- Extract metrics from 2nd line
-        regex_result = re.match(r'(\S+)\s+(\d+)\s*(\d+)\s*(\d+)\s*(\d+)%', raw_lines[1])
+    if line is not None:
+        regex_result = re.match(r'(\S+)\s+(\d+)\s*(\d+)\s*(\d+)\s*(\d+)%', line)
         if regex_result:
             result.update({
                 InstanceProp.DISK_FILE_SYSTEM: regex_result.group(1),
@@ -264,180 +842,480 @@ def get_df_metrics(ip, disk_path, ssh_user, logger):
                 InstanceProp.DISK_SPACE_AVAILABLE: int(regex_result.group(4)),
             })
         else:
-            logger.error(f"Regex search failed on '{raw_lines[1]}'")
-    elif cmd_output.returncode == 124:
-        # Timeout
-        logger.error(f"Timeout running command '{cmd_line}'")
-    else:
-        # Fail
-        logger.error(f"Error running command '{cmd_line}' :\n{cmd_output.stderr.decode().strip()}")
+            logger.error(f"Regex search failed on '{line}'")
     return result
 
 
-def get_iftop_metrics(ip, interface, ssh_user, logger):
-    """Get network usage metrics through given interface with iftop command
+def process_storage_df_output(cmd_output, disk_paths, logger):
+    """Get {disk_path: metrics} from a storage df command output (POSIX format, one line per path)
 
+    None when several paths were queried and df failed or hung on some of them: its line is then missing and
+    the other lines cannot be matched to their path.
     Raw command output example:
-    interface: ens4
-    IP address is: 192.168.10.107
-    MAC address is: 04:d9:f5:13:8e:e1
-    Listening on ens4
-       # Host name (port/service if enabled)            last 2s   last 10s   last 40s cumulative
-    --------------------------------------------------------------------------------------------
-       1 192.168.10.107                           =>     13,0Kb     13,0Kb     13,0Kb     3,25KB
-         192.168.10.205                           <=     40,4Kb     40,4Kb     40,4Kb     10,1KB
-       2 239.255.255.250                          =>         0b         0b         0b         0B
-         192.168.10.45                            <=       812b       812b       812b       203B
-    --------------------------------------------------------------------------------------------
-    Total send rate:                                     13,0Kb     13,0Kb     13,0Kb
-    Total receive rate:                                  41,2Kb     41,2Kb     41,2Kb
-    Total send and receive rate:                         54,2Kb     54,2Kb     54,2Kb
-    --------------------------------------------------------------------------------------------
-    Peak rate (sent/received/total):                     13,0Kb     41,1Kb     54,1Kb
-    Cumulative (sent/received/total):                    3,25KB     10,3KB     13,5KB
-    ============================================================================================
+    Filesystem                  1024-blocks        Used   Available Capacity Mounted on
+    //192.168.10.206/datacenter 82465199988 67438837112 15026362876      82% /mnt/datacenter
+    192.168.10.225:/projets/    30601641984 22277762048  8323879936      73% /mnt/projets
+    """
+    if cmd_output.returncode not in [0, 255] and len(disk_paths) > 1:
+        return None
+    if cmd_output.returncode in TIMEOUT_RETURNCODES:
+        # Hung mount
+        logger.error(f"Timeout running command '{cmd_output.args}'")
+        state = InstanceState.STALE
+    elif is_connection_failure(cmd_output):
+        logger.error(f"Error running command '{cmd_output.args}' :\n{cmd_output.stderr.decode().strip()}")
+        state = InstanceState.UNREACHABLE
+    else:
+        state = InstanceState.OK if cmd_output.returncode == 0 else InstanceState.ERROR
+    results = parse_multi_df_output(get_command_stdout(cmd_output, logger) if state == InstanceState.OK else None,
+                                    disk_paths, logger)
+    for result in results.values():
+        if state == InstanceState.OK and result[InstanceProp.DISK_SPACE_TOTAL] is None:
+            # Unexpected output
+            result.update({InstanceProp.STATE: InstanceState.ERROR})
+        else:
+            result.update({InstanceProp.STATE: state})
+    return results
+
+
+def parse_multi_df_output(cmd_stdout, disk_paths, logger):
+    raw_lines = [] if cmd_stdout is None else cmd_stdout.strip().split("\n")[1:]
+    if cmd_stdout is not None and len(raw_lines) != len(disk_paths):
+        logger.error(f"Expected {len(disk_paths)} lines in df output, got {len(raw_lines)}")
+        cmd_stdout = None
+    if cmd_stdout is None:
+        return {disk_path: parse_df_line(None, logger) for disk_path in disk_paths}
+    # -- Extract metrics from one line per path, after header line
+    return {disk_path: parse_df_line(line, logger) for disk_path, line in zip(disk_paths, raw_lines)}
+
+
+def parse_net_counters_output(cmd_stdout, logger, ip, interface):
+    """Get network usage metrics through given interface, from byte counters variation since previous call
+
+    Raw command output example (sent bytes, then received bytes):
+    1234567
+    91827364
     """
-    # Launch command, typically through ssh
-    cmd = f"iftop -i {interface} -n -t -s 1"
-    cmd_line = wrap_command_for_remote_ip(cmd, ip, ssh_user)
-    cmd_output = subprocess.run(cmd_line, shell=True, capture_output=True)
-    # Process command output
     result = {
         InstanceProp.NET_SEND_RATE: None,
         InstanceProp.NET_RECEIVE_RATE: None,
     }
-    if cmd_output.returncode == 0:
-        # Success
-        raw_lines = cmd_output.stdout.decode().strip().split("\n")
-        target_lines = "\n".join(raw_lines[-7:-5])
-        # -- Extract metrics from 2nd line
-        regex_result = re.match(r'Total send rate:\s+(\S+).*\nTotal receive rate:\s+(\S+)', target_lines)
-        if regex_result:
-            try:
-                # Get rates in bits/s
-                result.update({
-                    InstanceProp.NET_SEND_RATE: convert_iftop_rate_to_bits(regex_result.group(1)),
-                    InstanceProp.NET_RECEIVE_RATE: convert_iftop_rate_to_bits(regex_result.group(2)),
-                })
-            except Exception as e:
-                logger.exception(e)
+    if cmd_stdout is not None:
+        raw_lines = cmd_stdout.strip().split("\n")
+        # -- Extract counters from 1st and 2nd lines
+        if len(raw_lines) == 2 and raw_lines[0].isdigit() and raw_lines[1].isdigit():
+            # Get rates in bits/s
+            result.update(get_net_rates(ip, interface, int(raw_lines[0]), int(raw_lines[1])))
         else:
-            logger.error(f"Regex search failed on '{target_lines}'")
-    elif cmd_output.returncode == 124:
-        # Timeout
-        logger.error(f"Timeout running command '{cmd_line}'")
-    else:
-        # Fail
-        logger.error(f"Error running command '{cmd_line}' :\n{cmd_output.stderr.decode().strip()}")
+            logger.error(f"Unexpected network counters '{raw_lines}'")
     return result
 
 
-def get_uptime_metrics(ip, ssh_user, logger):
-    """Get uptime
+def parse_uptime_output(cmd_stdout, logger):
+    """Get uptime in days
 
     Raw command output example:
     up 2 weeks, 4 days, 11 hours, 58 minutes
     """
-    # Launch command, typically through ssh
-    cmd = "uptime --pretty"
-    cmd_line = wrap_command_for_remote_ip(cmd, ip, ssh_user)
-    cmd_output = subprocess.run(cmd_line, shell=True, capture_output=True)
-    # Process command output
-    result = {InstanceProp.UPTIME: None}
-    if cmd_output.returncode == 0:
-        # Success
-        raw_lines = cmd_output.stdout.decode().strip().split("\n")
-        # -- Extract metric from first and only line
-        regex_result = re.match(r'up (\d+ .*)', raw_lines[0])
-        if regex_result:
-            uptime_days = 0
-            for item in regex_result.group(1).split(","):
-                item_split = item.strip().split(" ")
-                if len(item_split) != 2:
-                    logger.error(f"Unexpected item '{item}' in '{raw_lines[0]}'")
-                    uptime_days = None
-                    break
-                value, unit = int(item_split[0]), item_split[1]
-                if unit in ["week", "weeks"]:
-                    uptime_days += int(value) * 7
-                elif unit in ["day", "days"]:
-                    uptime_days += int(value)
-                elif unit in ["hour", "hours", "minute", "minutes"]:
-                    pass
-                else:
-                    logger.error(f"Unexpected unit '{unit}' in '{raw_lines[0]}'")
-                    uptime_days = None
-                    break
-            result.update({InstanceProp.UPTIME: uptime_days})
-        else:
+    uptime_seconds = parse_uptime_seconds(cmd_stdout, logger)
+    return {InstanceProp.UPTIME: None if uptime_seconds is None else uptime_seconds // 86400}
+
+
+def parse_uptime_seconds(cmd_stdout, logger=None):
+    """Get uptime in seconds (to the minute) from uptime command output, None if unavailable (errors logged if a logger
+    is given)
+    """
+    if cmd_stdout is None:
+        return None
+    raw_lines = cmd_stdout.strip().split("\n")
+    # -- Extract metric from first and only line
+    regex_result = re.match(r'up (\d+ .*)', raw_lines[0])
+    if not regex_result:
+        if logger is not None:
             logger.error(f"Regex search failed on '{raw_lines[0]}'")
-    elif cmd_output.returncode == 124:
-        # Timeout
-        logger.error(f"Timeout running command '{cmd_line}'")
-    else:
-        # Fail
-        logger.error(f"Error running command '{cmd_line}' :\n{cmd_output.stderr.decode().strip()}")
-    return result
+        return None
+    uptime_seconds = 0
+    for item in regex_result.group(1).split(","):
+        item_split = item.strip().split(" ")
+        if len(item_split) != 2 or item_split[1] not in UPTIME_UNITS:
+            if logger is not None:
+                logger.error(f"Unexpected item '{item}' in '{raw_lines[0]}'")
+            return None
+        uptime_seconds += int(item_split[0]) * UPTIME_UNITS[item_split[1]]
+    return uptime_seconds
 
 
-def get_usage_memo(ip, ssh_user, logger):
-    """Get usage memo text from USAGE_MEMO_PATH
+def parse_usage_memo_output(cmd_stdout, logger, ip=None, cached_memo=None):
+    """Get usage memo text from USAGE_MEMO_PATH, preceded by its modification time ("none" if there is no memo file)
 
     Raw command output example:
+    1741095317
     MK
     """
-    # Launch command, typically through ssh
-    cmd = f"cat {USAGE_MEMO_PATH}"
-    cmd_line = wrap_command_for_remote_ip(cmd, ip, ssh_user)
-    cmd_output = subprocess.run(cmd_line, shell=True, capture_output=True)
-    # Process command output
     result = {InstanceProp.USAGE_MEMO: None}
-    if cmd_output.returncode == 0:
-        # Success
-        text = cmd_output.stdout.decode().strip()
+    if cmd_stdout is not None:
+        mtime, _, text = cmd_stdout.partition("\n")
+        mtime = mtime.strip()
+        if cached_memo is not None and cached_memo[0] == mtime:
+            # Unchanged memo, content not sent
+            text = cached_memo[1]
+        elif mtime == NO_USAGE_MEMO_MTIME:
+            # No memo
+            text = None
+            if ip is not None:
+                FACTS_CACHE.set(ip, InstanceProp.USAGE_MEMO, (mtime, text))
+        else:
+            text = text.strip()
+            if ip is not None:
+                FACTS_CACHE.set(ip, InstanceProp.USAGE_MEMO, (mtime, text))
         result.update({InstanceProp.USAGE_MEMO: text})
-    elif cmd_output.returncode == 124:
-        # Timeout
-        logger.error(f"Timeout running command '{cmd_line}'")
+    return result
+
+
+def get_instance_probes(ip, home_disk_path, net_interface):
+    """Get (name, command, output parser) of each instance probe
+
+    The command is None for probes whose metrics are all cached, their parser then returning cached metrics.
+    """
+    # Slow-changing facts
+    cpu_count = FACTS_CACHE.get(ip, InstanceProp.CPU_COUNT)
+    if cpu_count is None:
+        nproc_probe = ("nproc", NPROC_CMD, parse_nproc_output)
     else:
-        # Fail
-        logger.error(f"Error running command '{cmd_line}' :\n{cmd_output.stderr.decode().strip()}")
+        nproc_probe = ("nproc", None, lambda cmd_stdout, logger: {InstanceProp.CPU_COUNT: cpu_count})
+    cached_memo = FACTS_CACHE.get(ip, InstanceProp.USAGE_MEMO)
+    memo_probe = ("usage_memo", USAGE_MEMO_CMD.format(mtime=cached_memo[0] if cached_memo else ""),
+                  functools.partial(parse_usage_memo_output, ip=ip, cached_memo=cached_memo))
+    return [
+        nproc_probe,
+        ("load", LOAD_CMD, parse_load_output),
+        ("free", FREE_CMD, parse_free_output),
+        ("df", DF_CMD.format(disk_path=home_disk_path), parse_df_output),
+        ("net", NET_COUNTERS_CMD.format(interface=net_interface),
+         functools.partial(parse_net_counters_output, ip=ip, interface=net_interface)),
+        ("uptime", UPTIME_CMD, parse_uptime_output),
+        memo_probe,
+    ]
+
+
+def process_probe_outputs(ip, probes, cmd_outputs, logger, probe_stats=None):
+    """Get instance metrics from the output of each probe (None for cached probes), and refresh facts cache
+
+    Cached facts are only invalidated when probing was interrupted (connection failure or timeout), not when a probe
+    merely failed on the instance.
+    """
+    result = {}
+    probe_interrupted = False
+    uptime_seconds = None
+    for (name, cmd, parser), cmd_output in zip(probes, cmd_outputs):
+        if cmd_output is None:
+            # Cached metrics
+            result.update(parser(None, logger))
+        else:
+            start_time = time.perf_counter()
+            probe_interrupted = probe_interrupted or is_interrupted(cmd_output)
+            cmd_stdout = get_command_stdout(cmd_output, logger)
+            result.update(parser(cmd_stdout, logger))
+            if name == "uptime":
+                # Reboot detection to the minute (uptime metric being in days)
+                uptime_seconds = parse_uptime_seconds(cmd_stdout)
+            record_probe(probe_stats, ip, name, cmd_output, parse_time=time.perf_counter() - start_time)
+    # Refresh facts cache
+    if probe_interrupted:
+        FACTS_CACHE.invalidate(ip)
+    elif FACTS_CACHE.check_uptime(ip, uptime_seconds):
+        logger.info(f"{ip} rebooted, cached facts invalidated")
+    else:
+        FACTS_CACHE.set_missing(ip, {InstanceProp.CPU_COUNT: result.get(InstanceProp.CPU_COUNT)})
+    return result
+
+
+def create_batched_script(probes):
+    """Get a single combined command launching all probes at once, hence a single ssh connection
+
+    Each probe output is in its own section of stdout and stderr, delimited by marker lines, the closing one giving the
+    probe return code. Raw command output example:
+    @@BB@@ nproc
+    80
+
+    @@BB@@ nproc 0
+    @@BB@@ free
+                   total        used        free      shared  buff/cache   available
+    Mem:       528221324     2856272   308751440        5476   216613612   521607216
+    Swap:        8388604      130048     8258556
+
+    @@BB@@ free 0
+    ...
+    """
+    # Note: a new line before the closing marker, which must start its own line even if the probe output does not end
+    # with a new line (dropped when splitting)
+    return "; ".join(
+        f"echo {BATCH_MARKER} {name}; echo {BATCH_MARKER} {name} >&2; {cmd}; "
+        f"bb_returncode=$?; echo; echo {BATCH_MARKER} {name} $bb_returncode"
+        for name, cmd, _ in probes if cmd is not None)
+
+
+def split_batched_command_output(cmd_output, probes, ip, ssh_user, probe_stats=None):
+    """Split combined command output into standalone command outputs, one per probe (None for cached probes)
+
+    This way, a failing probe only voids its own metrics.
+    """
+    record_probe(probe_stats, ip, "batch", cmd_output)
+    stdout_sections = split_batched_output(cmd_output.stdout.decode())
+    stderr_sections = split_batched_output(cmd_output.stderr.decode())
+    cmd_outputs = []
+    for name, cmd, _ in probes:
+        if cmd is None:
+            cmd_outputs.append(None)
+            continue
+        returncode, section_stdout = stdout_sections.get(name, (None, ""))
+        _, section_stderr = stderr_sections.get(name, (None, ""))
+        if returncode is None:
+            # Unfinished section: the combined command was interrupted (timeout, ssh failure...)
+            returncode = cmd_output.returncode or 1
+            section_stderr = section_stderr or cmd_output.stderr.decode()
+        cmd_outputs.append(subprocess.CompletedProcess(
+            args=f"{cmd} (batched on {get_ssh_destination(ip, ssh_user)})", returncode=returncode,
+            stdout=section_stdout.encode(), stderr=section_stderr.encode()))
+    return cmd_outputs
+
+
+def split_batched_output(raw_output):
+    """Split combined command output into {section_name: (returncode, text)}
+
+    The return code is None for sections without closing marker line (unfinished or stderr sections)
+    """
+    sections = {}
+    section_name = None
+    section_lines = []
+    for line in raw_output.split("\n"):
+        if line.startswith(f"{BATCH_MARKER} "):
+            items = line.split()
+            if len(items) == 3 and items[1] == section_name:
+                # Closing marker, with return code (after an extra new line)
+                if section_lines and section_lines[-1] == "":
+                    section_lines.pop()
+                sections[section_name] = (int(items[2]), "\n".join(section_lines))
+                section_name = None
+            else:
+                # Opening marker
+                section_name = items[1]
+                section_lines = []
+                sections[section_name] = (None, "")
+        elif section_name is not None:
+            section_lines.append(line)
+            sections[section_name] = (None, "\n".join(section_lines))
+    return sections
+
+
+# -----------------------------------------------------------------------------
+# Asyncio engine
+
+async def monitor_all_async(instances, instances_count, storage_groups, settings, logger, deadline=None,
+                            jitter=0., probe_stats=None):
+    """Monitor instances ({index: instance}) and storage hosts concurrently within a single event loop, until
+    deadline (monotonic time)
+
+    Starts are spread over jitter seconds. Return results of instances and storage hosts done before the deadline,
+    then late ones (cancelled) as {index or key: None}.
+    """
+    # Note: storages have their own lane, so that hung mounts do not hold instance workers
+    semaphore = asyncio.Semaphore(settings[SettingsProp.WORKERS])
+    storage_semaphore = asyncio.Semaphore(settings[SettingsProp.WORKERS])
+    instance_tasks = {
+        i: asyncio.ensure_future(monitor_instance_async(
+            instance, f"[{i + 1}/{instances_count}]", settings, semaphore, logger, random.uniform(0, jitter),
+            probe_stats))
+        for i, instance in instances.items()}
+    group_tasks = {
+        (ip, ssh_user): asyncio.ensure_future(monitor_storage_group_async(
+            ip, ssh_user, disk_paths, storage_semaphore, logger, random.uniform(0, jitter), probe_stats))
+        for (ip, ssh_user), disk_paths in storage_groups.items()}
+    tasks = [*instance_tasks.values(), *group_tasks.values()]
+    if tasks:
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        _, late_tasks = await asyncio.wait(tasks, timeout=timeout)
+        # Cancel late tasks (killing their commands)
+        for task in late_tasks:
+            task.cancel()
+        await asyncio.gather(*late_tasks, return_exceptions=True)
+    return {i: task.result() for i, task in instance_tasks.items() if not task.cancelled()}, \
+        {key: task.result() for key, task in group_tasks.items() if not task.cancelled()}, \
+        {i: None for i, task in instance_tasks.items() if task.cancelled()}, \
+        {key: None for key, task in group_tasks.items() if task.cancelled()}
+
+
+async def monitor_instance_async(instance, label, settings, semaphore, logger, delay=0., probe_stats=None):
+    name = instance[InstanceProp.NAME]
+    ip = instance[InstanceProp.IP]
+    ssh_user = instance[InstanceProp.USER]
+    home_disk_path = "/"
+    net_interface = instance[InstanceProp.NET_INTERFACE]
+    await asyncio.sleep(delay)
+    async with semaphore:
+        logger.info(f"{label} {name} ({ip})")
+        result = instance.copy()
+        if ip in LOCALHOST_IPS:
+            # Instance running the monitor, no need for any command
+            result.update(await asyncio.to_thread(
+                get_timed_local_instance_metrics, ip, home_disk_path, net_interface, logger, probe_stats))
+            result.update(update_host_status(ip, [], logger))
+        elif not await asyncio.to_thread(CIRCUIT_BREAKER.allow, ip, logger):
+            # Unreachable, skipped until its backoff is over
+            result.update(get_empty_instance_metrics(logger))
+            result.update(get_unreachable_status(ip))
+        else:
+            probes = get_instance_probes(ip, home_disk_path, net_interface)
+            if settings[SettingsProp.BATCH_PROBE]:
+                # All probes at once
+                cmd_output = await run_command_async(create_batched_script(probes), ip, ssh_user)
+                cmd_outputs = split_batched_command_output(cmd_output, probes, ip, ssh_user, probe_stats)
+            else:
+                # All probes concurrently (except cached ones), once the first one connected
+                cmd_outputs = await run_probes_async(probes, ip, ssh_user)
+            result.update(process_probe_outputs(ip, probes, cmd_outputs, logger, probe_stats))
+            result.update(update_host_status(ip, cmd_outputs, logger))
+        logger.info(f">> {result}")
     return result
 
 
-def convert_iftop_rate_to_bits(rate_str):
-    # Remove trailing "b" standing for bits
-    if not rate_str.endswith("b"):
-        raise RuntimeError("Expecting value in bits")
-    rate_str = rate_str[:-1]
-    # Ensure decimal separator is "."
-    rate_str = rate_str.replace(",", ".")
-    # Determine factor
-    if rate_str.isnumeric():
-        rate_float = float(rate_str)
-    elif rate_str.endswith("K"):
-        rate_float = float(rate_str[:-1]) * 1024
-    elif rate_str.endswith("M"):
-        rate_float = float(rate_str[:-1]) * 1024 * 1024
-    elif rate_str.endswith("G"):
-        rate_float = float(rate_str[:-1]) * 1024 * 1024 * 1024
-    elif rate_str.endswith("T"):
-        rate_float = float(rate_str[:-1]) * 1024 * 1024 * 1024 * 1024
+async def run_probes_async(probes, ip, ssh_user):
+    """Run first probe, then the other ones concurrently (None output for cached ones), unless the first one failed to
+    connect (None output for skipped ones as well)"""
+    commands = [cmd for _, cmd, _ in probes if cmd is not None]
+    first_cmd_output = await run_command_async(commands[0], ip, ssh_user) if commands else None
+    if is_connection_failure(first_cmd_output):
+        other_cmd_outputs = [None] * (len(commands) - 1)
+    else:
+        other_cmd_outputs = await asyncio.gather(*[run_command_async(cmd, ip, ssh_user) for cmd in commands[1:]])
+    cmd_outputs = iter([first_cmd_output, *other_cmd_outputs])
+    return [None if cmd is None else next(cmd_outputs) for _, cmd, _ in probes]
+
+
+async def monitor_storage_group_async(ip, ssh_user, disk_paths, semaphore, logger, delay=0., probe_stats=None):
+    await asyncio.sleep(delay)
+    async with semaphore:
+        logger.info(f"Storages of {ip}: {', '.join(disk_paths)}")
+        if ip not in LOCALHOST_IPS and not await asyncio.to_thread(CIRCUIT_BREAKER.allow, ip, logger):
+            # Unreachable, skipped until its backoff is over
+            return {disk_path: {**parse_df_line(None, logger), InstanceProp.STATE: InstanceState.UNREACHABLE}
+                    for disk_path in disk_paths}
+        cmd_output = await run_storage_df_async(ip, ssh_user, disk_paths, probe_stats)
+        results = process_storage_df_output(cmd_output, disk_paths, logger)
+        update_host_status(ip, [cmd_output], logger)
+        if results is None:
+            # At least one path failed or hung: query each path on its own
+            cmd_outputs = await asyncio.gather(*[
+                run_storage_df_async(ip, ssh_user, [disk_path], probe_stats) for disk_path in disk_paths])
+            results = {}
+            for disk_path, cmd_output in zip(disk_paths, cmd_outputs):
+                results.update(process_storage_df_output(cmd_output, [disk_path], logger))
+    return results
+
+
+async def run_storage_df_async(ip, ssh_user, disk_paths, probe_stats=None):
+    cmd = STORAGE_DF_CMD.format(timeout=STORAGE_TIMEOUT, disk_paths=shlex.join(disk_paths))
+    cmd_output = await run_command_async(cmd, ip, ssh_user, timeout=STORAGE_TIMEOUT + 2)
+    record_probe(probe_stats, ip, "storage_df", cmd_output)
+    return cmd_output
+
+
+async def run_command_async(cmd, ip, ssh_user, timeout=SSH_TIMEOUT):
+    """Asyncio version of run_command: no intermediate local shell, and native timeout
+
+    On timeout, the whole process group is killed and the return code is 124 (as with timeout command),
+    while the output produced so far is kept. The command output gets its spawn and run times, as with run_command.
+    """
+    # Getting ssh arguments may block while (re)connecting pooled master connection
+    cmd_args = await asyncio.to_thread(get_command_args, cmd, ip, ssh_user)
+    start_time = time.perf_counter()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd_args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, start_new_session=True)
+    except OSError as e:
+        # Ex: command not found, reported like a shell would do
+        return subprocess.CompletedProcess(args=shlex.join(cmd_args), returncode=127, stdout=b"",
+                                           stderr=str(e).encode())
+    spawn_time = time.perf_counter()
+    # Read outputs until EOF, independently of the deadline so that partial outputs are not lost
+    stdout_task = asyncio.ensure_future(process.stdout.read())
+    stderr_task = asyncio.ensure_future(process.stderr.read())
+    try:
+        returncode = await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        # Kill the whole process group (new session), then reap
+        kill_process_group(process.pid)
+        await process.wait()
+        returncode = 124
+    except asyncio.CancelledError:
+        # Cancelled (ex: cycle deadline), kill the whole process group as well, then reap without waiting for
+        # outputs (descendants in their own process group may still hold them)
+        kill_process_group(process.pid)
+        await process.wait()
+        stdout_task.cancel()
+        stderr_task.cancel()
+        await asyncio.gather(stdout_task, stderr_task, return_exceptions=True)
+        raise
+    stdout, stderr = await asyncio.gather(stdout_task, stderr_task)
+    if returncode == 255 and SSH_POOL is not None and ip not in LOCALHOST_IPS:
+        # ssh error, check pooled master connection before next use (may wait for an ongoing reconnection)
+        await asyncio.to_thread(SSH_POOL.invalidate, ip, ssh_user)
+    cmd_output = subprocess.CompletedProcess(args=shlex.join(cmd_args), returncode=returncode, stdout=stdout,
+                                             stderr=stderr)
+    cmd_output.spawn_time = spawn_time - start_time
+    cmd_output.run_time = time.perf_counter() - spawn_time
+    return cmd_output
+
+
+def kill_process_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def get_command_args(cmd, ip, ssh_user=None):
+    """Get command arguments to be executed without intermediate local shell, typically through ssh"""
+    if ip not in LOCALHOST_IPS:
+        # Remote instance, the command is interpreted by the remote shell
+        return [*get_ssh_args(ip, ssh_user), cmd]
+    elif any(char in cmd for char in SHELL_SPECIAL_CHARS):
+        # Localhost, shell syntax (ex: batched probes) still requires a shell
+        return ["sh", "-c", cmd]
     else:
-        raise NotImplementedError("Not supporting network rate > Tb")
-    # To integer
-    return round(rate_float)
+        # Localhost, plain command
+        return shlex.split(cmd)
 
 
-def generate_metadata(start_time):
+def generate_metadata(start_time, probes_summary=None, version=None):
     timestamp = datetime.datetime.now().strftime(DATETIME_FORMAT)
     process_time = datetime.timedelta(seconds=round(time.time() - start_time))
     return {
+        MetaProp.VERSION: version,
         MetaProp.PROCESS_TIMESTAMP: str(timestamp),
         MetaProp.PROCESS_TIMEDELTA: str(process_time),
+        MetaProp.PROBES: probes_summary,
     }
 
 
+def get_next_snapshot_version(out_json_path):
+    """Get version of the next monitoring results, following the last written ones (on first call, the ones of a
+    previous monitor run, if any)
+    """
+    global SNAPSHOT_VERSION
+    if SNAPSHOT_VERSION is None:
+        SNAPSHOT_VERSION = 0
+        if out_json_path is not None:
+            try:
+                SNAPSHOT_VERSION = load_json(out_json_path)[MainProp.METADATA].get(MetaProp.VERSION) or 0
+            except (RuntimeError, ValueError, KeyError, TypeError):
+                # No previous results, or from an older monitor
+                pass
+    SNAPSHOT_VERSION += 1
+    return SNAPSHOT_VERSION
+
+
 if __name__ == "__main__":
     # Handy command line interface (-h for help)
     import argparse
@@ -452,12 +1330,54 @@ if __name__ == "__main__":
                         help='Path to log file (default: %(default)s)')
     parser.add_argument('--period', metavar="N", type=int, default=DEFAULT_MONITOR_PERIOD,
                         help='Repeat monitoring every N seconds (default: %(default)s)')
+    parser.add_argument('--workers', metavar="N", type=int, default=None,
+                        help='Monitor up to N instances and storages in parallel '
+                             f'(default: "workers" of input JSON "settings", else {DEFAULT_MONITOR_WORKERS})')
+    parser.add_argument('--batch_probe', action="store_true", default=None,
+                        help='Retrieve all metrics of an instance with a single combined command (single ssh connection)')
+    parser.add_argument('--engine', choices=[ENGINE_THREADS, ENGINE_ASYNCIO], default=None,
+                        help='Collection engine: parallel threads running shell commands, or a single asyncio '
+                             f'event loop running commands without shell (default: "engine" of input JSON '
+                             f'"settings", else {ENGINE_THREADS})')
+    parser.add_argument('--no_ssh_pool', action="store_true", default=False,
+                        help='Open a new ssh connection for each command, instead of reusing long-lived connections')
+    parser.add_argument('--compact_json', action="store_true", default=None,
+                        help='Write monitoring results without indentation (smaller file, faster to write)')
+    parser.add_argument('--history_dir', metavar="PATH", default=None,
+                        help='Keep history of metrics in ring files of this directory, readable by other processes '
+                             '(default: no history, requires NumPy)')
+    parser.add_argument('--history_capacity', metavar="N", type=int, default=None,
+                        help='Samples kept in history per instance and storage (default: the one of an existing '
+                             'history directory, else 1 day at 10s period)')
+    parser.add_argument('--history_rollups', metavar="TIERS", default=None,
+                        help='Rollup tiers of history, as comma-separated window:retention durations (default: the '
+                             'ones of an existing history directory, else 1m:2d,15m:30d,1h:90d)')
+    parser.add_argument('--archive_db', metavar="PATH", default=None,
+                        help='Archive metrics in this SQLite database, readable by the server (default: none)')
+    parser.add_argument('--archive_retention', metavar="DURATION", default="365d",
+                        help='Remove archived metrics older than that (default: %(default)s)')
     args = parser.parse_args()
 
+    # History (optional, NumPy only needed then)
+    metrics_history = None
+    if args.history_dir:
+        from big_brother.details.history import MetricsHistory, parse_rollup_tiers
+        metrics_history = MetricsHistory(args.history_dir, args.history_capacity,
+                                         rollups=args.history_rollups and parse_rollup_tiers(args.history_rollups),
+                                         period=args.period)
+
     # Go
     monitor_instances_periodically(
         instances_json_path=args.instances_json,
         out_json_path=args.out_json,
         log_path=args.log,
         period=args.period,
+        workers=args.workers,
+        batch_probe=args.batch_probe,
+        engine=args.engine,
+        ssh_pool=not args.no_ssh_pool,
+        compact_json=args.compact_json,
+        history=metrics_history,
+        archive_db_path=args.archive_db,
+        archive_retention=parse_duration(args.archive_retention),
     )
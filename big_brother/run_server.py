@@ -1,15 +1,29 @@
 import os
 import sys
+import gzip
+import json
+import time
+import queue
 import bottle
 import datetime
 import html
+import hashlib
+import threading
+import email.utils
 
 TOP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 [sys.path.append(dir_path) for dir_path in [TOP_DIR] if dir_path not in sys.path]
 
 from big_brother.details.globals import PROJECT_DIR, DEFAULT_MONITORING_JSON_PATH, \
-    MainProp, MetaProp, InstanceProp, DATETIME_FORMAT, USAGE_MEMO_PATH
-from big_brother.details.utils import load_json, get_kib_size_as_human_readable_str
+    MainProp, MetaProp, InstanceProp, InstanceState, DATETIME_FORMAT, USAGE_MEMO_PATH, \
+    LOW_LOAD_PERCENT, MEDIUM_LOAD_PERCENT, HIGH_LOAD_PERCENT, LOW_MEM_PERCENT, MEDIUM_MEM_PERCENT, HIGH_MEM_PERCENT, \
+    LOW_SPACE_PERCENT, MEDIUM_SPACE_PERCENT, HIGH_SPACE_PRECENT
+from big_brother.details.utils import get_kib_size_as_human_readable_str
+from big_brother.details.openmetrics import OPENMETRICS_CONTENT_TYPE, create_openmetrics_text
+from big_brother.details.snapshot_cache import SnapshotCache
+from big_brother.details.broadcaster import Broadcaster
+from big_brother.details.api import query_snapshot, query_history, query_archive
+from big_brother.details.archive import MetricsArchive
 
 
 # Globals
@@ -17,23 +31,28 @@ from big_brother.details.utils import load_json, get_kib_size_as_human_readable_
 APP = bottle.Bottle()
 DATA_JSON_PATH = None
 DEBUG = False
-# --
+# -- Monitoring results and their renderings, kept in memory until the results file changes (or in-memory store of a
+#    monitor running in the same process)
+SNAPSHOT_CACHE = None
+# -- History of metrics written by the monitor (MetricsHistory, optional)
+METRICS_HISTORY = None
+# -- Long-term archive of metrics written by the monitor (MetricsArchive, optional, opened read-only)
+METRICS_ARCHIVE = None
+# -- Live updates (Server-Sent Events) of all clients, fed by a single results watcher
+BROADCASTER = Broadcaster()
+SNAPSHOT_POLL_TIME = 1  # 1s
+EVENTS_KEEPALIVE_TIME = 15  # 15s
+EVENTS_MAX_DURATION = 300  # 5min, then reopened by the browser (so that server threads are recycled)
+EVENTS_RETRY_TIME = 5  # 5s
+MAX_EVENTS_CLIENTS = 64  # Each one holding a server thread
+SERVER_WORKERS = MAX_EVENTS_CLIENTS + 16
+# -- Full page reload, when live updates are not available
 REFRESH_TIME = 60  # 60s
+# -- Responses smaller than that are not worth compressing
+GZIP_MIN_SIZE = 1024  # 1KiB
 # -- Default IO
 DEFAULT_HOST = "192.168.10.132"  # drogon
 DEFAULT_PORT = 1984
-# -- Load average thresholds
-LOW_LOAD_PERCENT = 5
-MEDIUM_LOAD_PERCENT = 75
-HIGH_LOAD_PERCENT = 200
-# -- Memory usage thresholds
-LOW_MEM_PERCENT = 5
-MEDIUM_MEM_PERCENT = 75
-HIGH_MEM_PERCENT = 90
-# -- Disk space usage thresholds
-LOW_SPACE_PERCENT = 5
-MEDIUM_SPACE_PERCENT = 75
-HIGH_SPACE_PRECENT = 90
 # -- Uptime
 LOW_UPTIME = 1
 MEDIUM_UPTIME = 30
@@ -44,11 +63,26 @@ MEDIUM_NET_RATE = 1 * 1024 * 1024  # 1M
 HIGH_NET_RATE = 100 * 1024 * 1024  # 100M
 
 
-def run_server(host, port, data_json_path, debug):
+def run_server(host, port, data_json_path, debug, snapshot_store=None, history=None, archive_db_path=None,
+               archive_segments_dir=None):
+    """Serve monitoring results of a JSON file, or of an in-memory snapshot store (ex: MemorySnapshotStore), along
+    with the history of their metrics if given (MetricsHistory), and their archive database (and its compacted
+    segments) if given
+    """
     # Update app globals
-    global DATA_JSON_PATH, DEBUG
-    DATA_JSON_PATH = os.path.abspath(data_json_path)
+    global DATA_JSON_PATH, DEBUG, SNAPSHOT_CACHE, METRICS_HISTORY, METRICS_ARCHIVE
     DEBUG = debug
+    METRICS_HISTORY = history
+    if archive_db_path is not None:
+        METRICS_ARCHIVE = MetricsArchive(archive_db_path, readonly=True, segments_dir=archive_segments_dir)
+    if snapshot_store is not None:
+        SNAPSHOT_CACHE = snapshot_store
+    else:
+        DATA_JSON_PATH = os.path.abspath(data_json_path)
+        SNAPSHOT_CACHE = SnapshotCache(DATA_JSON_PATH)
+    # Publish live updates
+    threading.Thread(target=watch_snapshots, args=(SNAPSHOT_CACHE, BROADCASTER), name="BBSnapshotWatcher",
+                     daemon=True).start()
     # Run server
     if DEBUG:
         # Development/debug mode, restart at each code change
@@ -56,7 +90,7 @@ def run_server(host, port, data_json_path, debug):
         bottle.run(APP, host=host, port=port, debug=True, reloader=True)
     else:
         # Production mode
-        bottle.run(APP, host=host, port=port, server='paste')
+        bottle.run(APP, host=host, port=port, server='paste', threadpool_workers=SERVER_WORKERS)
 
 
 # -----------------------------------------------------------------------------
@@ -68,9 +102,62 @@ def get_main_page():
     page_title = "BigBrother"
     if DEBUG:
         page_title += " DEBUG"
-    # Load monitoring results
-    data = load_json(DATA_JSON_PATH)
-    return create_html_page(data, page_title)
+    # Monitoring results page, rendered once per results version
+    snapshot = SNAPSHOT_CACHE.get()
+    return create_snapshot_response(snapshot, "html",
+                                    lambda data: create_html_page(data, page_title, snapshot.get_tag()),
+                                    "text/html; charset=UTF-8")
+
+
+@APP.get('/metrics')
+def get_metrics():
+    # OpenMetrics exposition, rendered once per results version
+    snapshot = SNAPSHOT_CACHE.get()
+    return create_snapshot_response(snapshot, "metrics", create_openmetrics_text, OPENMETRICS_CONTENT_TYPE)
+
+
+@APP.get('/api/v1/<kind:re:instances|storages>')
+def get_api_results(kind):
+    snapshot = SNAPSHOT_CACHE.get()
+    query = dict(bottle.request.query.decode().items())
+    try:
+        result = query_snapshot(snapshot, kind, query)
+    except RuntimeError as e:
+        return bottle.HTTPResponse(json.dumps({"error": str(e)}), status=400,
+                                   headers={"Content-Type": "application/json"})
+    # Served from snapshot indexes, not kept: one entity tag per snapshot and query
+    query_digest = hashlib.sha1(bottle.request.query_string.encode()).hexdigest()[:16]
+    return create_snapshot_response(snapshot, f"api-{kind}-{query_digest}",
+                                    lambda data: json.dumps(result, separators=(',', ':')), "application/json",
+                                    cached=False)
+
+
+@APP.get('/api/v1/history')
+def get_api_history():
+    return create_range_query_response(METRICS_HISTORY, "History", query_history)
+
+
+@APP.get('/api/v1/archive')
+def get_api_archive():
+    return create_range_query_response(METRICS_ARCHIVE, "Archive", query_archive)
+
+
+@APP.get('/events')
+def get_events():
+    if BROADCASTER.get_subscriber_count() >= MAX_EVENTS_CLIENTS:
+        # Browser falling back to full page reload
+        return bottle.HTTPResponse(status=503, headers={"Retry-After": str(REFRESH_TIME)})
+    bottle.response.content_type = "text/event-stream"
+    bottle.response.set_header("Cache-Control", "no-cache")
+    # Subscribe now, so that no update is missed between current version and stream start
+    subscriber = BROADCASTER.subscribe()
+    try:
+        snapshot = SNAPSHOT_CACHE.get()
+    except Exception:
+        # Missing or invalid results file: no stream to release the subscriber
+        BROADCASTER.unsubscribe(subscriber)
+        raise
+    return stream_events(subscriber, snapshot.get_tag())
 
 
 @APP.get('/favicon.ico')
@@ -78,11 +165,178 @@ def get_favicon():
     return bottle.static_file("favicon.ico", root=os.path.join(PROJECT_DIR, "images"))
 
 
+# -----------------------------------------------------------------------------
+# Live updates
+
+def watch_snapshots(snapshot_cache, broadcaster, poll_time=SNAPSHOT_POLL_TIME):
+    """Publish an event for each new snapshot of monitoring results (the only results watcher, whatever the number
+    of clients)
+    """
+    snapshot = None
+    while True:
+        try:
+            previous_snapshot, snapshot = snapshot, snapshot_cache.get_next(snapshot, poll_time)
+            if previous_snapshot is not None and snapshot is not previous_snapshot:
+                broadcaster.publish(create_snapshot_event(previous_snapshot, snapshot))
+        except (RuntimeError, ValueError) as e:
+            # Missing or invalid results file
+            print(f"Failed to load monitoring results: {e}")
+            time.sleep(poll_time)
+        except Exception as e:
+            # Any other failure (ex: rendering of the event) only skipping this snapshot, not live updates for good
+            print(f"Failed to publish monitoring results: {e!r}")
+            time.sleep(poll_time)
+
+
+def stream_events(subscriber, version):
+    """Stream Server-Sent Events to a client: current snapshot version, then an event per new snapshot"""
+    try:
+        yield f"retry: {EVENTS_RETRY_TIME * 1000}\nevent: version\ndata: {version}\n\n".encode()
+        end_time = time.monotonic() + EVENTS_MAX_DURATION
+        while time.monotonic() < end_time:
+            try:
+                event = subscriber.get(timeout=EVENTS_KEEPALIVE_TIME)
+            except queue.Empty:
+                # Keep connection alive through proxies
+                yield b": keepalive\n\n"
+                continue
+            if event is None:
+                # Too slow client, disconnected (the browser reconnects and catches up)
+                break
+            yield event
+    finally:
+        BROADCASTER.unsubscribe(subscriber)
+
+
+def create_snapshot_event(previous_snapshot, snapshot):
+    """Create Server-Sent Event of a new snapshot, with the cells of the page that changed since previous one
+
+    Example:
+    event: snapshot
+    data: {"previous": "3a-17f0...", "version": "3a-17f1...", "timestamp": "2022-12-16 13:44:43", ...
+           "rows": {"bb-instance-0": {"cells": {"3": "<td ...>...</td>", ...}}, "bb-storage-1": {"row": "<td>..."}}}
+    """
+    metadata = snapshot.data[MainProp.METADATA]
+    last_update_datetime = datetime.datetime.strptime(metadata[MetaProp.PROCESS_TIMESTAMP], DATETIME_FORMAT)
+    data = {
+        "previous": previous_snapshot.get_tag(),
+        "version": snapshot.get_tag(),
+        "timestamp": metadata[MetaProp.PROCESS_TIMESTAMP],
+        "epoch": round(last_update_datetime.timestamp()),
+        "rows": get_rows_delta(previous_snapshot.get_rendering("cells", create_html_cells),
+                               snapshot.get_rendering("cells", create_html_cells)),
+    }
+    return f"id: {snapshot.get_tag()}\nevent: snapshot\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+def create_html_cells(data):
+    return {
+        "bb-instance": [create_html_instance_cells(instance_data) for instance_data in data[MainProp.INSTANCES]],
+        "bb-storage": [create_html_storage_cells(storage_data) for storage_data in data[MainProp.STORAGES]],
+    }
+
+
+def get_rows_delta(previous_cells, cells):
+    """Get changed table cells (by row id and cell index), or whole rows when their layout changed
+    (ex: unreachable instance). None if rows were added or removed: the whole page is to be reloaded.
+    """
+    delta = {}
+    for row_prefix, rows in cells.items():
+        previous_rows = previous_cells.get(row_prefix, [])
+        if len(rows) != len(previous_rows):
+            return None
+        for i, (previous_row, row) in enumerate(zip(previous_rows, rows)):
+            if len(row) != len(previous_row):
+                delta[f"{row_prefix}-{i}"] = {"row": "".join(row)}
+                continue
+            changed_cells = {j: cell for j, (previous_cell, cell) in enumerate(zip(previous_row, row))
+                             if cell != previous_cell}
+            if changed_cells:
+                delta[f"{row_prefix}-{i}"] = {"cells": changed_cells}
+    return delta
+
+
+# -----------------------------------------------------------------------------
+# Conditional and compressed responses
+
+def create_range_query_response(source, source_name, query_func):
+    """Query metrics over a time range of given source (history, archive), with query_func(source, query)"""
+    if source is None:
+        return bottle.HTTPResponse(json.dumps({"error": f"{source_name} not enabled"}), status=404,
+                                   headers={"Content-Type": "application/json"})
+    query = dict(bottle.request.query.decode().items())
+    try:
+        result = query_func(source, query)
+    except RuntimeError as e:
+        return bottle.HTTPResponse(json.dumps({"error": str(e)}), status=400,
+                                   headers={"Content-Type": "application/json"})
+    # Changing with each new sample
+    bottle.response.content_type = "application/json"
+    bottle.response.set_header("Cache-Control", "no-cache")
+    return json.dumps(result, separators=(',', ':'))
+
+
+def create_snapshot_response(snapshot, name, render_func, content_type, cached=True):
+    """Create response serving a rendering of a snapshot: 304 if the client already has it, else its body, encoded and
+    compressed (if accepted by the client) once per snapshot (or per request, if not cached)
+    """
+    if cached:
+        body = snapshot.get_rendering(f"{name}.utf8", lambda data: snapshot.get_rendering(name, render_func).encode())
+    else:
+        body = render_func(snapshot.data).encode()
+    use_gzip = len(body) >= GZIP_MIN_SIZE and accepts_gzip(bottle.request.get_header("Accept-Encoding"))
+    # Strong entity tag: one per snapshot, rendering and encoding
+    etag = f'"{snapshot.get_tag()}-{name}{"-gzip" if use_gzip else ""}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": email.utils.formatdate(snapshot.modified_time, usegmt=True),
+        "Cache-Control": "no-cache",  # Cached by clients, but always revalidated
+        "Vary": "Accept-Encoding",
+    }
+    if is_not_modified(etag, snapshot.modified_time, bottle.request.get_header("If-None-Match"),
+                       bottle.request.get_header("If-Modified-Since")):
+        return bottle.HTTPResponse(status=304, headers=headers)
+    headers["Content-Type"] = content_type
+    if use_gzip:
+        body = snapshot.get_rendering(f"{name}.gz", lambda data: gzip.compress(body, mtime=0)) if cached \
+            else gzip.compress(body, mtime=0)
+        headers["Content-Encoding"] = "gzip"
+    return bottle.HTTPResponse(body, headers=headers)
+
+
+def is_not_modified(etag, modified_time, if_none_match, if_modified_since):
+    # Entity tags take precedence over dates
+    if if_none_match is not None:
+        client_etags = [client_etag.strip().removeprefix("W/") for client_etag in if_none_match.split(",")]
+        return etag in client_etags or "*" in client_etags
+    if if_modified_since is not None:
+        try:
+            since_datetime = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since_datetime.tzinfo is None:
+            since_datetime = since_datetime.replace(tzinfo=datetime.timezone.utc)
+        # HTTP dates are precise to the second
+        return int(modified_time) <= since_datetime.timestamp()
+    return False
+
+
+def accepts_gzip(accept_encoding):
+    """Check Accept-Encoding header (ex: 'gzip, deflate, br', 'gzip;q=0') for gzip"""
+    if not accept_encoding:
+        return False
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() in ["gzip", "*"]:
+            return params.replace(" ", "").lower() not in ["q=0", "q=0.0", "q=0.00", "q=0.000"]
+    return False
+
+
 # -----------------------------------------------------------------------------
 # HTLM creation
 
-def create_html_page(data, page_title):
-    # Generate html content
+def create_html_page(data, page_title, version=None):
+    # Generate html content (live updated from given snapshot version, if any)
     return f"""
     <!doctype html>
     <html lang="en">
@@ -92,9 +346,9 @@ def create_html_page(data, page_title):
         <title>{page_title}</title>
         <link rel="icon" type="image/x-icon" href="favicon.ico">
         <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.2.0/dist/css/bootstrap.min.css" rel="stylesheet" integrity="sha384-gH2yIJqKdNHPEq0n4Mqa/HGKIhSkIHeL5AyhkYV8i59U5AR6csBvApHHNl/vI1Bx" crossorigin="anonymous">
-        <meta http-equiv="refresh" content="{REFRESH_TIME}">
+        <noscript><meta http-equiv="refresh" content="{REFRESH_TIME}"></noscript>
       </head>
-      <body>
+      <body data-bb-version="{version or ''}">
         <div class="container">
             <p></p>
             {create_html_head_banner(data)}
@@ -103,6 +357,7 @@ def create_html_page(data, page_title):
             {create_html_foot_banner(data)}
         </div>
         <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.2.0/dist/js/bootstrap.bundle.min.js" integrity="sha384-A3rJD856KowSb7dwlZdYEkO39Gagi7vIsF0jrRAoQmDKKtQBHUuLZ9AsSv4jD4Xa" crossorigin="anonymous"></script>
+        {create_html_live_update_script() if version else ""}
         <p></p>
       </body>
     </html>
@@ -114,10 +369,61 @@ def create_html_head_banner(data):
     last_update_datetime = datetime.datetime.strptime(last_update_timestamp, DATETIME_FORMAT)
     delta = datetime.datetime.now() - last_update_datetime
     delta_min = round(delta.total_seconds() / 60)
+    # Page being cached, elapsed time kept up to date by the browser
     return f"""
 <div class="alert alert-primary bb-head-banner" role="alert">
-    <strong>Last update</strong>: {last_update_timestamp} <i>({delta_min}min ago)</i>
+    <strong>Last update</strong>: <span class="bb-update-timestamp">{last_update_timestamp}</span> <i
+      class="bb-update-age" data-timestamp="{last_update_datetime.timestamp():.0f}">({delta_min}min ago)</i>
 </div>
+<script>
+  function updateAge() {{
+    for (const age of document.getElementsByClassName("bb-update-age")) {{
+      const delta_min = Math.round((Date.now() / 1000 - age.dataset.timestamp) / 60);
+      age.textContent = `(${{delta_min}}min ago)`;
+    }}
+  }}
+  updateAge();
+  setInterval(updateAge, 30000);
+</script>
+"""
+
+
+def create_html_live_update_script():
+    # Patch changed cells on each new snapshot, reload whole page when not possible
+    return f"""
+<script>
+  function reloadPage() {{
+    location.reload();
+  }}
+  const events = new EventSource("events");
+  events.addEventListener("version", (event) => {{
+    // (Re)connection: missed snapshots
+    if (event.data !== document.body.dataset.bbVersion) reloadPage();
+  }});
+  events.addEventListener("snapshot", (event) => {{
+    const snapshot = JSON.parse(event.data);
+    if (snapshot.previous !== document.body.dataset.bbVersion || snapshot.rows === null) return reloadPage();
+    for (const [rowId, row] of Object.entries(snapshot.rows)) {{
+      const tableRow = document.getElementById(rowId);
+      if (tableRow === null) return reloadPage();
+      if (row.row !== undefined) {{
+        tableRow.innerHTML = row.row;
+        continue;
+      }}
+      for (const [i, cell] of Object.entries(row.cells)) tableRow.cells[i].outerHTML = cell;
+    }}
+    for (const timestamp of document.getElementsByClassName("bb-update-timestamp")) {{
+      timestamp.textContent = snapshot.timestamp;
+    }}
+    for (const age of document.getElementsByClassName("bb-update-age")) age.dataset.timestamp = snapshot.epoch;
+    updateAge();
+    document.body.dataset.bbVersion = snapshot.version;
+  }});
+  events.onerror = () => {{
+    // Not reconnecting (ex: too many clients): full page reload
+    if (events.readyState === EventSource.CLOSED) setTimeout(reloadPage, {REFRESH_TIME * 1000});
+  }};
+</script>
 """
 
 
@@ -165,64 +471,8 @@ def create_html_instances_table(data):
 
     # Body
     tbody = "<tbody>"
-    for instance_data in data[MainProp.INSTANCES]:
-        trow = "<tr>"
-        # Name
-        trow += f"<td><strong>{instance_data[InstanceProp.NAME]}</strong></td>"
-        # IP
-        trow += f"<td><samp>{instance_data[InstanceProp.IP]}</samp></td>"
-        # CPU
-        trow += f"<td>{instance_data[InstanceProp.CPU_COUNT]}</td>"
-        # Load averages
-        for load_average in [instance_data[InstanceProp.LOAD_AVERAGE_1],
-                             instance_data[InstanceProp.LOAD_AVERAGE_5],
-                             instance_data[InstanceProp.LOAD_AVERAGE_15]]:
-            load_ratio_percent = get_as_percentage(load_average, instance_data[InstanceProp.CPU_COUNT])
-            trow += f"<td class='text-{get_load_average_color(load_ratio_percent)}'>" \
-                    f"<strong>{get_load_average_as_str(load_average)}</strong></td>"
-        # Memory
-        mem_used = instance_data[InstanceProp.MEMORY_USED]
-        mem_total = instance_data[InstanceProp.MEMORY_TOTAL]
-        mem_used_percent = get_as_percentage(mem_used, mem_total)
-        mem_usage_color = get_memory_usage_color(mem_used_percent)
-        # -- Total
-        trow += f"<td>{get_kib_size_as_human_readable_str(mem_total)}</td>"
-        # -- Used
-        trow += f"<td class='text-{mem_usage_color}'>" \
-                f"<strong>{get_kib_size_as_human_readable_str(mem_used)}</strong></td>"
-        # -- Usage
-        trow += f"<td>{create_progressbar(mem_used_percent, mem_usage_color)}</td>"
-        # Home disk space
-        # Note: TOTAL != USED+AVAIL (ex: 5% reserved/root) --> "Usable" = TOTAL-AVAIL
-        space_total = instance_data[InstanceProp.DISK_SPACE_TOTAL]
-        space_used = substract(space_total, instance_data[InstanceProp.DISK_SPACE_AVAILABLE])
-        space_used_percent = get_as_percentage(space_used, space_total)
-        space_usage_color = get_disk_space_usage_color(space_used_percent)
-        # -- total
-        trow += f"<td>{get_kib_size_as_human_readable_str(space_total)}</td>"
-        # -- Used
-        trow += f"<td class='text-{space_usage_color}'>" \
-                f"<strong>{get_kib_size_as_human_readable_str(space_used)}</strong></td>"
-        # -- Usage
-        trow += f"<td>{create_progressbar(space_used_percent, space_usage_color)}</td>"
-        # Network
-        send_rate = instance_data[InstanceProp.NET_SEND_RATE]
-        received_rate = instance_data[InstanceProp.NET_RECEIVE_RATE]
-        trow += f"<td class='text-{get_network_rate_color(send_rate)}'>" \
-                f"<strong>{get_kib_size_as_human_readable_str(get_network_rate_in_kbits(send_rate))}</strong></td>"
-        trow += f"<td class='text-{get_network_rate_color(received_rate)}'>" \
-                f"<strong>{get_kib_size_as_human_readable_str(get_network_rate_in_kbits(received_rate))}</strong></td>"
-        # Uptime
-        uptime = instance_data[InstanceProp.UPTIME]
-        trow += f"<td class='text-{get_uptime_color(uptime)}'>" \
-                f"<strong>{uptime}</strong></td>"
-        # Usage memo
-        usage_memo = instance_data[InstanceProp.USAGE_MEMO]
-        trow += f"<td class='text-{get_usage_memo_color(usage_memo)}'>" \
-                f"<strong>{get_readable_usage_memo(usage_memo)}</strong></td>"
-        # --
-        trow += "</tr>"
-        tbody += trow
+    for i, instance_data in enumerate(data[MainProp.INSTANCES]):
+        tbody += f'<tr id="bb-instance-{i}">{"".join(create_html_instance_cells(instance_data))}</tr>'
     tbody += "</tbody>"
     # -- Wrap it all
     return f"""
@@ -233,6 +483,68 @@ def create_html_instances_table(data):
 """
 
 
+def create_html_instance_cells(instance_data):
+    cells = []
+    # Name
+    cells.append(f"<td><strong>{instance_data[InstanceProp.NAME]}</strong></td>")
+    # IP
+    cells.append(f"<td><samp>{instance_data[InstanceProp.IP]}</samp></td>")
+    # Unreachable: no metrics
+    if instance_data.get(InstanceProp.STATE) == InstanceState.UNREACHABLE:
+        cells.append(f'<td colspan="14" class="text-center text-secondary">'
+                     f'{get_unreachable_as_str(instance_data.get(InstanceProp.LAST_SEEN))}</td>')
+        return cells
+    # CPU
+    cells.append(f"<td>{instance_data[InstanceProp.CPU_COUNT]}</td>")
+    # Load averages
+    for load_average in [instance_data[InstanceProp.LOAD_AVERAGE_1],
+                         instance_data[InstanceProp.LOAD_AVERAGE_5],
+                         instance_data[InstanceProp.LOAD_AVERAGE_15]]:
+        load_ratio_percent = get_as_percentage(load_average, instance_data[InstanceProp.CPU_COUNT])
+        cells.append(f"<td class='text-{get_load_average_color(load_ratio_percent)}'>"
+                     f"<strong>{get_load_average_as_str(load_average)}</strong></td>")
+    # Memory
+    mem_used = instance_data[InstanceProp.MEMORY_USED]
+    mem_total = instance_data[InstanceProp.MEMORY_TOTAL]
+    mem_used_percent = get_as_percentage(mem_used, mem_total)
+    mem_usage_color = get_memory_usage_color(mem_used_percent)
+    # -- Total
+    cells.append(f"<td>{get_kib_size_as_human_readable_str(mem_total)}</td>")
+    # -- Used
+    cells.append(f"<td class='text-{mem_usage_color}'>"
+                 f"<strong>{get_kib_size_as_human_readable_str(mem_used)}</strong></td>")
+    # -- Usage
+    cells.append(f"<td>{create_progressbar(mem_used_percent, mem_usage_color)}</td>")
+    # Home disk space
+    # Note: TOTAL != USED+AVAIL (ex: 5% reserved/root) --> "Usable" = TOTAL-AVAIL
+    space_total = instance_data[InstanceProp.DISK_SPACE_TOTAL]
+    space_used = substract(space_total, instance_data[InstanceProp.DISK_SPACE_AVAILABLE])
+    space_used_percent = get_as_percentage(space_used, space_total)
+    space_usage_color = get_disk_space_usage_color(space_used_percent)
+    # -- total
+    cells.append(f"<td>{get_kib_size_as_human_readable_str(space_total)}</td>")
+    # -- Used
+    cells.append(f"<td class='text-{space_usage_color}'>"
+                 f"<strong>{get_kib_size_as_human_readable_str(space_used)}</strong></td>")
+    # -- Usage
+    cells.append(f"<td>{create_progressbar(space_used_percent, space_usage_color)}</td>")
+    # Network
+    send_rate = instance_data[InstanceProp.NET_SEND_RATE]
+    received_rate = instance_data[InstanceProp.NET_RECEIVE_RATE]
+    for network_rate in [send_rate, received_rate]:
+        cells.append(f"<td class='text-{get_network_rate_color(network_rate)}'>"
+                     f"<strong>{get_kib_size_as_human_readable_str(get_network_rate_in_kbits(network_rate))}</strong></td>")
+    # Uptime
+    uptime = instance_data[InstanceProp.UPTIME]
+    cells.append(f"<td class='text-{get_uptime_color(uptime)}'>"
+                 f"<strong>{uptime}</strong></td>")
+    # Usage memo
+    usage_memo = instance_data[InstanceProp.USAGE_MEMO]
+    cells.append(f"<td class='text-{get_usage_memo_color(usage_memo)}'>"
+                 f"<strong>{get_readable_usage_memo(usage_memo)}</strong></td>")
+    return cells
+
+
 def create_html_storages_table(data):
     # Table header, on two lines
     thead = "<thead>"
@@ -257,36 +569,8 @@ def create_html_storages_table(data):
 
     # Table body
     tbody = "<tbody>"
-    for storage_data in data[MainProp.STORAGES]:
-        trow = "<tr>"
-        # Name
-        trow += f"<td><strong>{storage_data[InstanceProp.NAME]}</strong></td>"
-        # Type
-        storage_type = storage_data[InstanceProp.TYPE]
-        storage_type_color = get_storage_type_color(storage_type)
-        trow += f'<td class="table-{storage_type_color}">{storage_type}</td>'
-        # Location
-        host_ip = storage_data[InstanceProp.IP]
-        disk_path = storage_data[InstanceProp.DISK_PATH]
-        disk_file_system = storage_data[InstanceProp.DISK_FILE_SYSTEM]
-        displayed_location = reformat_storage_location(storage_type, host_ip, disk_path, disk_file_system)
-        trow += f"<td><samp>{displayed_location}</samp></td>"
-        # Space
-        # Note: TOTAL != USED+AVAIL (ex: 5% reserved/root) --> "Usable" = TOTAL-AVAIL
-        space_total = storage_data[InstanceProp.DISK_SPACE_TOTAL]
-        space_used = substract(space_total, storage_data[InstanceProp.DISK_SPACE_AVAILABLE])
-        space_used_percent = get_as_percentage(space_used, space_total)
-        space_usage_color = get_disk_space_usage_color(space_used_percent)
-        # -- Total
-        trow += f"<td>{get_kib_size_as_human_readable_str(space_total)}</td>"
-        # -- Used
-        trow += f"<td class='text-{space_usage_color}'>" \
-                f"<strong>{get_kib_size_as_human_readable_str(space_used)}</strong></td>"
-        # -- Usage
-        trow += f"<td>{create_progressbar(space_used_percent, space_usage_color)}</td>"
-        # --
-        trow += "</tr>"
-        tbody += trow
+    for i, storage_data in enumerate(data[MainProp.STORAGES]):
+        tbody += f'<tr id="bb-storage-{i}">{"".join(create_html_storage_cells(storage_data))}</tr>'
     tbody += "</tbody>"
     # -- Wrap it all
     return f"""
@@ -297,6 +581,49 @@ def create_html_storages_table(data):
 """
 
 
+def create_html_storage_cells(storage_data):
+    cells = []
+    # Name (flagged when stale: hung mount, last known metrics)
+    stale_badge = ' <span class="badge bg-secondary">stale</span>' \
+        if storage_data.get(InstanceProp.STATE) == InstanceState.STALE else ""
+    cells.append(f"<td><strong>{storage_data[InstanceProp.NAME]}</strong>{stale_badge}</td>")
+    # Type
+    storage_type = storage_data[InstanceProp.TYPE]
+    storage_type_color = get_storage_type_color(storage_type)
+    cells.append(f'<td class="table-{storage_type_color}">{storage_type}</td>')
+    # Location
+    host_ip = storage_data[InstanceProp.IP]
+    disk_path = storage_data[InstanceProp.DISK_PATH]
+    disk_file_system = storage_data[InstanceProp.DISK_FILE_SYSTEM]
+    displayed_location = reformat_storage_location(storage_type, host_ip, disk_path, disk_file_system)
+    cells.append(f"<td><samp>{displayed_location}</samp></td>")
+    # Unreachable: no metrics
+    if storage_data.get(InstanceProp.STATE) == InstanceState.UNREACHABLE:
+        cells.append(f'<td colspan="3" class="text-center text-secondary">'
+                     f'{get_unreachable_as_str(storage_data.get(InstanceProp.LAST_SEEN))}</td>')
+        return cells
+    # Space
+    # Note: TOTAL != USED+AVAIL (ex: 5% reserved/root) --> "Usable" = TOTAL-AVAIL
+    space_total = storage_data[InstanceProp.DISK_SPACE_TOTAL]
+    space_used = substract(space_total, storage_data[InstanceProp.DISK_SPACE_AVAILABLE])
+    space_used_percent = get_as_percentage(space_used, space_total)
+    space_usage_color = get_disk_space_usage_color(space_used_percent)
+    # -- Total
+    cells.append(f"<td>{get_kib_size_as_human_readable_str(space_total)}</td>")
+    # -- Used
+    cells.append(f"<td class='text-{space_usage_color}'>"
+                 f"<strong>{get_kib_size_as_human_readable_str(space_used)}</strong></td>")
+    # -- Usage
+    cells.append(f"<td>{create_progressbar(space_used_percent, space_usage_color)}</td>")
+    return cells
+
+
+def get_unreachable_as_str(last_seen):
+    if last_seen is None:
+        return "Unreachable"
+    return f"Unreachable since {last_seen}"
+
+
 def get_load_average_as_str(value):
     # By default, commands such as df display the amount of memory in kibibytes
     if value is None:
@@ -513,12 +840,28 @@ if __name__ == "__main__":
                         help='Path to input JSON file (default: %(default)s)')
     parser.add_argument("--debug", action="store_true", default=False,
                         help="Debug mode, server restarting at each code change (default: %(default)s)")
+    parser.add_argument('--history_dir', metavar="PATH", default=None,
+                        help='History directory of the monitor, to serve history of metrics (default: none, '
+                             'requires NumPy)')
+    parser.add_argument('--archive_db', metavar="PATH", default=None,
+                        help='Archive database of the monitor, to serve archived metrics (default: none)')
+    parser.add_argument('--archive_segments_dir', metavar="PATH", default=None,
+                        help='Compressed segments of the archive database (see run_compaction.py, default: none)')
     args = parser.parse_args()
 
+    # History (optional, NumPy only needed then)
+    metrics_history = None
+    if args.history_dir:
+        from big_brother.details.history import MetricsHistory
+        metrics_history = MetricsHistory(args.history_dir, readonly=True)
+
     # Go
     run_server(
         host=args.host,
         port=args.port,
         data_json_path=args.data_json,
         debug=args.debug,
+        history=metrics_history,
+        archive_db_path=args.archive_db,
+        archive_segments_dir=args.archive_segments_dir,
     )
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import statistics
+import logging
+
+TOP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+[sys.path.append(dir_path) for dir_path in [TOP_DIR] if dir_path not in sys.path]
+
+from big_brother.run_monitor import run_command, get_command_stdout, parse_top_output, parse_load_output, \
+    TOP_CMD, LOAD_CMD
+
+
+def bench_probe(cmd, parser, ip, ssh_user, repeat):
+    """Time a probe (command + parsing) on a host, and measure its output size"""
+    logger = logging.getLogger("BBBench")
+    durations = []
+    output_size = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        cmd_output = run_command(cmd, ip, ssh_user)
+        parser(get_command_stdout(cmd_output, logger), logger)
+        durations.append(time.perf_counter() - start_time)
+        output_size = len(cmd_output.stdout)
+    return statistics.median(durations), statistics.mean(durations), output_size
+
+
+def bench_load_probes(ip, ssh_user, repeat):
+    print(f"Load average probe cost on {ip} ({repeat} runs)")
+    print(f"{'probe':<40} {'median (ms)':>12} {'mean (ms)':>12} {'output (B)':>12}")
+    for name, cmd, parser in [
+        ("before: top -b -n1 -i", TOP_CMD, parse_top_output),
+        ("after: /proc/loadavg (top fallback)", LOAD_CMD, parse_load_output),
+    ]:
+        median, mean, output_size = bench_probe(cmd, parser, ip, ssh_user, repeat)
+        print(f"{name:<40} {1000 * median:>12.1f} {1000 * mean:>12.1f} {output_size:>12}")
+
+
+if __name__ == '__main__':
+    # Handy command line interface (-h for help)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark BigBrother monitor probes on a host")
+    parser.add_argument('--ip', default="localhost",
+                        help='IP of benchmarked host, reached through ssh if not localhost (default: %(default)s)')
+    parser.add_argument('--user', default=None,
+                        help='User for ssh connection (default: %(default)s)')
+    parser.add_argument('--repeat', metavar="N", type=int, default=20,
+                        help='Number of runs of each probe (default: %(default)s)')
+    args = parser.parse_args()
+
+    # Go
+    bench_load_probes(args.ip, args.user, args.repeat)
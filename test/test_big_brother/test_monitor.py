@@ -7,12 +7,34 @@ import socket
 import getpass
 import datetime
 import re
+import time
+import asyncio
+import threading
+import concurrent.futures
+import sqlite3
+import contextlib
+import numpy as np
 
 TOP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
 [sys.path.append(dir_path) for dir_path in [TOP_DIR] if dir_path not in sys.path]
 
-from big_brother.run_monitor import monitor_instances
+from big_brother.run_monitor import monitor_instances, split_batched_output, run_command_async, \
+    run_command, create_batched_script, parse_load_output, run_probes, parse_multi_df_output, get_storage_queries, \
+    process_storage_df_output, STORAGE_VOLUMES, get_instance_probes, split_batched_command_output, process_probe_outputs, \
+    FACTS_CACHE, monitor_storage_group, get_target_key
+import big_brother.run_monitor as run_monitor
+import big_brother.details.archive as archive_module
+from big_brother.details.logger import create_rotating_logger
+from big_brother.details.local_metrics import get_local_instance_metrics
+from big_brother.details.net_counters import get_net_rates
+from big_brother.details.facts_cache import HostFactsCache
+from big_brother.details.scheduler import MonitorScheduler, is_alerting
+from big_brother.details.circuit_breaker import HostCircuitBreaker, is_reachable
+from big_brother.details.probe_stats import ProbeStats
 from big_brother.details.utils import write_json, load_json
+from big_brother.details.history import MetricsHistory, parse_rollup_tiers
+from big_brother.details.archive import MetricsArchive, compact_archive
+from big_brother.details.segments import SegmentStore, read_index, get_matching_blocks
 
 
 class BBMonitor(unittest.TestCase):
@@ -44,9 +66,13 @@ class BBMonitor(unittest.TestCase):
             write_json(in_json_path, json_data)
             self.assertTrue(os.path.isfile(in_json_path))
 
-            # Monitor this instance
-            monitor_instances(in_json_path, out_json_path)
-            self.assertTrue(os.path.isfile(out_json_path))
+            # Monitor this instance, twice since network rates are computed from one cycle to the other
+            versions = []
+            for _ in range(2):
+                monitor_instances(in_json_path, out_json_path)
+                self.assertTrue(os.path.isfile(out_json_path))
+                versions.append(load_json(out_json_path)["metadata"]["version"])
+            self.assertEqual(versions[1], versions[0] + 1)
 
             # Check results
             results = load_json(out_json_path)
@@ -89,6 +115,609 @@ class BBMonitor(unittest.TestCase):
             self.assertTrue(0 < int(results["storages"][0]["disk_space_used"])
                             <= int(results["storages"][0]["disk_space_total"]))
 
+    def test_write_json(self):
+        with tempfile.TemporaryDirectory(prefix="test_monitor_") as tmp_dir:
+            json_path = os.path.join(tmp_dir, "results.json")
+            data = {"metadata": {"version": 1}, "instances": [{"name": "helios", "cpu": 12}]}
+            # Indented
+            write_json(json_path, data)
+            with open(json_path) as f_in:
+                self.assertIn('\n   "metadata": {', f_in.read())
+            inode = os.stat(json_path).st_ino
+            # Compact, replacing previous file (new inode: readers keep the previous one until reopening it)
+            write_json(json_path, data, compact=True)
+            with open(json_path) as f_in:
+                self.assertEqual(f_in.read(), '{"metadata":{"version":1},"instances":[{"name":"helios","cpu":12}]}')
+            self.assertNotEqual(os.stat(json_path).st_ino, inode)
+            # Failed write: previous file kept, no temporary file left
+            self.assertRaises(TypeError, write_json, json_path, {"not serializable": object()})
+            self.assertDictEqual(load_json(json_path), data)
+            self.assertListEqual(os.listdir(tmp_dir), ["results.json"])
+            # Usual permissions
+            self.assertEqual(os.stat(json_path).st_mode & 0o777, 0o666 & ~get_umask())
+            # -- Following the umask of the process, even if changed after import
+            umask = os.umask(0o077)
+            try:
+                write_json(json_path, data)
+            finally:
+                os.umask(umask)
+            self.assertEqual(os.stat(json_path).st_mode & 0o777, 0o600)
+
+    def test_history(self):
+        # In memory, ring buffer wrapping around
+        history = MetricsHistory(capacity=4, metrics=["load_avg_1", "mem_used"])
+        for i in range(6):
+            history.append("helios", 1000. + 10 * i, [i / 10, None if i == 5 else 1000 + i])
+        history.append("helios", 1050., [9., 9.])  # Same sample again, ignored
+        times, values = history.get_series("helios", "load_avg_1")
+        self.assertListEqual(times.tolist(), [1020., 1030., 1040., 1050.])
+        self.assertListEqual([round(value, 2) for value in values.tolist()], [0.2, 0.3, 0.4, 0.5])
+        times, values = history.get_series("helios", "mem_used", 1025, 1040)
+        self.assertListEqual(times.tolist(), [1030., 1040.])
+        self.assertListEqual(values.tolist(), [1003., 1004.])
+        self.assertEqual(len(history.get_series("apollo-1", "mem_used")[0]), 0)
+        # -- Large values kept exactly (ex: memory in KiB)
+        history.append("helios", 1060., [0.1, 528221323])
+        self.assertEqual(history.get_series("helios", "mem_used", 1060)[1].tolist(), [528221323.])
+        self.assertEqual(history.get_series("helios", "load_avg_1", 1060)[1].tolist(), [0.1])
+        self.assertRaises(RuntimeError, history.get_series, "helios", "foo")
+
+        with tempfile.TemporaryDirectory(prefix="test_monitor_") as tmp_dir:
+            # Ring files, through monitor cycles
+            history_dir = os.path.join(tmp_dir, "history")
+            in_json_path = os.path.join(tmp_dir, "instances.json")
+            write_json(in_json_path, {"instances": [{"name": "this/host", "ip": "localhost", "user": getpass.getuser(),
+                                                     "net_interface": get_active_net_interface()}], "storages": []})
+            history = MetricsHistory(history_dir, capacity=16)
+            for _ in range(2):
+                monitor_instances(in_json_path, None, history=history)
+            history.flush()
+            self.assertListEqual(history.get_hosts(), ["this/host"])
+            times, values = history.get_series("this/host", "load_avg_1")
+            self.assertEqual(len(times), 2)
+            self.assertTrue(times[0] < times[1] <= time.time())
+            self.assertTrue(all(0 <= value for value in values))
+            # -- Read by another process, with the same layout
+            reader = MetricsHistory(history_dir, readonly=True)
+            self.assertEqual(reader.capacity, 16)
+            self.assertListEqual(reader.get_hosts(), ["this/host"])
+            history.append("this/host", times[-1] + 10, [1.] * len(history.metrics))
+            self.assertEqual(len(reader.get_series("this/host", "load_avg_1")[0]), 3)
+            self.assertEqual(reader.get_series("this/host", "load_avg_1", step=60, stat="last")[1][-1], 1.)
+            # -- Reopened after restart, other layout refused
+            self.assertEqual(len(MetricsHistory(history_dir).get_series("this/host", "mem_used")[0]), 3)
+            self.assertRaises(RuntimeError, MetricsHistory, history_dir, capacity=32)
+            # -- Other monitor period accepted, and known by readers
+            self.assertEqual(reader.period, 10)
+            MetricsHistory(history_dir, period=30)
+            self.assertEqual(MetricsHistory(history_dir, readonly=True).period, 30)
+            # -- Directory of an older version (float32 ring files) refused as well
+            meta = load_json(os.path.join(history_dir, "history.json"))
+            self.assertEqual(meta.pop("values_type"), "float64")
+            write_json(os.path.join(history_dir, "history.json"), meta)
+            self.assertRaises(RuntimeError, MetricsHistory, history_dir)
+
+    def test_history_rollups(self):
+        self.assertListEqual(parse_rollup_tiers("1m:2d,15m:30d"), [(60, 2880), (900, 2880)])
+        self.assertRaises(RuntimeError, parse_rollup_tiers, "1h:30m")
+        self.assertRaises(RuntimeError, parse_rollup_tiers, "1x:2d")
+
+        # Samples every 10s over 3 minutes, rolled up per minute and per 2 minutes
+        history = MetricsHistory(capacity=4, metrics=["load_avg_1", "mem_used"], rollups=[(120, 2), (60, 2)])
+        self.assertListEqual(history.get_steps(), [60, 120])
+        for i in range(18):
+            history.append("helios", 1200. + 10 * i, [i, None if i % 2 else 1000 + i])
+        times, values = history.get_series("helios", "load_avg_1", step=60, stat="max")
+        self.assertListEqual(times.tolist(), [1260., 1320.])  # Oldest minute overwritten
+        self.assertListEqual(values.tolist(), [11., 17.])
+        times, values = history.get_series("helios", "load_avg_1", 1250, step=120)
+        self.assertListEqual(times.tolist(), [1200., 1320.])
+        self.assertListEqual(values.tolist(), [5.5, 14.5])
+        self.assertListEqual(history.get_series("helios", "mem_used", step=120, stat="min")[1].tolist(), [1000, 1012])
+        self.assertListEqual(history.get_series("helios", "mem_used", step=60, stat="last")[1].tolist(), [1010, 1016])
+        self.assertListEqual(history.get_series("helios", "mem_used", step=60)[1].tolist(), [1008, 1014])
+        self.assertRaises(RuntimeError, history.get_series, "helios", "mem_used", step=30)
+        self.assertRaises(RuntimeError, history.get_series, "helios", "mem_used", stat="p95")
+        # -- Exact sums of large values (ex: memory in KiB every 10s over 1 hour)
+        large_history = MetricsHistory(capacity=4, metrics=["mem_used"], rollups=[(3600, 2)])
+        for i in range(360):
+            large_history.append("helios", 3600. + 10 * i, [528221323 + i])
+        self.assertListEqual(large_history.get_series("helios", "mem_used", step=3600)[1].tolist(), [528221502.5])
+        self.assertListEqual(large_history.get_series("helios", "mem_used", step=3600, stat="max")[1].tolist(),
+                             [528221682])
+
+        # Concurrent reads while appending (threads switched as often as possible): each sample read with its own
+        # values, windows with consistent statistics
+        shared_history = MetricsHistory(capacity=64, metrics=["load_avg_1"], rollups=[(60, 4)])
+        writer = threading.Thread(target=lambda: [shared_history.append("helios", 1200. + i, [i]) for i in range(5000)])
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            writer.start()
+            while writer.is_alive():
+                times, values = shared_history.get_series("helios", "load_avg_1")
+                self.assertTrue(np.array_equal(times - 1200., values))
+                times, mins = shared_history.get_series("helios", "load_avg_1", step=60, stat="min")
+                self.assertTrue(np.array_equal(times - 1200., mins))
+        finally:
+            writer.join()
+            sys.setswitchinterval(switch_interval)
+
+        # Finest series with few points, covering requested times
+        now = time.time()
+        self.assertIsNone(history.select_step(now - 30))
+        self.assertEqual(history.select_step(now - 100), 60)
+        self.assertEqual(history.select_step(now - 200), 120)
+        self.assertEqual(history.select_step(now - 200, max_points=1), 120)
+        self.assertEqual(history.select_step(now - 150, max_points=2), 120)
+        self.assertEqual(MetricsHistory().select_step(now - 7 * 86400), 900)
+        # -- Raw samples covering more time at a longer monitor period
+        self.assertIsNone(MetricsHistory(capacity=4, rollups=[(120, 2), (60, 2)], period=60).select_step(now - 100))
+
+    def test_archive(self):
+        with tempfile.TemporaryDirectory(prefix="test_monitor_") as tmp_dir:
+            db_path = os.path.join(tmp_dir, "archive.db")
+            archive = MetricsArchive(db_path, retention=86400)
+            now = time.time()
+            # Pruned once written (older than retention), same samples ignored
+            self.assertTrue(archive.append_results(now - 2 * 86400, [{"name": "helios", "load_avg_1": 9.}]))
+            for i in range(3):
+                results = [{"name": "helios", "load_avg_1": 0.5 + i, "mem_used": 1000},
+                           {"name": "apollo-1", "load_avg_1": None, "disk_space_used": 42}]
+                self.assertTrue(archive.append_results(now - 60 + 10 * i, results))
+            self.assertTrue(archive.append_results(now - 40, results))
+            # -- Monitor results
+            in_json_path = os.path.join(tmp_dir, "instances.json")
+            write_json(in_json_path, {"instances": [{"name": "this/host", "ip": "localhost", "user": getpass.getuser(),
+                                                     "net_interface": get_active_net_interface()}], "storages": []})
+            monitor_instances(in_json_path, None, archive=archive)
+            archive.close()
+
+            # Read-only queries
+            reader = MetricsArchive(db_path, readonly=True)
+            self.assertListEqual(reader.get_hosts(), ["apollo-1", "helios", "this/host"])
+            series = reader.get_series(["helios", "apollo-*"], "load_avg_1", now - 3600, now)
+            self.assertListEqual(sorted(series.keys()), ["apollo-1", "helios"])
+            self.assertListEqual(series["helios"][0], [now - 60, now - 50, now - 40])
+            self.assertListEqual(series["helios"][1], [0.5, 1.5, 2.5])
+            self.assertListEqual(series["apollo-1"][1], [None] * 3)
+            self.assertEqual(len(reader.get_series([], "mem_used", now - 3600, time.time())["this/host"][0]), 1)
+            self.assertEqual(reader.get_aggregates(["helios"], "load_avg_1", now - 3600, now, "max"),
+                             ({"helios": 2.5}, 2.5))
+            self.assertEqual(reader.get_aggregates(["*"], "load_avg_1", now - 3 * 86400, now - 45, "count"),
+                             ({"helios": 2}, 2))
+            self.assertRaises(RuntimeError, reader.get_series, [], "name", now - 3600, now)
+            self.assertRaises(RuntimeError, reader.get_aggregates, [], "mem_used", now - 3600, now, "p95")
+
+            # Writer not keeping up: cycles dropped rather than waited for
+            archive = MetricsArchive(db_path, max_pending=1)
+            archive._queue.put(None)  # Writer stopped
+            archive._writer.join()
+            self.assertTrue(archive.append_results(now, results))
+            self.assertFalse(archive.append_results(now + 10, results))
+            self.assertEqual(archive.dropped_count, 1)
+
+    def test_archive_compaction(self):
+        with tempfile.TemporaryDirectory(prefix="test_monitor_") as tmp_dir:
+            db_path = os.path.join(tmp_dir, "archive.db")
+            segments_dir = os.path.join(tmp_dir, "segments")
+            # Samples of the last 3 days, every 10 minutes
+            archive = MetricsArchive(db_path, max_pending=1000)
+            day_time = time.time() // 86400 * 86400
+            start_time = day_time - 3 * 86400
+            for i in range(3 * 144 + 6):
+                archive.append_results(start_time + 600 * i, [{"name": "helios", "load_avg_1": i % 7},
+                                                              {"name": "apollo-1", "load_avg_1": None if i % 2 else i}])
+            archive.close()
+            reader = MetricsArchive(db_path, readonly=True, segments_dir=segments_dir)
+            series = reader.get_series([], "load_avg_1", 0, time.time())
+            aggregates = reader.get_aggregates(["apollo-*"], "load_avg_1", start_time + 3600, day_time, "mean")
+            counts = reader.get_aggregates([], "load_avg_1", 0, time.time(), "count")
+            # -- Read as well while compacting, between segments being written and their samples being removed from
+            # the database: each sample read once
+            compaction_reads = []
+            original_write_segment = archive_module.write_segment
+
+            def write_segment_then_read(*args, **kwargs):
+                blocks_count = original_write_segment(*args, **kwargs)
+                compaction_reads.append((reader.get_series([], "load_avg_1", 0, time.time()),
+                                         reader.get_aggregates([], "load_avg_1", 0, time.time(), "count")))
+                return blocks_count
+
+            # Days older than 1 day compacted, all samples still readable
+            for codec in ["lzma", "zlib"]:
+                archive_module.write_segment = write_segment_then_read
+                try:
+                    segment_paths = compact_archive(db_path, segments_dir, 86400, codec)
+                finally:
+                    archive_module.write_segment = original_write_segment
+                self.assertEqual(len(compaction_reads), 2)
+                self.assertTrue(all(read == (series, counts) for read in compaction_reads))
+                compaction_reads.clear()
+                self.assertEqual([os.path.basename(path) for path in segment_paths],
+                                 [time.strftime("%Y-%m-%d.seg", time.gmtime(start_time + i * 86400)) for i in range(2)])
+                self.assertListEqual(reader.get_hosts(), ["apollo-1", "helios"])  # Last day
+                self.assertDictEqual(reader.get_series([], "load_avg_1", 0, time.time()), series)
+                self.assertEqual(reader.get_aggregates(["apollo-*"], "load_avg_1", start_time + 3600, day_time, "mean"),
+                                 aggregates)
+                # -- Again (late samples), merged in segments
+                archive = MetricsArchive(db_path, max_pending=1000)
+                for i in range(2 * 144):
+                    archive.append_results(start_time + 600 * i, [{"name": "helios", "load_avg_1": i % 7}])
+                archive.close()
+            self.assertEqual(len(compact_archive(db_path, segments_dir, 86400)), 2)
+            self.assertDictEqual(reader.get_series([], "load_avg_1", 0, time.time()), series)
+
+            # Only blocks of an hour of a host decompressed
+            with open(segment_paths[0], "rb") as f_in:
+                index = read_index(f_in)
+            self.assertEqual(len(index["blocks"]), 2 * 24)
+            self.assertEqual(len(get_matching_blocks(index, ["helios"], start_time + 3600, start_time + 7199)), 1)
+            series = SegmentStore(segments_dir).get_series(["hel*"], "load_avg_1", start_time + 3600, start_time + 7199)
+            self.assertListEqual(series["helios"][1], [(6 + i) % 7 for i in range(6)])
+
+            # Sample archived while its day is being compacted, not lost (compacted as well)
+            archive = MetricsArchive(db_path, max_pending=1000)
+            archive.append_results(start_time + 300, [{"name": "helios", "load_avg_1": 2}])
+            archive.close()
+            write_segment = archive_module.write_segment
+
+            def write_segment_meanwhile(*args, **kwargs):
+                with contextlib.closing(sqlite3.connect(db_path)) as connection, connection:
+                    connection.execute("INSERT OR IGNORE INTO samples (host, ts, load_avg_1) VALUES ('apollo-1', ?, 5)",
+                                       (start_time + 300,))
+                return write_segment(*args, **kwargs)
+
+            archive_module.write_segment = write_segment_meanwhile
+            try:
+                compact_archive(db_path, segments_dir, 86400)
+            finally:
+                archive_module.write_segment = write_segment
+            series = reader.get_series([], "load_avg_1", start_time + 300, start_time + 300)
+            self.assertDictEqual(series, {"apollo-1": ([start_time + 300], [5]), "helios": ([start_time + 300], [2])})
+
+            # Segments older than retention removed
+            self.assertListEqual(compact_archive(db_path, segments_dir, 86400, retention=2 * 86400), [])
+            self.assertEqual(len(os.listdir(segments_dir)), 1)
+
+    def test_monitor_parallel_keeps_order(self):
+        with tempfile.TemporaryDirectory(prefix="test_monitor_") as tmp_dir:
+            # Define tmp paths
+            in_json_path = os.path.join(tmp_dir, "instances.json")
+            out_json_path = os.path.join(tmp_dir, "results.json")
+
+            # Several times the instance running this test, with a limited number of workers
+            instances = [{
+                "name": f"{socket.gethostname()}-{i}",
+                "ip": "localhost",
+                "user": getpass.getuser(),
+                "net_interface": get_active_net_interface(),
+            } for i in range(5)]
+            storages = [{
+                "name": f"root-{i}",
+                "type": "Home Disk",
+                "ip": "localhost",
+                "user": getpass.getuser(),
+                "disk_path": "/"
+            } for i in range(3)]
+            write_json(in_json_path, {"settings": {"workers": 3}, "instances": instances, "storages": storages})
+
+            # Monitor
+            monitor_instances(in_json_path, out_json_path)
+
+            # Check results order
+            results = load_json(out_json_path)
+            self.assertListEqual([x["name"] for x in results["instances"]], [x["name"] for x in instances])
+            self.assertListEqual([x["name"] for x in results["storages"]], [x["name"] for x in storages])
+            for storage_result in results["storages"]:
+                self.assertTrue(0 < int(storage_result["disk_space_total"]))
+
+    def test_batched_probe(self):
+        logger = create_rotating_logger(log_path=None, no_console_log=True, log_name="BBMonitorTest")
+        result = get_batched_metrics("localhost", logger)
+        # Same metrics as one probe after the other
+        self.assertListEqual(list(result.keys()), [
+            "cpu", "load_avg_1", "load_avg_5", "load_avg_15", "mem_total", "mem_used",
+            "disk_file_sys", "disk_space_total", "disk_space_used", "disk_space_avail",
+            "net_send_rate", "net_receive_rate", "uptime", "usage_memo"])
+        self.assertTrue(0 < result["cpu"])
+        self.assertTrue(0 < result["mem_used"] <= result["mem_total"])
+        self.assertTrue(0 < result["disk_space_used"] <= result["disk_space_total"])
+
+    def test_split_batched_output(self):
+        # Complete sections, failed section and section interrupted by a timeout
+        raw_output = "@@BB@@ nproc\n80\n\n@@BB@@ nproc 0\n@@BB@@ free\n\n@@BB@@ free 127\n@@BB@@ df\nFilesystem"
+        sections = split_batched_output(raw_output)
+        self.assertDictEqual(sections, {"nproc": (0, "80"), "free": (127, ""), "df": (None, "Filesystem")})
+        # Probe output without final new line (ex: memo file), closing marker still on its own line
+        probes = [("memo", "printf 'free\\nuntil 5pm'", None), ("nproc", "nproc", None), ("empty", "true", None)]
+        cmd_output = run_command(create_batched_script(probes), "localhost", getpass.getuser())
+        sections = split_batched_output(cmd_output.stdout.decode())
+        self.assertEqual(sections["memo"], (0, "free\nuntil 5pm"))
+        self.assertEqual(sections["nproc"][0], 0)
+        self.assertTrue(0 < int(sections["nproc"][1]))
+        self.assertEqual(sections["empty"], (0, ""))
+
+    def test_monitor_asyncio_engine(self):
+        with tempfile.TemporaryDirectory(prefix="test_monitor_") as tmp_dir:
+            # Define tmp paths
+            in_json_path = os.path.join(tmp_dir, "instances.json")
+            out_json_path = os.path.join(tmp_dir, "results.json")
+            this_instance = {
+                "name": socket.gethostname(),
+                "ip": "localhost",
+                "user": getpass.getuser(),
+                "net_interface": get_active_net_interface(),
+            }
+            this_storage = {
+                "name": "/home",
+                "type": "Home Disk",
+                "ip": "localhost",
+                "user": getpass.getuser(),
+                "disk_path": "/"
+            }
+            write_json(in_json_path, {"instances": [this_instance] * 3, "storages": [this_storage]})
+
+            # Monitor with both engines
+            monitor_instances(in_json_path, out_json_path, engine="threads")
+            thread_results = load_json(out_json_path)
+            monitor_instances(in_json_path, out_json_path, engine="asyncio")
+            asyncio_results = load_json(out_json_path)
+
+            # Same results layout
+            for key in ["instances", "storages"]:
+                self.assertEqual(len(thread_results[key]), len(asyncio_results[key]))
+                for thread_result, asyncio_result in zip(thread_results[key], asyncio_results[key]):
+                    self.assertListEqual(list(thread_result.keys()), list(asyncio_result.keys()))
+                    self.assertEqual(thread_result["name"], asyncio_result["name"])
+            self.assertTrue(0 < asyncio_results["instances"][0]["cpu"])
+            self.assertTrue(0 < asyncio_results["storages"][0]["disk_space_total"])
+
+    def test_run_command_async_timeout(self):
+        # Output produced before the deadline is kept, and the whole process group is killed
+        start_time = time.time()
+        cmd_output = asyncio.run(run_command_async("echo start; sleep 5 & sleep 5", "localhost", None, timeout=0.5))
+        self.assertTrue(time.time() - start_time < 2)
+        self.assertEqual(cmd_output.returncode, 124)
+        self.assertEqual(cmd_output.stdout.decode().strip(), "start")
+
+    def test_local_metrics(self):
+        # Native metrics of localhost should match the ones of the commands
+        logger = create_rotating_logger(log_path=None, no_console_log=True, log_name="BBMonitorTest")
+        local_result = get_local_instance_metrics("/", get_active_net_interface(), logger)
+        command_result = get_batched_metrics("localhost", logger)
+        self.assertListEqual(list(local_result.keys()), list(command_result.keys()))
+        for key in ["cpu", "mem_total", "disk_file_sys", "disk_space_total", "uptime", "usage_memo"]:
+            self.assertEqual(local_result[key], command_result[key])
+        for key in ["mem_used", "disk_space_used"]:
+            self.assertAlmostEqual(local_result[key], command_result[key], delta=0.05 * command_result[key])
+
+    def test_net_rates(self):
+        # No rate on first call
+        rates = get_net_rates("192.0.2.1", "eth0", 1000, 5000, timestamp=100.)
+        self.assertDictEqual(rates, {"net_send_rate": None, "net_receive_rate": None})
+        # Rates in bits/s from counters variation
+        rates = get_net_rates("192.0.2.1", "eth0", 2000, 25000, timestamp=110.)
+        self.assertDictEqual(rates, {"net_send_rate": 800, "net_receive_rate": 16000})
+        # No rate after counters reset
+        rates = get_net_rates("192.0.2.1", "eth0", 10, 10, timestamp=120.)
+        self.assertDictEqual(rates, {"net_send_rate": None, "net_receive_rate": None})
+
+    def test_parse_load_output(self):
+        logger = create_rotating_logger(log_path=None, no_console_log=True, log_name="BBMonitorTest")
+        expected_result = {"load_avg_1": 12.09, "load_avg_5": 12.26, "load_avg_15": 15.26}
+        # /proc/loadavg format
+        self.assertDictEqual(parse_load_output("12.09 12.26 15.26 11/809 1192691\n", logger), expected_result)
+        # top fallback format
+        top_line = "top - 09:20:25 up 3 days,  1:58,  0 users,  load average: 12,09, 12,26, 15,26\n"
+        self.assertDictEqual(parse_load_output(top_line, logger), expected_result)
+
+    def test_facts_cache(self):
+        facts_cache = HostFactsCache(ttls={"cpu": 0.2})
+        # Cached until expiration
+        facts_cache.set_missing("192.0.2.1", {"cpu": 80})
+        self.assertEqual(facts_cache.get("192.0.2.1", "cpu"), 80)
+        time.sleep(0.3)
+        self.assertIsNone(facts_cache.get("192.0.2.1", "cpu"))
+        # Invalidated on reboot
+        facts_cache.set_missing("192.0.2.1", {"cpu": 80})
+        self.assertFalse(facts_cache.check_uptime("192.0.2.1", 12))
+        self.assertFalse(facts_cache.check_uptime("192.0.2.1", 13))
+        self.assertEqual(facts_cache.get("192.0.2.1", "cpu"), 80)
+        self.assertTrue(facts_cache.check_uptime("192.0.2.1", 0))
+        self.assertIsNone(facts_cache.get("192.0.2.1", "cpu"))
+
+    def test_probe_facts_invalidation(self):
+        logger = create_rotating_logger(log_path=None, no_console_log=True, log_name="BBMonitorTest")
+        ip = "192.0.2.2"
+        probes = {name: (name, cmd, parser) for name, cmd, parser in get_instance_probes(ip, "/", "eth0")}
+        FACTS_CACHE.set(ip, "cpu", 80)
+        # No memo file: no memo (cached as such), and other facts kept
+        cmd_output = subprocess.CompletedProcess(args="memo", returncode=0, stdout=b"none\n", stderr=b"")
+        result = process_probe_outputs(ip, [probes["usage_memo"]], [cmd_output], logger)
+        self.assertIsNone(result["usage_memo"])
+        self.assertEqual(FACTS_CACHE.get(ip, "usage_memo"), ("none", None))
+        self.assertEqual(FACTS_CACHE.get(ip, "cpu"), 80)
+        # Probe failing on the instance: facts kept
+        cmd_output = subprocess.CompletedProcess(args="free", returncode=127, stdout=b"", stderr=b"not found")
+        process_probe_outputs(ip, [probes["free"]], [cmd_output], logger)
+        self.assertEqual(FACTS_CACHE.get(ip, "cpu"), 80)
+        # Connection failure: facts invalidated
+        cmd_output = subprocess.CompletedProcess(args="free", returncode=255, stdout=b"", stderr=b"ssh: timed out")
+        process_probe_outputs(ip, [probes["free"]], [cmd_output], logger)
+        self.assertIsNone(FACTS_CACHE.get(ip, "cpu"))
+        # Reboot within a day (same uptime in days): facts invalidated
+        FACTS_CACHE.set(ip, "cpu", 80)
+        for uptime, expected_cpu in [("up 5 hours, 3 minutes", 80), ("up 5 hours, 4 minutes", 80),
+                                     ("up 2 minutes", None)]:
+            cmd_output = subprocess.CompletedProcess(args="uptime", returncode=0, stdout=uptime.encode(), stderr=b"")
+            result = process_probe_outputs(ip, [probes["uptime"]], [cmd_output], logger)
+            self.assertEqual(result["uptime"], 0)
+            self.assertEqual(FACTS_CACHE.get(ip, "cpu"), expected_cpu)
+
+    def test_storage_group_fallback(self):
+        # Hung mounts (df killed by its remote deadline) queried on their own all at once: a single extra timeout
+        logger = create_rotating_logger(log_path=None, no_console_log=True, log_name="BBMonitorTest")
+        storage_df_cmd, storage_timeout = run_monitor.STORAGE_DF_CMD, run_monitor.STORAGE_TIMEOUT
+        run_monitor.STORAGE_DF_CMD = "timeout --foreground -s KILL {timeout} sh -c 'exec sleep 5' {disk_paths}"
+        run_monitor.STORAGE_TIMEOUT = 1
+        try:
+            start_time = time.time()
+            results = monitor_storage_group("localhost", getpass.getuser(), ["/mnt/a", "/mnt/b", "/mnt/c"], logger)
+            self.assertTrue(time.time() - start_time < 3.5)
+        finally:
+            run_monitor.STORAGE_DF_CMD, run_monitor.STORAGE_TIMEOUT = storage_df_cmd, storage_timeout
+        self.assertListEqual(list(results.keys()), ["/mnt/a", "/mnt/b", "/mnt/c"])
+        self.assertTrue(all(result["state"] == "stale" for result in results.values()))
+
+    def test_parse_multi_df_output(self):
+        logger = create_rotating_logger(log_path=None, no_console_log=True, log_name="BBMonitorTest")
+        cmd_stdout = "Filesystem 1024-blocks Used Available Capacity Mounted on\n" \
+                     "//192.168.10.206/datacenter 82465199988 67438837112 15026362876 82% /mnt/datacenter\n" \
+                     "192.168.10.225:/projets/ 30601641984 22277762048 8323879936 73% /mnt/projets\n"
+        results = parse_multi_df_output(cmd_stdout, ["/mnt/datacenter", "/mnt/projets"], logger)
+        self.assertEqual(results["/mnt/datacenter"]["disk_file_sys"], "//192.168.10.206/datacenter")
+        self.assertEqual(results["/mnt/projets"]["disk_space_avail"], 8323879936)
+        # Missing line: no metric rather than mismatched ones
+        results = parse_multi_df_output(cmd_stdout, ["/mnt/datacenter", "/mnt/projets", "/mnt/other"], logger)
+        self.assertTrue(all(result["disk_space_total"] is None for result in results.values()))
+
+    def test_storage_queries(self):
+        logger = create_rotating_logger(log_path=None, no_console_log=True, log_name="BBMonitorTest")
+        storages = [
+            {"ip": "192.0.2.1", "user": None, "disk_path": "/mnt/projets"},
+            {"ip": "192.0.2.1", "user": None, "disk_path": "/mnt/data"},
+            {"ip": "192.0.2.2", "user": None, "disk_path": "/mnt/projets"},
+        ]
+        # A single df per host
+        storage_groups, storage_sources = get_storage_queries(storages, logger)
+        self.assertDictEqual(storage_groups, {("192.0.2.1", None): ["/mnt/projets", "/mnt/data"],
+                                              ("192.0.2.2", None): ["/mnt/projets"]})
+        # A single query per volume, once known
+        STORAGE_VOLUMES[("192.0.2.1", "/mnt/projets")] = ("192.168.10.225:/projets", time.monotonic())
+        STORAGE_VOLUMES[("192.0.2.2", "/mnt/projets")] = ("192.168.10.225:/projets", time.monotonic())
+        try:
+            storage_groups, storage_sources = get_storage_queries(storages, logger)
+        finally:
+            STORAGE_VOLUMES.clear()
+        self.assertDictEqual(storage_groups, {("192.0.2.1", None): ["/mnt/projets", "/mnt/data"]})
+        self.assertEqual(storage_sources[2], ("192.0.2.1", None, "/mnt/projets"))
+
+    def test_storage_df_states(self):
+        logger = create_rotating_logger(log_path=None, no_console_log=True, log_name="BBMonitorTest")
+        df_stdout = b"Filesystem 1024-blocks Used Available Capacity Mounted on\n" \
+                    b"192.168.10.225:/projets/ 30601641984 22277762048 8323879936 73% /mnt/projets\n"
+        # Success
+        cmd_output = subprocess.CompletedProcess(args="df", returncode=0, stdout=df_stdout, stderr=b"")
+        results = process_storage_df_output(cmd_output, ["/mnt/projets"], logger)
+        self.assertEqual(results["/mnt/projets"]["state"], "ok")
+        # Hung mount, killed on deadline
+        cmd_output = subprocess.CompletedProcess(args="df", returncode=137, stdout=b"", stderr=b"")
+        results = process_storage_df_output(cmd_output, ["/mnt/projets"], logger)
+        self.assertEqual(results["/mnt/projets"]["state"], "stale")
+        # Several paths, one of them failing: each path has to be queried on its own
+        cmd_output = subprocess.CompletedProcess(args="df", returncode=1, stdout=df_stdout, stderr=b"")
+        self.assertIsNone(process_storage_df_output(cmd_output, ["/mnt/projets", "/mnt/other"], logger))
+
+    def test_adopt_late_storage(self):
+        with tempfile.TemporaryDirectory(prefix="test_monitor_") as tmp_dir:
+            in_json_path = os.path.join(tmp_dir, "instances.json")
+            storage = {"name": "late", "type": "NAS", "ip": "192.0.2.3", "user": getpass.getuser(),
+                       "disk_path": "/mnt/late"}
+            write_json(in_json_path, {"instances": [], "storages": [storage]})
+            # Storage host results done after the end of previous cycle
+            future = concurrent.futures.Future()
+            future.set_result({"/mnt/late": {"disk_file_sys": "nas:/late", "disk_space_total": 100,
+                                             "disk_space_used": 40, "disk_space_avail": 60, "state": "ok"}})
+            scheduler = MonitorScheduler(default_interval=60)
+            scheduler.set_pending(get_target_key("storages", storage), (future, ("192.0.2.3", storage["user"],
+                                                                                 "/mnt/late")))
+            history = MetricsHistory(capacity=4)
+            results = monitor_instances(in_json_path, None, scheduler=scheduler, history=history)
+            # Processed as a fresh result: kept in history, last known metrics and volume remembered
+            self.assertEqual(results["storages"][0]["disk_space_used"], 40)
+            self.assertIn("last_seen", results["storages"][0])
+            self.assertEqual(history.get_series("late", "disk_space_used")[1].tolist(), [40.])
+            self.assertEqual(run_monitor.LAST_STORAGE_METRICS[("192.0.2.3", "/mnt/late")]["disk_space_used"], 40)
+            self.assertIn(("192.0.2.3", "/mnt/late"), STORAGE_VOLUMES)
+
+    def test_scheduler(self):
+        scheduler = MonitorScheduler(default_interval=10)
+        # Fixed rate: next sample measured from the previous due time, not from the (late) sample time
+        self.assertTrue(scheduler.is_due("host", now=100.))
+        scheduler.set_result("host", {"cpu": 8}, 10, sample_time=100.)
+        self.assertFalse(scheduler.is_due("host", now=105.))
+        self.assertTrue(scheduler.is_due("host", now=110.))
+        scheduler.set_result("host", {"cpu": 8}, 10, sample_time=112.)
+        self.assertTrue(scheduler.is_due("host", now=120.))
+        # Pending (late) host is not due
+        scheduler.set_pending("host", "future")
+        self.assertFalse(scheduler.is_due("host", now=130.))
+        self.assertEqual(scheduler.pop_pending("host"), "future")
+        self.assertEqual(scheduler.get_result("host"), {"cpu": 8})
+        # Missed ticks are skipped
+        self.assertEqual(scheduler.get_next_tick_time(100., now=105.), 110.)
+        self.assertEqual(scheduler.get_next_tick_time(100., now=125.), 130.)
+        # Warning or critical state
+        self.assertTrue(is_alerting({"cpu": 8, "load_avg_1": 7.9}))
+        self.assertFalse(is_alerting({"cpu": 8, "load_avg_1": 1., "mem_total": 100, "mem_used": 10}))
+        self.assertTrue(is_alerting({"disk_space_total": 100, "disk_space_avail": 5}))
+
+    def test_circuit_breaker(self):
+        logger = create_rotating_logger(log_path=None, no_console_log=True, log_name="BBMonitorTest")
+        circuit_breaker = HostCircuitBreaker(threshold=2)
+        # Skipped after repeated failures, until its backoff is over
+        circuit_breaker.record_failure("192.0.2.1", logger)
+        self.assertTrue(circuit_breaker.allow("192.0.2.1", logger))
+        circuit_breaker.record_failure("192.0.2.1", logger)
+        self.assertFalse(circuit_breaker.allow("192.0.2.1", logger))
+        self.assertTrue(circuit_breaker.is_unreachable("192.0.2.1"))
+        self.assertIsNone(circuit_breaker.get_last_seen("192.0.2.1"))
+        # Back on success
+        circuit_breaker.record_success("192.0.2.1")
+        self.assertTrue(circuit_breaker.allow("192.0.2.1", logger))
+        self.assertIsNotNone(circuit_breaker.get_last_seen("192.0.2.1"))
+        # At most one failure per cycle (ex: host of an instance and a storage)
+        circuit_breaker.start_cycle()
+        circuit_breaker.record_failure("192.0.2.1", logger)
+        circuit_breaker.record_failure("192.0.2.1", logger)
+        self.assertTrue(circuit_breaker.allow("192.0.2.1", logger))
+        circuit_breaker.start_cycle()
+        circuit_breaker.record_failure("192.0.2.1", logger)
+        self.assertFalse(circuit_breaker.allow("192.0.2.1", logger))
+        # Cheap reachability check
+        with socket.socket() as server_socket:
+            server_socket.bind(("127.0.0.1", 0))
+            server_socket.listen()
+            self.assertTrue(is_reachable("127.0.0.1", port=server_socket.getsockname()[1]))
+
+    def test_probes_skipped_after_connection_failure(self):
+        # Remaining probes of an unreachable host are skipped
+        probes = [("first", "exit 255", None), ("cached", None, None), ("second", "echo 1", None)]
+        cmd_outputs = run_probes(probes, "localhost", None)
+        self.assertEqual(cmd_outputs[0].returncode, 255)
+        self.assertListEqual(cmd_outputs[1:], [None, None])
+
+    def test_probe_stats(self):
+        probe_stats = ProbeStats()
+        probe_stats.record("192.0.2.1", "load", "ok", spawn_time=0.002, run_time=0.03, parse_time=0.0001)
+        probe_stats.record("192.0.2.1", "free", "timeout", spawn_time=0.002, run_time=10.)
+        probe_stats.record("192.0.2.2", "load", "unreachable", spawn_time=0.002, run_time=5.)
+        summary = probe_stats.close()
+        # Per probe name and per host
+        self.assertEqual(summary["by_probe"]["load"]["count"], 2)
+        self.assertEqual(summary["by_probe"]["load"]["unreachable"], 1)
+        self.assertEqual(summary["by_host"]["192.0.2.1"]["timeout"], 1)
+        self.assertEqual(sum(summary["by_probe"]["load"]["histogram"]), 2)
+        self.assertEqual(summary["by_host"]["192.0.2.1"]["histogram"][-1], 1)
+        # Slowest first
+        self.assertEqual(summary["slowest"][0]["probe"], "free")
+        # Late probes are left out of the cycle, and of the next one
+        probe_stats.record("192.0.2.1", "uptime", "ok", run_time=0.01)
+        next_probe_stats = ProbeStats()
+        self.assertNotIn("uptime", probe_stats.close()["by_probe"])
+        self.assertDictEqual(next_probe_stats.close()["by_probe"], {})
+
 
 def get_active_net_interface():
     cmd_output = subprocess.run("ip a", shell=True, capture_output=True)
@@ -103,5 +732,19 @@ def get_active_net_interface():
     return None
 
 
+def get_batched_metrics(ip, logger):
+    # All instance metrics through a single combined command, as monitored remote instances
+    probes = get_instance_probes(ip, "/", get_active_net_interface())
+    cmd_output = run_command(create_batched_script(probes), ip, getpass.getuser())
+    cmd_outputs = split_batched_command_output(cmd_output, probes, ip, getpass.getuser())
+    return process_probe_outputs(ip, probes, cmd_outputs, logger)
+
+
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
 if __name__ == '__main__':
     unittest.main()
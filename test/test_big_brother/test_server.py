@@ -1,13 +1,32 @@
+import io
 import os
 import sys
+import copy
+import gzip
+import json
+import re
+import time
+import shutil
+import tempfile
 import unittest
+import threading
 from bs4 import BeautifulSoup
+try:
+    from prometheus_client.openmetrics.parser import text_string_to_metric_families
+except ImportError:
+    text_string_to_metric_families = None
 
 TOP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
 [sys.path.append(dir_path) for dir_path in [TOP_DIR] if dir_path not in sys.path]
 
+import big_brother.run_server as run_server
 from big_brother.run_server import create_html_page
-from big_brother.details.utils import load_json
+from big_brother.details.utils import load_json, write_json
+from big_brother.details.openmetrics import create_openmetrics_text
+from big_brother.details.snapshot_cache import Snapshot, SnapshotCache, MemorySnapshotStore
+from big_brother.details.broadcaster import Broadcaster
+from big_brother.details.history import MetricsHistory
+from big_brother.details.archive import MetricsArchive
 
 
 class BBMServer(unittest.TestCase):
@@ -85,6 +104,436 @@ class BBMServer(unittest.TestCase):
         self.assertTrue(footer is not None)
         self.assertEqual(footer.u.text, "Legend")
 
+    def test_create_openmetrics_text(self):
+        # Check input
+        json_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "data", "monitoring_results_sample.json"))
+        data = load_json(json_path)
+        data["instances"][0]["state"] = "ok"
+        data["metadata"]["probes"] = {
+            "buckets": [0.1, 1],
+            "by_probe": {"load": {"count": 3, "ok": 2, "error": 0, "timeout": 1, "unreachable": 0, "spawn_time": 0.01,
+                                  "run_time": 10.2, "parse_time": 0.001, "max_time": 10.1, "histogram": [1, 1, 1]}},
+        }
+
+        # Create exposition
+        samples = parse_openmetrics_text(create_openmetrics_text(data))
+        # -- Instance and storage metrics, labelled by name, ip and type, and path for storages (missing values not
+        # exposed)
+        apollo_labels = {"name": "apollo-1", "ip": "192.168.10.101", "type": ""}
+        helios_labels = {"name": "helios", "ip": "192.168.10.107", "type": ""}
+        self.assertEqual(get_sample(samples, "bigbrother_instance_cpus", **apollo_labels), 80)
+        self.assertEqual(get_sample(samples, "bigbrother_instance_load_average_1m", **helios_labels), 0.65)
+        self.assertEqual(get_sample(samples, "bigbrother_instance_memory_used_bytes", **helios_labels), 9060700 * 1024)
+        self.assertFalse([key for key in samples if dict(key[1]).get("name") == "scoubi"])
+        self.assertEqual(get_sample(samples, "bigbrother_storage_space_available_bytes", name="datagri",
+                                    ip="192.168.10.106", type="NetApp NAS", path="/mnt/datagri"), 1712138240 * 1024)
+        # -- Monitoring state, as a stateset labelled by its family name
+        self.assertEqual(get_sample(samples, "bigbrother_instance_state", **apollo_labels,
+                                    bigbrother_instance_state="ok"), 1)
+        self.assertEqual(get_sample(samples, "bigbrother_instance_state", **apollo_labels,
+                                    bigbrother_instance_state="unreachable"), 0)
+        # -- Monitor cycle timings, of last cycle (gauges)
+        self.assertEqual(get_sample(samples, "bigbrother_monitor_cycle_duration_seconds"), 135.)
+        self.assertEqual(get_sample(samples, "bigbrother_monitor_probe_duration_seconds", probe="load"), 10.211)
+        self.assertEqual(get_sample(samples, "bigbrother_monitor_probe_max_duration_seconds", probe="load"), 10.1)
+        self.assertEqual(get_sample(samples, "bigbrother_monitor_probes_by_duration", probe="load", max_seconds="1.0"),
+                         2)
+        self.assertEqual(get_sample(samples, "bigbrother_monitor_probes_by_duration", probe="load", max_seconds="+Inf"),
+                         3)
+        self.assertEqual(get_sample(samples, "bigbrother_monitor_probes", probe="load", status="timeout"), 1)
+        # -- Storages of a same host, with the same name and type, still told apart
+        data["storages"][0].update({"name": "datagri", "type": "NetApp NAS"})
+        storage_keys = [key for key in parse_openmetrics_text(create_openmetrics_text(data))
+                        if key[0] == "bigbrother_storage_space_total_bytes"]
+        self.assertEqual(len(storage_keys), 2)
+
+    def test_snapshot_cache(self):
+        json_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "data", "monitoring_results_sample.json"))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_json_path = os.path.join(tmp_dir, "monitoring_results.json")
+            shutil.copy(json_path, tmp_json_path)
+            cache = SnapshotCache(tmp_json_path)
+            renderings = []
+
+            def render(data):
+                renderings.append(data)
+                return len(data["instances"])
+
+            # Concurrent requests: a single load and a single rendering
+            snapshots = []
+            threads = [threading.Thread(target=lambda: snapshots.append(cache.get())) for _ in range(8)]
+            [thread.start() for thread in threads]
+            [thread.join() for thread in threads]
+            self.assertEqual(len({id(snapshot) for snapshot in snapshots}), 1)
+            snapshot = cache.get()
+            self.assertIs(snapshot, snapshots[0])
+            self.assertEqual(snapshot.get_rendering("count", render), 3)
+            self.assertEqual(snapshot.get_rendering("count", render), 3)
+            self.assertEqual(len(renderings), 1)
+
+            # File replaced: new snapshot, rendered again
+            data = load_json(json_path)
+            data["instances"] = data["instances"][:1]
+            write_json(tmp_json_path + ".tmp", data)
+            os.replace(tmp_json_path + ".tmp", tmp_json_path)
+            snapshot = cache.get()
+            self.assertIsNot(snapshot, snapshots[0])
+            self.assertEqual(snapshot.get_rendering("count", render), 1)
+            self.assertEqual(len(renderings), 2)
+
+            # Missing file
+            os.remove(tmp_json_path)
+            self.assertRaises(RuntimeError, cache.get)
+
+    def test_memory_snapshot_store(self):
+        json_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "data", "monitoring_results_sample.json"))
+        data = load_json(json_path)
+        store = MemorySnapshotStore(first_snapshot_timeout=0.1)
+        # Nothing published yet
+        self.assertRaises(RuntimeError, store.get)
+        self.assertIsNone(store.get_next(None, 0.1))
+
+        # Published results, handed over as is
+        data["metadata"]["version"] = 7
+        threading.Timer(0.1, store.publish, args=(data,)).start()
+        snapshot = store.get_next(None, 5)
+        self.assertIs(snapshot.data, data)
+        self.assertIs(store.get(), snapshot)
+        self.assertTrue(snapshot.get_tag().endswith("-7"))
+        self.assertIs(store.get_next(snapshot, 0.1), snapshot)
+        # -- Served like results of a file
+        run_server.SNAPSHOT_CACHE = store
+        status, _, body = request_app("/api/v1/instances", {"QUERY_STRING": "fields=name"})
+        self.assertEqual(status, "200 OK")
+        self.assertListEqual([instance["name"] for instance in json.loads(body)["instances"]],
+                             ["apollo-1", "helios", "scoubi"])
+
+        # Next results
+        new_data = copy.deepcopy(data)
+        new_data["metadata"]["version"] = 8
+        threading.Timer(0.1, store.publish, args=(new_data,)).start()
+        new_snapshot = store.get_next(snapshot, 5)
+        self.assertIs(new_snapshot.data, new_data)
+        self.assertNotEqual(new_snapshot.get_tag(), snapshot.get_tag())
+
+    def test_conditional_responses(self):
+        json_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "data", "monitoring_results_sample.json"))
+        run_server.SNAPSHOT_CACHE = SnapshotCache(json_path)
+
+        # Full page, compressed if accepted
+        status, headers, body = request_app("/")
+        self.assertEqual(status, "200 OK")
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertTrue(body.decode().strip().startswith("<!doctype html>"))
+        etag = headers["Etag"]
+        last_modified = headers["Last-Modified"]
+        status, headers, gzip_body = request_app("/", {"HTTP_ACCEPT_ENCODING": "gzip, deflate, br"})
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(gzip_body), body)
+        self.assertNotEqual(headers["Etag"], etag)
+        status, headers, _ = request_app("/", {"HTTP_ACCEPT_ENCODING": "gzip;q=0"})
+        self.assertNotIn("Content-Encoding", headers)
+
+        # Up to date client copy, by entity tag or date
+        status, headers, body = request_app("/", {"HTTP_IF_NONE_MATCH": f'"other", {etag}'})
+        self.assertEqual(status, "304 Not Modified")
+        self.assertEqual(body, b"")
+        self.assertEqual(headers["Etag"], etag)
+        status, _, _ = request_app("/", {"HTTP_IF_MODIFIED_SINCE": last_modified})
+        self.assertEqual(status, "304 Not Modified")
+        # -- Outdated client copy
+        status, _, _ = request_app("/", {"HTTP_IF_NONE_MATCH": '"other"', "HTTP_IF_MODIFIED_SINCE": last_modified})
+        self.assertEqual(status, "200 OK")
+        status, _, _ = request_app("/", {"HTTP_IF_MODIFIED_SINCE": "Thu, 01 Jan 1970 00:00:00 GMT"})
+        self.assertEqual(status, "200 OK")
+
+        # Same for OpenMetrics exposition, with its own entity tag
+        status, headers, _ = request_app("/metrics")
+        self.assertEqual(status, "200 OK")
+        self.assertTrue(headers["Content-Type"].startswith("application/openmetrics-text"))
+        self.assertNotEqual(headers["Etag"], etag)
+        status, _, _ = request_app("/metrics", {"HTTP_IF_NONE_MATCH": headers["Etag"]})
+        self.assertEqual(status, "304 Not Modified")
+
+    def test_live_updates(self):
+        json_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "data", "monitoring_results_sample.json"))
+        data = load_json(json_path)
+        previous_snapshot = Snapshot((1, 1), data, 0.)
+
+        # New snapshot: a changed metric, a newly unreachable instance
+        new_data = copy.deepcopy(data)
+        new_data["metadata"]["timestamp"] = "2022-12-16 13:45:43"
+        new_data["instances"][1]["load_avg_1"] = 9.65
+        new_data["instances"][0].update({"state": "unreachable", "last_seen": "2022-12-16 13:44:43"})
+        snapshot = Snapshot((1, 2), new_data, 0.)
+        event = run_server.create_snapshot_event(previous_snapshot, snapshot).decode()
+        event_lines = event.split("\n")
+        self.assertEqual(event_lines[:2], ["id: 1-2", "event: snapshot"])
+        self.assertTrue(event.endswith("\n\n"))
+        event_data = json.loads(event_lines[2].removeprefix("data: "))
+        self.assertEqual(event_data["previous"], "1-1")
+        self.assertEqual(event_data["version"], "1-2")
+        self.assertEqual(event_data["timestamp"], "2022-12-16 13:45:43")
+        # -- Only changed cells, whole row when its layout changed
+        self.assertListEqual(sorted(event_data["rows"].keys()), ["bb-instance-0", "bb-instance-1"])
+        self.assertIn("Unreachable since 2022-12-16 13:44:43", event_data["rows"]["bb-instance-0"]["row"])
+        cells = event_data["rows"]["bb-instance-1"]["cells"]
+        self.assertListEqual(list(cells.keys()), ["3"])
+        self.assertEqual(BeautifulSoup(cells["3"], 'html.parser').text, "9.65")
+        # -- Removed instance: whole page to be reloaded
+        new_data = copy.deepcopy(data)
+        new_data["instances"].pop()
+        previous_cells = previous_snapshot.get_rendering("cells", run_server.create_html_cells)
+        self.assertIsNone(run_server.get_rows_delta(previous_cells, run_server.create_html_cells(new_data)))
+
+        # Fan-out to subscribers, slow ones being closed
+        broadcaster = Broadcaster(max_pending=2)
+        subscribers = [broadcaster.subscribe() for _ in range(3)]
+        broadcaster.publish(b"event 1")
+        [subscriber.get_nowait() for subscriber in subscribers[:2]]
+        broadcaster.publish(b"event 2")
+        subscribers[0].get_nowait()
+        broadcaster.publish(b"event 3")
+        self.assertEqual(broadcaster.get_subscriber_count(), 2)
+        self.assertListEqual([subscribers[0].get_nowait()], [b"event 3"])
+        self.assertListEqual([subscribers[1].get_nowait(), subscribers[1].get_nowait()], [b"event 2", b"event 3"])
+        self.assertIsNone(subscribers[2].get_nowait())
+
+        # Snapshots watcher going on after a failure to publish
+        class FailingBroadcaster(Broadcaster):
+            def publish(self, message):
+                if b"id: 1-2" in message:
+                    raise OSError("publish failure")
+                super().publish(message)
+
+        snapshots = [previous_snapshot, snapshot, Snapshot((1, 3), data, 0.)]
+
+        class SnapshotsList:
+            def get_next(self, current, poll_time):
+                if not snapshots:
+                    time.sleep(poll_time)
+                    return current
+                return snapshots.pop(0)
+
+        broadcaster = FailingBroadcaster()
+        subscriber = broadcaster.subscribe()
+        threading.Thread(target=run_server.watch_snapshots, args=(SnapshotsList(), broadcaster, 0.01),
+                         daemon=True).start()
+        self.assertTrue(subscriber.get(timeout=5).startswith(b"id: 1-3\n"))
+
+        # Events stream subscriber released on missing results file
+        run_server.SNAPSHOT_CACHE = SnapshotCache(json_path + ".missing")
+        with self.assertRaises(RuntimeError):
+            run_server.get_events()
+        self.assertEqual(run_server.BROADCASTER.get_subscriber_count(), 0)
+
+        # Live updated page
+        html_page = create_html_page(data, "BigBrother", previous_snapshot.get_tag())
+        soup = BeautifulSoup(html_page, 'html.parser')
+        self.assertEqual(soup.body["data-bb-version"], "1-1")
+        self.assertIsNotNone(soup.find("tr", {"id": "bb-storage-1"}))
+        self.assertIn('new EventSource("events")', html_page)
+
+    def test_api(self):
+        json_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "data", "monitoring_results_sample.json"))
+        run_server.SNAPSHOT_CACHE = SnapshotCache(json_path)
+
+        # Whole instances
+        status, headers, body = request_app("/api/v1/instances")
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(headers["Content-Type"], "application/json")
+        result = json.loads(body)
+        self.assertEqual(result["version"], 1)
+        self.assertEqual(result["timestamp"], "2022-12-16 13:44:43")
+        self.assertListEqual(result["instances"], load_json(json_path)["instances"])
+
+        # Projection, sort (missing values last) and limit
+        query_string = "fields=name,load_avg_1&sort=load_avg_1"
+        status, headers, body = request_app("/api/v1/instances", {"QUERY_STRING": query_string})
+        self.assertListEqual(json.loads(body)["instances"], [{"name": "helios", "load_avg_1": 0.65},
+                                                             {"name": "apollo-1", "load_avg_1": 142.35},
+                                                             {"name": "scoubi", "load_avg_1": None}])
+        status, _, body = request_app("/api/v1/instances", {"QUERY_STRING": "fields=name&sort=-load_avg_1&limit=1"})
+        self.assertListEqual(json.loads(body)["instances"], [{"name": "apollo-1"}])
+        # -- Conditional request
+        status, _, _ = request_app("/api/v1/instances", {"QUERY_STRING": "fields=name&sort=-load_avg_1&limit=1",
+                                                         "HTTP_IF_NONE_MATCH": headers["Etag"]})
+        self.assertEqual(status, "200 OK")
+        status, _, _ = request_app("/api/v1/instances", {"QUERY_STRING": query_string,
+                                                         "HTTP_IF_NONE_MATCH": headers["Etag"]})
+        self.assertEqual(status, "304 Not Modified")
+
+        # Filters, with wildcards
+        status, _, body = request_app("/api/v1/instances", {"QUERY_STRING": "name=apollo-*,scoubi&fields=name"})
+        self.assertListEqual(json.loads(body)["instances"], [{"name": "apollo-1"}, {"name": "scoubi"}])
+        status, _, body = request_app("/api/v1/storages", {"QUERY_STRING": "type=NetApp%20NAS&fields=name,type"})
+        self.assertListEqual(json.loads(body)["storages"], [{"name": "datagri", "type": "NetApp NAS"}])
+        status, _, body = request_app("/api/v1/storages", {"QUERY_STRING": "type=Synology%20NAS&name=datagri"})
+        self.assertListEqual(json.loads(body)["storages"], [])
+
+        # Invalid queries
+        for query_string in ["fields=name,foo", "sort=-foo", "limit=-1", "foo=bar"]:
+            status, _, body = request_app("/api/v1/instances", {"QUERY_STRING": query_string})
+            self.assertEqual(status, "400 Bad Request")
+            self.assertIn("Invalid", json.loads(body)["error"])
+
+    def test_api_history(self):
+        run_server.METRICS_HISTORY = None
+        status, _, _ = request_app("/api/v1/history", {"QUERY_STRING": "metric=load_avg_1"})
+        self.assertEqual(status, "404 Not Found")
+
+        # Samples of the last 2 hours, every 10s (a minute late for apollo-2)
+        history = MetricsHistory(metrics=["load_avg_1", "mem_used"], rollups=[(60, 240), (900, 16)])
+        now = time.time() // 900 * 900
+        for i in range(720):
+            timestamp = now - 7200 + 10 * i
+            history.append("helios", timestamp, [0.5, 1000 + i])
+            history.append("apollo-1", timestamp, [i / 100, None])
+            if i < 714:
+                history.append("apollo-2", timestamp, [100 + i % 2, 2000])
+        run_server.METRICS_HISTORY = history
+
+        # Series of last hour (default), raw samples
+        status, headers, body = request_app("/api/v1/history", {"QUERY_STRING": f"metric=mem_used&host=helios&to={now}"})
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(headers["Content-Type"], "application/json")
+        result = json.loads(body)
+        self.assertEqual((result["version"], result["metric"], result["step"], result["stat"]),
+                         (1, "mem_used", None, None))
+        self.assertListEqual(list(result["hosts"].keys()), ["helios"])
+        self.assertEqual(len(result["hosts"]["helios"]["times"]), 360)
+        self.assertEqual(result["hosts"]["helios"]["values"][-1], 1719)
+        # -- From epoch (0 being a time, not a missing one)
+        status, _, body = request_app("/api/v1/history", {"QUERY_STRING": f"metric=mem_used&host=helios&from=0&to={now}"
+                                                                          f"&step=raw"})
+        result = json.loads(body)
+        self.assertEqual(result["from"], 0)
+        self.assertEqual(len(result["hosts"]["helios"]["times"]), 720)
+        # -- Rollup tier picked for longer periods, or given
+        status, _, body = request_app("/api/v1/history", {"QUERY_STRING": "metric=load_avg_1&from=-3h"})
+        result = json.loads(body)
+        self.assertEqual((result["step"], result["stat"]), (60, "mean"))
+        self.assertListEqual(list(result["hosts"].keys()), ["apollo-1", "apollo-2", "helios"])
+        self.assertEqual(len(result["hosts"]["helios"]["times"]), 120)
+        self.assertEqual(len(result["hosts"]["apollo-2"]["times"]), 119)
+        self.assertEqual(result["hosts"]["apollo-2"]["values"][-1], 100.5)
+        status, _, body = request_app("/api/v1/history", {"QUERY_STRING": f"metric=load_avg_1&step=15m&host=hel*&from={now - 7200}"})
+        self.assertListEqual(json.loads(body)["hosts"]["helios"]["values"], [0.5] * 8)
+
+        # Aggregates, per host and fleet-wide
+        for agg, expected_values, expected_all in [
+            ("max", {"apollo-1": 7.19, "apollo-2": 101, "helios": 0.5}, 101),
+            ("min", {"apollo-1": 0, "apollo-2": 100, "helios": 0.5}, 0),
+            ("last", {"apollo-1": 7.19, "apollo-2": 101, "helios": 0.5}, 7.19),
+            ("p50", {"apollo-1": 3.595, "apollo-2": 100.5, "helios": 0.5}, 3.565),
+        ]:
+            query_string = f"metric=load_avg_1&from={now - 7200}&to={now}&step=raw&agg={agg}"
+            status, _, body = request_app("/api/v1/history", {"QUERY_STRING": query_string})
+            result = json.loads(body)
+            self.assertEqual(result["agg"], agg)
+            self.assertDictEqual({host: round(value, 3) for host, value in result["hosts"].items()}, expected_values)
+            self.assertAlmostEqual(result["all"], expected_all, places=3)
+        status, _, body = request_app("/api/v1/history", {"QUERY_STRING": "metric=mem_used&host=apollo-*&agg=p95"})
+        result = json.loads(body)
+        self.assertIsNone(result["step"])
+        self.assertDictEqual(result["hosts"], {"apollo-1": None, "apollo-2": 2000})
+        self.assertEqual(result["all"], 2000)
+
+        # Invalid queries
+        for query_string in ["host=helios", "metric=foo", "metric=mem_used&agg=p101", "metric=mem_used&step=5m",
+                             "metric=mem_used&from=yesterday", "metric=mem_used&foo=bar"]:
+            status, _, body = request_app("/api/v1/history", {"QUERY_STRING": query_string})
+            self.assertEqual(status, "400 Bad Request")
+            self.assertIn("error", json.loads(body))
+        run_server.METRICS_HISTORY = None
+
+    def test_api_archive(self):
+        run_server.METRICS_ARCHIVE = None
+        status, _, _ = request_app("/api/v1/archive", {"QUERY_STRING": "metric=load_avg_1"})
+        self.assertEqual(status, "404 Not Found")
+
+        with tempfile.TemporaryDirectory(prefix="test_server_") as tmp_dir:
+            db_path = os.path.join(tmp_dir, "archive.db")
+            archive = MetricsArchive(db_path)
+            now = time.time()
+            for i in range(10):
+                archive.append_results(now - 100 + 10 * i, [{"name": "helios", "load_avg_1": i},
+                                                            {"name": "apollo-1", "load_avg_1": 100 + i}])
+            archive.close()
+            run_server.METRICS_ARCHIVE = MetricsArchive(db_path, readonly=True)
+
+            # Series of last day (default)
+            status, headers, body = request_app("/api/v1/archive", {"QUERY_STRING": "metric=load_avg_1&host=hel*"})
+            self.assertEqual(status, "200 OK")
+            self.assertEqual(headers["Content-Type"], "application/json")
+            result = json.loads(body)
+            self.assertEqual((result["version"], result["metric"], result["agg"]), (1, "load_avg_1", None))
+            self.assertListEqual(list(result["hosts"].keys()), ["helios"])
+            self.assertListEqual(result["hosts"]["helios"]["values"], list(range(10)))
+            # Aggregates, per host and of all of them
+            query_string = f"metric=load_avg_1&agg=mean&to={now - 55}"
+            status, _, body = request_app("/api/v1/archive", {"QUERY_STRING": query_string})
+            result = json.loads(body)
+            self.assertDictEqual(result["hosts"], {"apollo-1": 102, "helios": 2})
+            self.assertEqual(result["all"], 52)
+
+            # Invalid queries
+            for query_string in ["host=helios", "metric=foo", "metric=mem_used&agg=p95", "metric=mem_used&step=1h"]:
+                status, _, body = request_app("/api/v1/archive", {"QUERY_STRING": query_string})
+                self.assertEqual(status, "400 Bad Request")
+                self.assertIn("error", json.loads(body))
+            run_server.METRICS_ARCHIVE = None
+
+
+def request_app(path, environ=None):
+    """Send a GET request to the server application, get response (status, headers, body)"""
+    request_environ = {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(),
+        **(environ or {}),
+    }
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = status
+        response["headers"] = {name.title(): value for name, value in headers}
+
+    body = b"".join(run_server.APP(request_environ, start_response))
+    return response["status"], response["headers"], body
+
 
 if __name__ == '__main__':
     unittest.main()
+
+
+
+def parse_openmetrics_text(text):
+    """Parse an OpenMetrics text exposition into {(sample name, frozenset of labels): value}, with the reference
+    parser if available, else checking its structure only (declared families, label syntax, final EOF)"""
+    if text_string_to_metric_families is not None:
+        return {(sample.name, frozenset(sample.labels.items())): sample.value
+                for family in text_string_to_metric_families(text) for sample in family.samples}
+    lines = text.splitlines()
+    assert lines[-1] == "# EOF" and "# EOF" not in lines[:-1]
+    families, samples = set(), {}
+    for line in lines[:-1]:
+        if line.startswith("# TYPE "):
+            families.add(line.split()[2])
+            continue
+        if line.startswith("#"):
+            continue
+        match = re.fullmatch(r'([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)', line)
+        assert match and match.group(1) in families, line
+        labels = re.findall(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"', match.group(2) or "")
+        assert ",".join(f'{label}="{value}"' for label, value in labels) == (match.group(2) or ""), line
+        samples[(match.group(1), frozenset(labels))] = float(match.group(3))
+    return samples
+
+
+def get_sample(samples, name, /, **labels):
+    return samples[(name, frozenset(labels.items()))]